@@ -1,10 +1,12 @@
 from flask import Flask, request, jsonify, send_from_directory, render_template, send_file
 from flask_cors import CORS
 from clv_analyzer import CLVAnalyzer
+import ingest
 import os
 import openai
 from dotenv import load_dotenv
 import json
+import hmac
 import numpy as np
 from functools import wraps
 from customer_profile_generator import CustomerProfileGenerator
@@ -22,8 +24,8 @@ CORS(app)
 # Initialize OpenAI client
 openai.api_key = os.getenv('OPENAI_API_KEY')
 
-# Initialize analyzer
-clv_analyzer = CLVAnalyzer()
+# Initialize analyzer; CLV_APPROXIMATE=1 serves distinct counts and percentiles from sketches
+clv_analyzer = CLVAnalyzer(approximate=os.getenv('CLV_APPROXIMATE', '') == '1')
 profile_generator = CustomerProfileGenerator()
 
 # Initialize Modal client
@@ -51,11 +53,29 @@ def require_merchant_auth(f):
             return jsonify({'error': 'Invalid authorization format'}), 401
     return decorated
 
+def require_ingest_token(f):
+    """Require the X-Ingest-Token header to match CLV_INGEST_TOKEN (shared with server.js)."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        expected = os.getenv('CLV_INGEST_TOKEN')
+        if not expected:
+            return jsonify({'error': 'Ingest token not configured'}), 503
+        if not hmac.compare_digest(request.headers.get('X-Ingest-Token', ''), expected):
+            return jsonify({'error': 'Invalid ingest token'}), 401
+        return f(*args, **kwargs)
+    return decorated
+
 # Load data at startup
 print("Loading data at startup...")
 try:
-    clv_analyzer.load_data()
-    print(f"Successfully loaded data for {len(clv_analyzer.data)} customers")
+    if os.getenv('CLV_TRANSACTION_LOG'):
+        clv_analyzer.load_log(os.getenv('CLV_TRANSACTION_LOG'))
+    elif os.getenv('CLV_SQLITE_DB'):
+        clv_analyzer.load_sqlite(os.getenv('CLV_SQLITE_DB'))
+    else:
+        clv_analyzer.load_data(snapshot_dir=os.getenv('CLV_SNAPSHOT_DIR', '.clv_snapshot'))
+    print(f"Successfully loaded data for {clv_analyzer.store.num_loaded_customers} customers")
+    clv_analyzer.fit_clv_model()
 except Exception as e:
     print(f"Error loading data at startup: {str(e)}")
 
@@ -63,7 +83,7 @@ except Exception as e:
 def check_status():
     """Check if the API is ready and data is loaded."""
     try:
-        if not hasattr(clv_analyzer, 'data') or not clv_analyzer.data:
+        if not clv_analyzer.store.num_loaded_customers:
             return jsonify({
                 'status': 'error',
                 'message': 'Data not loaded',
@@ -73,7 +93,8 @@ def check_status():
             'status': 'success',
             'message': 'API is ready',
             'ready': True,
-            'customers_loaded': len(clv_analyzer.data)
+            'customers_loaded': clv_analyzer.store.num_loaded_customers,
+            'cache': clv_analyzer.merchant_metrics.stats()
         })
     except Exception as e:
         return jsonify({
@@ -82,12 +103,46 @@ def check_status():
             'ready': False
         }), 500
 
+def parse_time_param(name):
+    """Optional epoch-seconds or ISO-8601 query parameter; raises ValueError if malformed."""
+    value = request.args.get(name)
+    if not value:
+        return None
+    if value.lstrip('-').isdigit():
+        return int(value)
+    return ingest.parse_timestamp(value)
+
 @app.route('/api/merchant/<merchant_name>/top-customers', methods=['GET'])
 def get_merchant_top_customers(merchant_name):
-    """Get top CLV customers and their demographics for a specific merchant."""
+    """Get top CLV customers and their demographics for a specific merchant.
+
+    Optional since/until query parameters (epoch seconds or ISO-8601)
+    restrict rankings and demographics to transactions in [since, until).
+    rank_by=predicted_value ranks by the fitted model's expected spend
+    over the next year instead of clv_score.
+    """
+    try:
+        since, until = parse_time_param('since'), parse_time_param('until')
+    except ValueError:
+        return jsonify({
+            'status': 'error',
+            'message': 'since and until must be epoch seconds or ISO-8601 datetimes'
+        }), 400
+    try:
+        rankings = clv_analyzer.get_merchant_customer_rankings(merchant_name, limit=10, since=since, until=until,
+                                                               rank_by=request.args.get('rank_by', 'clv_score'))
+    except ValueError as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
     try:
         # Get merchant's top customers and insights
-        rankings = clv_analyzer.get_merchant_customer_rankings(merchant_name)
         insights = clv_analyzer.get_merchant_insights(merchant_name)
         
         if not rankings or not insights:
@@ -97,7 +152,7 @@ def get_merchant_top_customers(merchant_name):
             }), 404
         
         # Get top 10 customers
-        top_customers = rankings[:10]
+        top_customers = rankings
         
         # Get demographic insights
         demographics = {
@@ -107,6 +162,17 @@ def get_merchant_top_customers(merchant_name):
             'average_monthly_frequency': insights['average_purchase_frequency'],
             'retention_metrics': insights['retention_metrics']
         }
+        if since is not None or until is not None:
+            # Retention stays lifetime; everything else describes the window
+            window = clv_analyzer.get_merchant_window_metrics(merchant_name, since, until)
+            demographics.update({
+                'total_customers': window['total_customers'],
+                'average_transaction_value': window['average_transaction_value'],
+                'total_revenue': window['total_revenue'],
+                'average_monthly_frequency': window['average_purchase_frequency'],
+                'average_clv_score': window['average_clv_score'],
+                'window': {'since': since, 'until': until, 'transactions': window['transactions']}
+            })
         
         # Generate profile and ad suggestions
         profile = profile_generator.generate_customer_profile(merchant_name, top_customers)
@@ -126,6 +192,77 @@ def get_merchant_top_customers(merchant_name):
             'message': str(e)
         }), 500
 
+@app.route('/api/merchant/<merchant_name>/cohorts', methods=['GET'])
+def get_merchant_cohorts(merchant_name):
+    """Monthly acquisition cohorts of a merchant, with retention and revenue by months since first purchase."""
+    try:
+        cohorts = clv_analyzer.get_merchant_cohorts(merchant_name)
+        if not cohorts:
+            return jsonify({
+                'status': 'error',
+                'message': f'No data found for merchant {merchant_name}'
+            }), 404
+        return jsonify({
+            'status': 'success',
+            'merchant_name': merchant_name,
+            'cohorts': cohorts['cohorts']
+        })
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
+@app.route('/api/transactions', methods=['POST'])
+@require_ingest_token
+def append_transactions():
+    """Append newly synced Knot transactions for one customer to the live analyzer.
+
+    Transactions without a datetime, url or price total are skipped and
+    counted as invalid rather than failing the batch.
+    """
+    try:
+        data = request.get_json()
+        customer_id = data.get('external_user_id') or data.get('customer_id')
+        transactions = data.get('transactions') or []
+        
+        if not customer_id:
+            return jsonify({
+                'status': 'error',
+                'message': 'No external_user_id provided'
+            }), 400
+        
+        invalid = sum(1 for t in transactions if not ingest.is_rankable(t))
+        added = clv_analyzer.append_transactions(customer_id, transactions)
+        return jsonify({
+            'status': 'success',
+            'transactions_added': added,
+            'invalid_skipped': invalid,
+            'duplicates_skipped': len(transactions) - invalid - added
+        })
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
+@app.route('/api/admin/reload', methods=['POST'])
+@require_merchant_auth
+def reload_data():
+    """Re-read only new, changed and deleted customer files from the data directory."""
+    try:
+        summary = clv_analyzer.reload_data()
+        return jsonify({
+            'status': 'success',
+            'customers_loaded': clv_analyzer.store.num_loaded_customers,
+            **summary
+        })
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
 @app.route('/api/text_to_image', methods=['POST'])
 def generate_image():
     try:
@@ -0,0 +1,325 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+from clv_analyzer import CLVAnalyzer
+from cohorts import CohortMatrices
+import customer_files
+import ingest
+from ingest import list_customer_files, normalize_merchant_name
+from lookalikes import LookalikeIndex
+from merchant_table import MerchantCustomerTable
+from transaction_store import SECONDS_PER_DAY, StringTable, TransactionStore
+
+
+def legacy_load(data_dir):
+    """Load customer files as nested dicts, the way CLVAnalyzer used to."""
+    data = []
+    for path in list_customer_files(data_dir):
+        data.append(customer_files.load_customer_document(path))
+    return data
+
+
+def legacy_merchant_insights(data, merchant_id):
+    """The original two-pass, per-transaction insights algorithm, kept as a baseline."""
+    merchant_customers = {}
+    for customer in data:
+        merchant_transactions = [
+            t for t in customer['transactions']
+            if merchant_id.lower() == normalize_merchant_name(t['url'])
+        ]
+        if not merchant_transactions:
+            continue
+        dates = [datetime.fromisoformat(t['datetime'].replace('Z', '+00:00')).replace(tzinfo=None)
+                 for t in merchant_transactions]
+        total_spend = sum(float(t['price']['total']) for t in merchant_transactions)
+        num_transactions = len(merchant_transactions)
+        months_active = max(1, (max(dates) - min(dates)).days / 30.0)
+        merchant_customers[customer['customer_type']] = {
+            'total_spend': total_spend,
+            'num_transactions': num_transactions,
+            'avg_transaction_value': total_spend / num_transactions,
+            'purchase_frequency': num_transactions / months_active,
+            'clv_score': 0.4 * total_spend + 0.3 * (num_transactions * 100) + 0.3 * (months_active * 1000),
+            'last_purchase': max(dates).isoformat()
+        }
+
+    time_between_purchases = []
+    for customer in data:
+        merchant_transactions = [
+            t for t in customer['transactions']
+            if normalize_merchant_name(t['url']) == merchant_id.lower()
+        ]
+        if len(merchant_transactions) > 1:
+            dates = sorted(datetime.fromisoformat(t['datetime'].replace('Z', '+00:00')).replace(tzinfo=None)
+                           for t in merchant_transactions)
+            for i in range(1, len(dates)):
+                time_between_purchases.append((dates[i] - dates[i - 1]).days)
+
+    current_date = datetime.now()
+    churned_customers = sum(1 for c in merchant_customers.values()
+                            if (current_date - datetime.fromisoformat(c['last_purchase'])).days > 30)
+    top_customers = sorted(merchant_customers.items(), key=lambda x: x[1]['clv_score'], reverse=True)[:5]
+    return {
+        'total_customers': len(merchant_customers),
+        'repeat_customers': sum(1 for c in merchant_customers.values() if c['num_transactions'] > 1),
+        'avg_time_between_purchases': round(np.mean(time_between_purchases), 1) if time_between_purchases else 0,
+        'churned_customers': churned_customers,
+        'top_customers': [customer_id for customer_id, _ in top_customers]
+    }
+
+
+def time_calls(fn, args_list):
+    """Run fn over args_list; returns per-call latencies in milliseconds."""
+    latencies = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def report(label, latencies):
+    print(f"{label:<28} mean {statistics.mean(latencies):9.3f} ms   "
+          f"p50 {statistics.median(latencies):9.3f} ms   max {max(latencies):9.3f} ms")
+
+
+def bench_insights(args):
+    """Per-merchant get_merchant_insights latency, legacy vs. fused."""
+    data = legacy_load(args.data_dir)
+    analyzer = CLVAnalyzer()
+    analyzer.load_data(args.data_dir, workers=1)
+    merchants = list(analyzer.store.merchants.values)
+
+    legacy = time_calls(lambda m: legacy_merchant_insights(data, m), [(m,) for m in merchants])
+    fused = time_calls(analyzer.get_merchant_insights, [(m,) for m in merchants])
+
+    mismatches = 0
+    for merchant_id in merchants:
+        expected = legacy_merchant_insights(data, merchant_id)
+        actual = analyzer.get_merchant_insights(merchant_id)
+        retention = actual['retention_metrics']
+        if (expected['total_customers'], expected['repeat_customers'],
+                expected['avg_time_between_purchases'], expected['churned_customers']) != (
+                actual['total_customers'], retention['repeat_customers'],
+                retention['avg_time_between_purchases'], retention['churned_customers']):
+            mismatches += 1
+
+    print(f"{len(merchants)} merchants, {analyzer.store.num_transactions} transactions")
+    report('legacy two-pass insights', legacy)
+    report('fused table insights', fused)
+    print(f"speedup {statistics.mean(legacy) / statistics.mean(fused):.0f}x, "
+          f"{mismatches} merchants with differing counts")
+
+
+def bench_normalize(args):
+    """Per-transaction merchant normalization cost, per URL vs. memoized per host."""
+    data = legacy_load(args.data_dir)
+    urls = [t['url'] for customer in data for t in customer['transactions']]
+    transactions = [t for customer in data for t in customer['transactions']]
+
+    def per_url():
+        return [normalize_merchant_name(url) for url in urls]
+
+    def per_host():
+        return [ingest.merchant_for_url(url) for url in urls]
+
+    def parse():
+        return ingest.parse_transactions('benchmark', transactions)
+
+    assert per_url() == per_host()
+    print(f"{len(urls)} transactions, {len({ingest.url_host(url) for url in urls})} distinct hosts")
+    for label, fn in (('normalize every URL', per_url), ('memoized per host', per_host),
+                      ('parse_transactions', parse)):
+        seconds = min(time_calls(fn, [()] * args.repeat)) / 1000
+        print(f"{label:<28} {seconds / len(urls) * 1e9:8.0f} ns per transaction")
+
+
+def write_synthetic_customer_file(path, size_mb, template):
+    """Write one customer file of roughly size_mb, repeating a template transaction."""
+    target = size_mb * 1024 * 1024
+    written = 0
+    with open(path, 'w') as f:
+        f.write('{"customer_type": "Synthetic Customer", "transactions": [')
+        i = 0
+        while written < target:
+            transaction = dict(template, id=f"synthetic-{i}")
+            chunk = ('' if i == 0 else ',') + json.dumps(transaction, indent=4)
+            f.write(chunk)
+            written += len(chunk)
+            i += 1
+        f.write('], "limit": %d}' % i)
+    return i
+
+
+PEAK_RSS_SCRIPT = """
+import resource, sys, ingest
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+ingest.STREAM_THRESHOLD_BYTES = {threshold}
+partial = ingest.parse_customer_file(sys.argv[1])
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(baseline, peak, len(partial['timestamp']))
+"""
+
+
+def peak_rss(path, threshold):
+    """Parse path in a fresh interpreter; returns (baseline KB, peak KB, rows)."""
+    output = subprocess.run(
+        [sys.executable, '-c', PEAK_RSS_SCRIPT.format(threshold=threshold), path],
+        capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    ).stdout.split()
+    return tuple(int(value) for value in output)
+
+
+def bench_stream_memory(args):
+    """Peak RSS of parsing one oversized customer file, streamed vs. json.load."""
+    template = legacy_load(args.data_dir)[0]['transactions'][0]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'synthetic.txt')
+        rows = write_synthetic_customer_file(path, args.size_mb, template)
+        print(f"synthetic file: {os.path.getsize(path) / 2**20:.0f} MB, {rows} transactions")
+        modes = [('streaming reader', 0)]
+        if args.compare_json_load:
+            modes.append(('json.load', 2**62))
+        for label, threshold in modes:
+            start = time.perf_counter()
+            baseline, peak, _ = peak_rss(path, threshold)
+            print(f"{label:<28} peak RSS {peak / 1024:8.1f} MB "
+                  f"(+{(peak - baseline) / 1024:.1f} MB over startup) in {time.perf_counter() - start:.1f}s")
+
+
+STORAGE_FORMATS = ('.txt', '.json.gz', '.json.zst', '.ndjson', '.ndjson.gz', '.ndjson.zst')
+
+
+def bench_storage(args):
+    """Disk footprint and load time of the data directory in each customer file format."""
+    paths = list_customer_files(args.data_dir)
+    formats = [f for f in STORAGE_FORMATS if not f.endswith('.zst') or customer_files.zstandard is not None]
+    if len(formats) < len(STORAGE_FORMATS):
+        print("zstandard is not installed; skipping .zst formats")
+    with tempfile.TemporaryDirectory() as tmp:
+        directories = {}
+        for suffix in formats:
+            directories[suffix] = os.path.join(tmp, suffix.strip('.').replace('.', '_'))
+            os.makedirs(directories[suffix])
+            customer_files.convert_customer_files(paths, directories[suffix], suffix)
+        # Rounds interleave the formats so caches and allocator state favour none of them
+        seconds = {suffix: [] for suffix in formats}
+        transactions = {}
+        for _ in range(args.repeat):
+            for suffix in formats:
+                start = time.perf_counter()
+                store, _ = ingest.load_customer_files(directories[suffix], workers=args.workers)
+                seconds[suffix].append(time.perf_counter() - start)
+                transactions[suffix] = store.num_transactions
+        disk_bytes = {
+            suffix: sum(os.path.getsize(path) for path in list_customer_files(directory))
+            for suffix, directory in directories.items()
+        }
+
+    base_bytes, base_seconds = disk_bytes[formats[0]], min(seconds[formats[0]])
+    for suffix in formats:
+        print(f"{suffix:<12} {disk_bytes[suffix] / 2**20:8.2f} MB ({disk_bytes[suffix] / base_bytes:6.1%})  "
+              f"load {min(seconds[suffix]) * 1000:7.1f} ms ({min(seconds[suffix]) / base_seconds:.2f}x)  "
+              f"{transactions[suffix]} transactions")
+
+
+def synthetic_store(num_customers, num_merchants, transactions_per_customer, days=730, seed=0):
+    """A TransactionStore of random transactions; low merchant codes get most of the traffic."""
+    rng = np.random.default_rng(seed)
+    store = TransactionStore()
+    store.customers = StringTable(f"Customer {i}" for i in range(num_customers))
+    store.merchants = StringTable(f"merchant-{i}" for i in range(num_merchants))
+    counts = rng.poisson(transactions_per_customer - 1, num_customers) + 1
+    store.customer = np.repeat(np.arange(num_customers, dtype=np.int32), counts)
+    num_rows = len(store.customer)
+    store.merchant = (num_merchants * rng.random(num_rows) ** 2).astype(np.int32)
+    store.timestamp = 1_700_000_000 + rng.integers(0, days * SECONDS_PER_DAY, num_rows)
+    store.total_cents = rng.integers(100, 50_000, num_rows)
+    store.status = np.zeros(num_rows, dtype=np.int16)
+    store.brand = np.zeros(num_rows, dtype=np.int16)
+    store.key = np.zeros(num_rows, dtype=np.int64)
+    return store
+
+
+def bench_cohorts(args):
+    """Cohort retention matrices for every merchant of a synthetic store."""
+    store = synthetic_store(args.customers, args.merchants, args.transactions_per_customer)
+    print(f"{args.customers} customers, {args.merchants} merchants, {store.num_transactions} transactions")
+    start = time.perf_counter()
+    store.build_index()
+    print(f"merchant index     {time.perf_counter() - start:7.2f} s")
+    start = time.perf_counter()
+    cohorts = CohortMatrices(store)
+    print(f"cohort matrices    {time.perf_counter() - start:7.2f} s  "
+          f"({cohorts.num_months} months, {(cohorts.customers.nbytes + cohorts.revenue_cents.nbytes) / 2**20:.1f} MB)")
+    latencies = time_calls(cohorts.merchant, [(code,) for code in range(args.merchants)])
+    report('one merchant\'s cohorts', latencies)
+
+
+def bench_lookalikes(args):
+    """Lookalike nearest-neighbour queries against every customer of a synthetic store."""
+    store = synthetic_store(args.customers, args.merchants, args.transactions_per_customer)
+    # Refunds: some customers end up with a net negative spend, which must not poison the standardization
+    refunds = np.flatnonzero(np.random.default_rng(1).random(store.num_transactions) < 0.01)
+    store.total_cents[refunds] *= -10
+    print(f"{args.customers} customers, {args.merchants} merchants, {store.num_transactions} transactions")
+    table = MerchantCustomerTable.from_store(store)
+    start = time.perf_counter()
+    index = LookalikeIndex(store, table)
+    print(f"lookalike index    {time.perf_counter() - start:7.2f} s  ({index.features.nbytes / 2**20:.1f} MB)")
+    negative = int(np.count_nonzero(index.total_spend < 0))
+    if not np.isfinite(index.features).all():
+        raise ValueError(f"non-finite lookalike features ({negative} customers with negative net spend)")
+    print(f"{negative} customers with negative net spend, all features finite")
+    exclude = np.zeros(len(index), dtype=bool)
+    rng = np.random.default_rng(0)
+    for num_queries in (1, args.seeds):
+        queries = [(index.features[rng.integers(0, len(index), num_queries)], args.top_n, exclude) for _ in range(20)]
+        report(f"{num_queries} queries, top {args.top_n}", time_calls(index.nearest, queries))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the CLV analytics engine')
+    parser.add_argument('--data-dir', type=str, default='data', help='Customer data directory')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    subparsers.add_parser('insights', help=bench_insights.__doc__).set_defaults(run=bench_insights)
+    normalize = subparsers.add_parser('normalize', help=bench_normalize.__doc__)
+    normalize.add_argument('--repeat', type=int, default=5, help='Runs per variant (best is reported)')
+    normalize.set_defaults(run=bench_normalize)
+    stream = subparsers.add_parser('stream-memory', help=bench_stream_memory.__doc__)
+    stream.add_argument('--size-mb', type=int, default=2048, help='Size of the synthetic customer file')
+    stream.add_argument('--compare-json-load', action='store_true',
+                        help='Also measure json.load (needs several times the file size in RAM)')
+    stream.set_defaults(run=bench_stream_memory)
+    storage = subparsers.add_parser('storage', help=bench_storage.__doc__)
+    storage.add_argument('--repeat', type=int, default=3, help='Loads per format (best is reported)')
+    storage.add_argument('--workers', type=int, default=1, help='Parse worker processes')
+    storage.set_defaults(run=bench_storage)
+    cohorts = subparsers.add_parser('cohorts', help=bench_cohorts.__doc__)
+    cohorts.add_argument('--customers', type=int, default=1_000_000, help='Synthetic customers')
+    cohorts.add_argument('--merchants', type=int, default=200, help='Synthetic merchants')
+    cohorts.add_argument('--transactions-per-customer', type=int, default=10, help='Mean transactions per customer')
+    cohorts.set_defaults(run=bench_cohorts)
+    lookalikes = subparsers.add_parser('lookalikes', help=bench_lookalikes.__doc__)
+    lookalikes.add_argument('--customers', type=int, default=1_000_000, help='Synthetic customers')
+    lookalikes.add_argument('--merchants', type=int, default=200, help='Synthetic merchants')
+    lookalikes.add_argument('--transactions-per-customer', type=int, default=10, help='Mean transactions per customer')
+    lookalikes.add_argument('--top-n', type=int, default=20, help='Neighbours per query')
+    lookalikes.add_argument('--seeds', type=int, default=10, help='Queries per batch (one per seed customer)')
+    lookalikes.set_defaults(run=bench_lookalikes)
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
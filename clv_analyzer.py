@@ -1,163 +1,680 @@
 import pandas as pd
 import numpy as np
-from datetime import datetime
 import json
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 import os
+import time
+from transaction_store import SECONDS_PER_DAY, TransactionStore, TransactionStoreBuilder
+from merchant_table import CLV_SCALE, TICKET_SCALE, MerchantCustomerTable, clv_metrics, ticket_units
+from metrics_cache import MetricsCache
+import ingest
+from txlog import TransactionLog
+from sqlite_store import SQLiteStore
+from partitions import MonthlyPartitions
+from windows import WindowIndex
+from cohorts import CohortMatrices
+from clv_model import CLVModel
+from lookalikes import LookalikeIndex
+from sketches import TDigest
+
+
+def format_timestamps(timestamps: np.ndarray) -> List[str]:
+    """Format epoch seconds the same way datetime.isoformat() does."""
+    return np.datetime_as_string(timestamps.view('datetime64[s]')).tolist()
+
 
 class CLVAnalyzer:
-    def __init__(self):
-        self.data = []
+    # Insights depend on the clock (churn), so cached copies also expire
+    INSIGHTS_TTL_SECONDS = 300
+    # Appended rows are scanned until there are this many, then folded into their month partitions
+    PARTITION_TAIL_ROWS = 4096
+    RECENT_ACTIVITY_DAYS = 30
+    # Spend and CLV percentiles reported by get_merchant_insights
+    PERCENTILES = (50, 90, 99)
+    # Columns get_merchant_customer_rankings can order by
+    RANKING_KEYS = ('clv_score', 'predicted_value')
+
+    def __init__(self, cache_bytes: int = 64 * 1024 * 1024, approximate: bool = False):
+        # Window distinct counts from HyperLogLogs merged across months, and
+        # percentiles from t-digests, instead of gathering every row or customer
+        self.approximate = approximate
+        self.store = TransactionStore()
+        self.table = MerchantCustomerTable()
         self.customer_metrics = {}
-        self.merchant_metrics = {}
+        self.merchant_metrics = MetricsCache(cache_bytes)  # keyed by merchant code
+        self.data_version = 0  # bumped on every load
+        self.table_generation = 0  # bumped whenever self.table is replaced, which renumbers its pair ids
+        self.load_stats = {}
+        self.data_dir: Optional[str] = None
+        self.sqlite_path: Optional[str] = None
+        self.log_dir: Optional[str] = None  # set while serving a transaction log (load_log)
+        self.partitions: Optional[MonthlyPartitions] = None  # built on first time-bounded query
+        self.windows: Optional[WindowIndex] = None  # built on first windowed metrics query
+        self.cohorts: Optional[CohortMatrices] = None  # every merchant's, built on first cohort query
+        self.clv_model: Optional[CLVModel] = None  # fitted by fit_clv_model() or the first predicted_value ranking
+        self.lookalikes: Optional[LookalikeIndex] = None  # built on first lookalike query
+        self.file_manifest: Optional[Dict[str, Dict]] = None  # filename -> size, mtime_ns, sha256, customer_id
         
-    def load_data(self, data_dir: str = 'data'):
-        """Load transaction data from the specified directory."""
-        self.data = []
-        for filename in os.listdir(data_dir):
-            if filename.endswith('.txt'):
-                with open(os.path.join(data_dir, filename), 'r') as f:
-                    try:
-                        customer_data = json.load(f)
-                        self.data.append(customer_data)
-                    except json.JSONDecodeError:
-                        print(f"Error reading {filename}")
-                        continue
+    def load_data(self, data_dir: str = 'data', workers: Optional[int] = None,
+                  snapshot_dir: Optional[str] = None):
+        """Load transaction data from the specified directory.
+
+        Files are parsed in a process pool of `workers` processes (one per
+        CPU by default, 1 to parse in-process). Timings are kept in
+        self.load_stats. CLV metrics for every merchant are materialized
+        into self.table in the same call.
+
+        With a snapshot_dir, the parsed store is saved there keyed by a
+        hash of the data files' names, sizes and mtimes, and later loads
+        memory-map that snapshot instead of parsing while the hash matches.
+        """
+        start = time.perf_counter()
+        key = ingest.data_fingerprint(data_dir) if snapshot_dir else None
+        store = TransactionStore.load_snapshot(snapshot_dir, key) if snapshot_dir else None
+        self.data_dir = data_dir
+        self.sqlite_path = None
+        self.log_dir = None
+        if store is not None:
+            self.store = store
+            self.file_manifest = self._load_file_manifest(snapshot_dir, key)
+            self.load_stats = {'snapshot': snapshot_dir, 'wall_seconds': time.perf_counter() - start}
+            print(f"Loaded snapshot from {snapshot_dir} in {self.load_stats['wall_seconds'] * 1000:.1f}ms")
+        else:
+            self.store, self.load_stats = ingest.load_customer_files(data_dir, workers)
+            print(f"Parsed {self.load_stats['files']} files with {self.load_stats['workers']} workers "
+                  f"in {self.load_stats['wall_seconds']:.2f}s "
+                  f"(per-file parse total {self.load_stats['parse_seconds']:.2f}s, "
+                  f"speedup {self.load_stats['speedup']:.1f}x, {self.load_stats['duplicates']} duplicates dropped)")
+            self.file_manifest = self.load_stats['manifest']
+            if snapshot_dir:
+                self.store.save_snapshot(snapshot_dir, key)
+                with open(os.path.join(snapshot_dir, 'files.json'), 'w') as f:
+                    json.dump({'key': key, 'files': self.file_manifest}, f)
+        self.table = MerchantCustomerTable.from_store(self.store)
+        self.table_generation += 1
+        self.partitions = None
+        self.windows = None
+        self.cohorts = None
+        self.lookalikes = None
+        self.clv_model = None
+        self.data_version += 1
+    
+    def load_sqlite(self, db_path: str = 'transactions.db', data_dir: Optional[str] = 'data',
+                    workers: Optional[int] = None):
+        """Load through the SQLite backend shared with the Knot sync server.
+
+        New Knot rows and new or changed files in data_dir (None to skip
+        files) are ingested into db_path first; the per-customer
+        aggregation is then pushed down to SQL and only its result is
+        materialized into self.table.
+        """
+        start = time.perf_counter()
+        backend = SQLiteStore(db_path)
+        try:
+            stats = backend.ingest(data_dir, workers)
+            self.store = backend.to_store()
+            aggregates = backend.pair_aggregates()
+        finally:
+            backend.close()
+        self.table = MerchantCustomerTable.from_aggregates(len(self.store.merchants), aggregates)
+        self.table_generation += 1
+        self.partitions = None
+        self.windows = None
+        self.cohorts = None
+        self.lookalikes = None
+        self.clv_model = None
+        self.data_dir = data_dir
+        self.sqlite_path = db_path
+        self.log_dir = None
+        self.file_manifest = None
+        self.data_version += 1
+        self.load_stats = {'sqlite': db_path, **stats, 'wall_seconds': time.perf_counter() - start}
+        print(f"Loaded {self.store.num_transactions} transactions from {db_path} "
+              f"({stats['knot']['rows']} new Knot rows) in {self.load_stats['wall_seconds']:.2f}s")
+    
+    def load_partials(self, partials: List[Dict]):
+        """Serve exactly the given customer partials (see ingest.parse_customer_file).
+
+        Used by shards, which are handed their customers' already-parsed
+        files instead of reading a data directory.
+        """
+        builder = TransactionStoreBuilder()
+        for partial in partials:
+            builder.add_partial(partial)
+        self.store = builder.build()
+        self.table = MerchantCustomerTable.from_store(self.store)
+        self.table_generation += 1
+        self.partitions = None
+        self.windows = None
+        self.cohorts = None
+        self.lookalikes = None
+        self.clv_model = None
+        self.file_manifest = None
+        self.sqlite_path = None
+        self.log_dir = None
+        self.data_version += 1
+    
+    @staticmethod
+    def _load_file_manifest(snapshot_dir: str, key: str) -> Optional[Dict[str, Dict]]:
+        try:
+            with open(os.path.join(snapshot_dir, 'files.json'), 'r') as f:
+                saved = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        return saved['files'] if saved.get('key') == key else None
+    
+    def reload_data(self, workers: Optional[int] = None) -> Dict:
+        """Bring the loaded data up to date with the data directory.
+
+        Only new or changed customer files are parsed (a file counts as
+        changed when its size or mtime moved and its sha256 differs).
+        Rows of customers whose files changed or were deleted are dropped
+        first, and only the merchants those customers bought from (before
+        or after) get their version bumped, so every other merchant's
+        cached metrics stay valid. With the SQLite backend, the database
+        is brought up to date incrementally and then re-read whole; a
+        transaction log is mapped again, picking up what was appended to it.
+        Falls back to a full load_data when no file manifest is known.
+        Returns a summary.
+        """
+        if self.sqlite_path is not None:
+            self.load_sqlite(self.sqlite_path, self.data_dir, workers)
+            return {'full_reload': True, 'sqlite': self.load_stats}
+        if self.log_dir is not None:
+            self.load_log(self.log_dir)
+            return {'full_reload': True, 'log': self.load_stats}
+        if self.file_manifest is None:
+            self.load_data(self.data_dir or 'data', workers)
+            return {'full_reload': True, 'files': len(self.file_manifest)}
+
+        start = time.perf_counter()
+        manifest = dict(self.file_manifest)
+        changed, deleted, touched = ingest.scan_changes(self.data_dir, manifest)
+        manifest.update(touched)
+
+        # Customers whose old rows are now stale; files of theirs that did not change are re-read too
+        stale = {manifest[name]['customer_id'] for name in deleted}
+        stale.update(manifest[os.path.basename(path)]['customer_id'] for path in changed
+                     if os.path.basename(path) in manifest)
+        stale.discard(None)
+        changed_names = {os.path.basename(path) for path in changed}
+        reparse = changed + [
+            os.path.join(self.data_dir, name) for name, entry in manifest.items()
+            if entry['customer_id'] in stale and name not in changed_names and name not in deleted
+        ]
+        for name in deleted:
+            del manifest[name]
+
+        partials, _ = ingest.parse_customer_files(reparse, workers) if reparse else ([], 1)
+        store = self.store
+        touched_merchants = set()
+        stale_codes = [store.customers.lookup(customer_id) for customer_id in stale if customer_id in store.customers]
+        if stale_codes:
+            touched_merchants.update(store.drop_customers(stale_codes).tolist())
+        errors = []
+        appended = []
+        duplicates = 0
+        for partial in partials:
+            manifest[partial['filename']] = ingest.manifest_entry(partial)
+            if 'error' in partial:
+                print(f"Error reading {partial['filename']}")
+                errors.append(partial['filename'])
+                continue
+            ingest.report_invalid(partial)
+            row_start, row_end = store.append_partial(partial)
+            duplicates += len(partial['timestamp']) - (row_end - row_start)
+            appended.append((row_start, row_end))
+
+        if stale_codes:
+            # Rows were removed, so rebuild the table; versions carry over for untouched merchants
+            versions = self.table.merchant_versions
+            self.table = MerchantCustomerTable.from_store(store, self.table.top_k)
+            self.table_generation += 1
+            self.partitions = None  # row ids changed
+            self.windows = None
+            self.cohorts = None
+            self.lookalikes = None
+            self.clv_model = None
+            self.table.merchant_versions = versions
+            for row_start, row_end in appended:
+                touched_merchants.update(store.merchant[row_start:row_end].tolist())
+            for merchant_code in touched_merchants:
+                versions[merchant_code] = versions.get(merchant_code, 0) + 1
+        else:
+            for row_start, row_end in appended:
+                touched_merchants.update(self.table.add_rows(store, row_start, row_end))
+
+        self.file_manifest = manifest
+        summary = {
+            'full_reload': False,
+            'changed_files': sorted(changed_names),
+            'deleted_files': sorted(deleted),
+            'reparsed_files': len(reparse),
+            'errors': errors,
+            'customers_replaced': len(stale_codes),
+            'merchants_invalidated': len(touched_merchants),
+            'duplicates': duplicates,
+            'wall_seconds': time.perf_counter() - start,
+        }
+        print(f"Reloaded {len(reparse)} changed files ({len(deleted)} deleted) in {summary['wall_seconds']:.2f}s, "
+              f"{len(touched_merchants)} merchants invalidated")
+        return summary
+    
+    def load_log(self, log_dir: str):
+        """Serve from a memory-mapped transaction log written by txlog.py.
+
+        Nothing is parsed: the store's columns and merchant index are views
+        into the log's files, shared with any other process that opens them.
+        """
+        start = time.perf_counter()
+        self.store = TransactionLog(log_dir).to_store()
+        self.file_manifest = None
+        self.sqlite_path = None
+        self.log_dir = log_dir
+        self.load_stats = {'log': log_dir, 'wall_seconds': time.perf_counter() - start}
+        self.table = MerchantCustomerTable.from_store(self.store)
+        self.table_generation += 1
+        self.partitions = None
+        self.windows = None
+        self.cohorts = None
+        self.lookalikes = None
+        self.clv_model = None
+        self.data_version += 1
+        print(f"Mapped transaction log {log_dir} ({self.store.num_transactions} transactions) "
+              f"in {self.load_stats['wall_seconds'] * 1000:.1f}ms")
+    
+    def append_transactions(self, customer_id: str, transactions: List[Dict]) -> int:
+        """Add new transactions for a customer without reloading.
+
+        Each transaction updates its (merchant, customer) aggregates in
+        O(1), so rankings and insights reflect it immediately; the touched
+        merchants' versions change, which invalidates only their cached
+        metrics. Transactions already loaded (same Knot id, e.g. redelivered
+        by sync pagination) are skipped, as are transactions missing a
+        datetime, url or price total (see ingest.parse_transactions).
+        Returns the number of transactions added.
+        """
+        partial = ingest.parse_customer({'customer_type': customer_id, 'transactions': transactions})
+        start, end = self.store.append_partial(partial)
+        self.table.add_rows(self.store, start, end)
+        # Appended rows are scanned per query until indexed; a rebuild sorts every row, so the tail grows with the store
+        store = self.store
+        if store.num_transactions - store.indexed_rows > max(self.PARTITION_TAIL_ROWS, store.indexed_rows // 8):
+            store.build_index()
+        return end - start
     
     def normalize_merchant_name(self, url: str) -> str:
         """Extract merchant name from URL."""
-        # Remove http(s):// and www.
-        url = url.lower().replace('https://', '').replace('http://', '').replace('www.', '')
-        # Get the domain part
-        domain = url.split('/')[0]
-        # Remove .com and similar endings
-        merchant = domain.split('.')[0]
-        return merchant
+        return ingest.merchant_for_url(url)
 
-    def calculate_merchant_specific_metrics(self, merchant_name: str) -> Dict:
-        """Calculate customer metrics specific to a merchant."""
+    def has_merchant(self, merchant_name: str) -> bool:
+        """Whether any loaded transaction belongs to this merchant."""
+        return merchant_name.lower() in self.store.merchants
+
+    def _merchant_code(self, merchant_name: str) -> int:
+        return self.store.merchants.lookup(merchant_name.lower())
+
+    def _version(self, merchant_code: int) -> Tuple[int, int]:
+        """Cache stamp for a merchant: the load generation and its append count."""
+        return self.data_version, self.table.merchant_versions.get(merchant_code, 0)
+
+    def _cached_metrics(self, merchant_code: int) -> Dict:
+        """Full per-customer metrics for a merchant, through the bounded cache."""
+        key = ('metrics', merchant_code)
+        version = self._version(merchant_code)
+        merchant_customers = self.merchant_metrics.get(key, version)
+        if merchant_customers is None:
+            merchant_customers = self._pair_metrics(self.table.ranked_pairs(merchant_code))
+            self.merchant_metrics.put(key, version, merchant_customers)
+        return merchant_customers
+
+    def _pair_metrics(self, pairs) -> Dict:
+        """Per-customer metric dicts for table pairs, keyed by customer id in the given order."""
+        table = self.table
+        return self._customer_metrics(
+            table.customer[pairs], table.total_spend[pairs], table.num_transactions[pairs],
+            table.purchase_frequency[pairs], table.months_active[pairs], table.clv_score[pairs],
+            table.first_purchase[pairs], table.last_purchase[pairs]
+        )
+
+    def _customer_metrics(self, customers, total_spend, num_transactions, purchase_frequency,
+                          months_active, clv_score, first_purchase, last_purchase) -> Dict:
+        """Per-customer metric dicts from metric columns, keyed by customer id in the given order."""
         merchant_customers = {}
-        
-        # Convert merchant name to lowercase for matching
-        merchant_match = merchant_name.lower()
-        
-        for customer in self.data:
-            customer_id = customer['customer_type']
-            
-            # Filter transactions for this merchant based on URL
-            merchant_transactions = [
-                t for t in customer['transactions'] 
-                if merchant_match == self.normalize_merchant_name(t['url'])
-            ]
-            
-            if not merchant_transactions:
-                continue
-                
-            # Convert transaction dates to datetime objects (timezone-naive)
-            dates = [datetime.fromisoformat(t['datetime'].replace('Z', '+00:00')).replace(tzinfo=None) 
-                    for t in merchant_transactions]
-            
-            # Calculate merchant-specific metrics
-            total_spend = sum(float(t['price']['total']) for t in merchant_transactions)
-            num_transactions = len(merchant_transactions)
-            first_purchase = min(dates)
-            last_purchase = max(dates)
-            
-            # Calculate months between first and last purchase
-            months_active = max(1, (last_purchase - first_purchase).days / 30.0)
-            
-            # Calculate monthly purchase frequency
-            monthly_frequency = num_transactions / months_active
-            
-            # Calculate CLV score
-            clv_score = (
-                0.4 * total_spend +  # 40% weight on total spend
-                0.3 * (num_transactions * 100) +  # 30% weight on frequency
-                0.3 * (months_active * 1000)  # 30% weight on longevity
-            )
-            
-            merchant_customers[customer_id] = {
-                'total_spend': total_spend,
-                'num_transactions': num_transactions,
-                'avg_transaction_value': total_spend / num_transactions if num_transactions > 0 else 0,
-                'purchase_frequency': monthly_frequency,  # transactions per month
-                'months_active': months_active,
-                'clv_score': clv_score,
-                'first_purchase': first_purchase.isoformat(),
-                'last_purchase': last_purchase.isoformat()
+        columns = zip(
+            customers.tolist(), total_spend.tolist(), num_transactions.tolist(),
+            (total_spend / num_transactions).tolist(), purchase_frequency.tolist(),
+            months_active.tolist(), clv_score.tolist(),
+            format_timestamps(first_purchase), format_timestamps(last_purchase),
+            first_purchase.tolist(), last_purchase.tolist()
+        )
+        for code, spend, count, avg_value, frequency, months, clv, first, last, first_ts, last_ts in columns:
+            merchant_customers[self.store.customers.decode(code)] = {
+                'total_spend': spend,
+                'num_transactions': count,
+                'avg_transaction_value': avg_value,
+                'purchase_frequency': frequency,  # transactions per month
+                'months_active': months,
+                'clv_score': clv,
+                'first_purchase': first,
+                'last_purchase': last,
+                'first_purchase_ts': first_ts,  # epoch seconds
+                'last_purchase_ts': last_ts
             }
-            
         return merchant_customers
+
+    def calculate_merchant_specific_metrics(self, merchant_name: str) -> Dict:
+        """Calculate customer metrics specific to a merchant, best CLV first."""
+        merchant_code = self._merchant_code(merchant_name)
+        if merchant_code < 0:
+            return {}
+        return self._pair_metrics(self.table.ranked_pairs(merchant_code))
     
-    def get_merchant_customer_rankings(self, merchant_id: str) -> List[Dict]:
-        """Get ranked list of customers for a specific merchant based on their CLV."""
-        if merchant_id not in self.merchant_metrics:
-            self.merchant_metrics[merchant_id] = self.calculate_merchant_specific_metrics(merchant_id)
+    def get_merchant_customer_rankings(self, merchant_id: str, limit: Optional[int] = None,
+                                       since: Optional[int] = None, until: Optional[int] = None,
+                                       rank_by: str = 'clv_score') -> List[Dict]:
+        """Get ranked list of customers for a specific merchant based on their CLV.
+
+        With a limit up to the table's top_k, the answer comes from the
+        merchant's maintained top-K list in O(limit). Without a limit the
+        full ranking is built (and cached in merchant_metrics). With since
+        and/or until (epoch seconds), customers are ranked by the CLV of
+        their transactions with since <= time < until only.
+
+        rank_by='predicted_value' ranks by the fitted BG/NBD + Gamma-Gamma
+        model's expected spend over the next 12 months instead, and adds
+        the model's predictions to every customer; it covers whole
+        histories, so it can't be combined with since/until.
+        """
+        if rank_by not in self.RANKING_KEYS:
+            raise ValueError(f"rank_by must be one of {', '.join(self.RANKING_KEYS)}")
+        if rank_by == 'predicted_value' and (since is not None or until is not None):
+            raise ValueError("predicted_value rankings cover whole histories and take no since/until")
+        merchant_code = self._merchant_code(merchant_id)
+        if merchant_code < 0:
+            return []
+        if rank_by == 'predicted_value':
+            return self._predicted_rankings(merchant_code, limit)
+        if since is not None or until is not None:
+            merchant_customers = self._window_customer_metrics(merchant_code, since, until)
+        elif limit is not None and limit <= self.table.top_k:
+            merchant_customers = self._pair_metrics(self.table.top_ranked_pairs(merchant_code, limit))
+        else:
+            merchant_customers = self._cached_metrics(merchant_code)
         
-        # Convert to list and sort by CLV score
+        # Metrics are already ordered by CLV score, descending
         customer_rankings = [
             {
                 'customer_id': customer_id,
                 **metrics
             }
-            for customer_id, metrics in self.merchant_metrics[merchant_id].items()
+            for customer_id, metrics in merchant_customers.items()
         ]
-        
-        # Sort by CLV score in descending order
-        customer_rankings.sort(key=lambda x: x['clv_score'], reverse=True)
-        
-        return customer_rankings
+        return customer_rankings if limit is None else customer_rankings[:limit]
+
+    def fit_clv_model(self, now: Optional[int] = None) -> Optional[CLVModel]:
+        """Fit the BG/NBD + Gamma-Gamma model for every merchant at once (see clv_model.CLVModel).
+
+        now (epoch seconds) ends the observation period; it defaults to the
+        newest loaded transaction, so a corpus that stopped syncing a while
+        ago isn't read as every customer having churned since. Predictions
+        are made as of the same moment until the next fit. With no data
+        loaded there is nothing to fit and the model stays None.
+        """
+        if not self.table.num_pairs:
+            self.clv_model = None
+            return None
+        if now is None:
+            now = int(self.store.timestamp.max()) if self.store.num_transactions else int(time.time())
+        start = time.perf_counter()
+        self.clv_model = CLVModel.fit(self.table, now)
+        self.load_stats['clv_model_seconds'] = time.perf_counter() - start
+        print(f"Fitted CLV model for {len(self.clv_model.bgnbd)} merchants "
+              f"in {self.load_stats['clv_model_seconds'] * 1000:.1f}ms")
+        return self.clv_model
+
+    def _clv_predictions(self, merchant_code: int) -> Optional[Dict[str, np.ndarray]]:
+        """Model predictions for all of a merchant's pairs, best predicted_value first; None without data."""
+        if self.clv_model is None and self.fit_clv_model() is None:
+            return None
+        key = ('predictions', merchant_code)
+        # Predictions hold pair ids; a reload that drops customers rebuilds the table and renumbers them
+        version = self._version(merchant_code) + (self.table_generation, self.clv_model.fitted_at)
+        predictions = self.merchant_metrics.get(key, version)
+        if predictions is None:
+            pairs = self.table.pairs_for_merchant(merchant_code)
+            if isinstance(pairs, slice):
+                pairs = np.arange(pairs.start, pairs.stop)
+            predictions = self.clv_model.predict(self.table, merchant_code, pairs, self.clv_model.fitted_at)
+            order = np.lexsort((self.table.customer[pairs], -predictions['predicted_value']))
+            predictions = {'pairs': pairs[order], **{name: column[order] for name, column in predictions.items()}}
+            self.merchant_metrics.put(key, version, predictions)
+        return predictions
+
+    def _predicted_rankings(self, merchant_code: int, limit: Optional[int]) -> List[Dict]:
+        predictions = self._clv_predictions(merchant_code)
+        if predictions is None:
+            return []
+        top = slice(None, limit)
+        merchant_customers = self._pair_metrics(predictions['pairs'][top])
+        columns = zip(*(predictions[name][top].tolist() for name in CLVModel.PREDICTIONS))
+        return [
+            {'customer_id': customer_id, **metrics, **dict(zip(CLVModel.PREDICTIONS, values))}
+            for (customer_id, metrics), values in zip(merchant_customers.items(), columns)
+        ]
+    
+    def _monthly_partitions(self) -> MonthlyPartitions:
+        if self.partitions is None:
+            self.partitions = MonthlyPartitions(self.store)
+        elif self.store.num_transactions - self.partitions.num_rows > self.PARTITION_TAIL_ROWS:
+            self.partitions.extend()
+        return self.partitions
+    
+    def _window_index(self) -> WindowIndex:
+        # A rebuild sorts every row, so the tail allowed to build up grows with the store
+        if self.windows is None or \
+                self.store.num_transactions - self.windows.num_rows > max(self.PARTITION_TAIL_ROWS, self.windows.num_rows // 8):
+            self.windows = WindowIndex(self.store)
+        return self.windows
+
+    def _window_aggregates(self, merchant_code: int, since: Optional[int], until: Optional[int]) -> Dict:
+        """Per-customer aggregates inside a window plus their derived CLV metrics, best CLV first."""
+        aggregates = self._window_index().customer_aggregates(merchant_code, since, until)
+        total_spend, months_active, purchase_frequency, clv_units, clv_score = clv_metrics(
+            aggregates['total_cents'], aggregates['num_transactions'],
+            aggregates['first_purchase'], aggregates['last_purchase']
+        )
+        aggregates.update(total_spend=total_spend, months_active=months_active, purchase_frequency=purchase_frequency,
+                          clv_units=clv_units, clv_score=clv_score)
+        order = np.lexsort((aggregates['customer'], -clv_units))
+        return {name: column[order] for name, column in aggregates.items()}
+
+    def _window_customer_metrics(self, merchant_code: int, since: Optional[int], until: Optional[int]) -> Dict:
+        window = self._window_aggregates(merchant_code, since, until)
+        return self._customer_metrics(
+            window['customer'], window['total_spend'], window['num_transactions'], window['purchase_frequency'],
+            window['months_active'], window['clv_score'], window['first_purchase'], window['last_purchase']
+        )
+
+    def get_merchant_window_metrics(self, merchant_id: str, since: Optional[int] = None,
+                                    until: Optional[int] = None) -> Dict:
+        """Revenue, customers, average ticket, frequency and CLV of a merchant with since <= time < until.
+
+        Bounds are epoch seconds; either may be None. Totals come from
+        running sums over the merchant's time-sorted transactions and each
+        customer's figures from running sums over their own, so the cost is
+        binary searches, not a scan of the transactions in the window.
+        Averages are per customer active in the window, as in
+        get_merchant_insights.
+        """
+        merchant_code = self._merchant_code(merchant_id)
+        if merchant_code < 0:
+            return {}
+        transactions, revenue_cents = self._window_index().totals(merchant_code, since, until)
+        window = self._window_aggregates(merchant_code, since, until)
+        total_customers = len(window['customer'])
+        metrics = {
+            'merchant_id': merchant_id,
+            'since': since,
+            'until': until,
+            'transactions': transactions,
+            'total_revenue': revenue_cents / 100.0,
+            'total_customers': total_customers,
+            'average_transaction_value': 0,
+            'average_purchase_frequency': 0,
+            'average_clv_score': 0,
+        }
+        if total_customers:
+            ticket_units_sum = int(ticket_units(window['total_cents'], window['num_transactions']).sum())
+            metrics['average_transaction_value'] = ticket_units_sum / total_customers / (100 * TICKET_SCALE)
+            metrics['average_purchase_frequency'] = float(window['purchase_frequency'].mean())
+            metrics['average_clv_score'] = int(window['clv_units'].sum()) / total_customers / CLV_SCALE
+        return metrics
+
+    def get_merchant_cohorts(self, merchant_id: str) -> Dict:
+        """Acquisition-month cohorts of a merchant with monthly retention and revenue.
+
+        The matrices cover every merchant and are rebuilt in one pass on
+        the first query after the store changes.
+        """
+        merchant_code = self._merchant_code(merchant_id)
+        if merchant_code < 0:
+            return {}
+        if self.cohorts is None or self.cohorts.num_rows != self.store.num_transactions:
+            self.cohorts = CohortMatrices(self.store)
+        return {'merchant_id': merchant_id, 'cohorts': self.cohorts.merchant(merchant_code)}
+
+    def get_merchant_activity(self, merchant_id: str, since: Optional[int] = None,
+                              until: Optional[int] = None) -> Dict:
+        """Transactions, revenue and active customers of a merchant with since <= time < until.
+
+        Bounds are epoch seconds; either may be None. Month partitions
+        outside the window are skipped without reading their rows.
+        """
+        merchant_code = self._merchant_code(merchant_id)
+        if merchant_code < 0:
+            return {}
+        activity = self._window_activity(merchant_code, since, until)
+        return {
+            'transactions': activity['transactions'],
+            'revenue': activity['revenue_cents'] / 100.0,
+            'active_customers': activity['active_customers']
+        }
+
+    def _window_activity(self, merchant_code: int, since: Optional[int], until: Optional[int]) -> Dict:
+        """MonthlyPartitions.window, with active customers estimated by HyperLogLog in approximate mode."""
+        partitions = self._monthly_partitions()
+        if not self.approximate:
+            return partitions.window(merchant_code, since, until)
+        activity = partitions.window(merchant_code, since, until, distinct=False)
+        activity['active_customers'] = len(partitions.window_sketches(merchant_code, since, until)['customers'])
+        return activity
+
+    def _merchant_rows(self, merchant_code: int) -> np.ndarray:
+        """Every row id of one merchant: its indexed rows, then matching rows appended since."""
+        store = self.store
+        tail = store.indexed_rows + np.flatnonzero(store.merchant[store.indexed_rows:] == merchant_code)
+        return np.concatenate((store.rows_for_merchant(merchant_code), tail))
+
+    def merchant_sketches(self, merchant_id: str) -> Dict:
+        """Mergeable sketches of one merchant, cached until its data changes.
+
+        customers is a HyperLogLog of its distinct customers, spend a
+        t-digest of its transaction values (dollars) and clv a t-digest of
+        its customers' clv_score. Sketches from shards holding other
+        customers merge into these with merge().
+        """
+        merchant_code = self._merchant_code(merchant_id)
+        if merchant_code < 0:
+            return {}
+        return self._merchant_sketches(merchant_code)
+
+    def _merchant_sketches(self, merchant_code: int) -> Dict:
+        key = ('sketches', merchant_code)
+        version = self._version(merchant_code)
+        sketches = self.merchant_metrics.get(key, version)
+        if sketches is None:
+            # Customers and spend merge the month partitions' cell sketches; only appended rows are read.
+            # CLV scores change in place on appends, so they are digested from the pair table (one per customer).
+            sketches = self._monthly_partitions().window_sketches(merchant_code)
+            sketches['clv'] = TDigest()
+            sketches['clv'].add(self.table.clv_score[self.table.pairs_for_merchant(merchant_code)])
+            self.merchant_metrics.put(key, version, sketches)
+        return sketches
+
+    def _percentiles(self, merchant_code: int) -> Dict[str, Dict[str, float]]:
+        """p50/p90/p99 of a merchant's transaction values and customer CLV scores."""
+        labels = [f'p{p}' for p in self.PERCENTILES]
+        if self.approximate:
+            sketches = self._merchant_sketches(merchant_code)
+            spend = sketches['spend'].quantiles([p / 100 for p in self.PERCENTILES])
+            clv = sketches['clv'].quantiles([p / 100 for p in self.PERCENTILES])
+        else:
+            spend = np.percentile(self.store.total_cents[self._merchant_rows(merchant_code)] / 100.0, self.PERCENTILES)
+            clv = np.percentile(self.table.clv_score[self.table.pairs_for_merchant(merchant_code)], self.PERCENTILES)
+        return {
+            'spend': dict(zip(labels, np.round(spend, 2).tolist())),
+            'clv': dict(zip(labels, np.round(clv, 2).tolist())),
+        }
     
     def get_merchant_insights(self, merchant_id: str) -> Dict:
         """Get detailed insights about customers for a specific merchant."""
-        if merchant_id not in self.merchant_metrics:
-            self.merchant_metrics[merchant_id] = self.calculate_merchant_specific_metrics(merchant_id)
-        
-        merchant_customers = self.merchant_metrics[merchant_id]
+        merchant_code = self._merchant_code(merchant_id)
+        if merchant_code < 0:
+            return {}
         
-        if not merchant_customers:
+        current_time = int(time.time())
+        key = ('insights', merchant_code)
+        version = self._version(merchant_code) + (current_time // self.INSIGHTS_TTL_SECONDS,)
+        insights = self.merchant_metrics.get(key, version)
+        if insights is None:
+            insights = self._compute_merchant_insights(merchant_code, current_time)
+            self.merchant_metrics.put(key, version, insights)
+        return {**insights, 'merchant_id': merchant_id} if insights else insights
+    
+    def _compute_merchant_insights(self, merchant_code: int, current_time: int) -> Dict:
+        summary = self.table.summarize(merchant_code, current_time)
+        if not summary['total_customers']:
             return {}
         
         # Calculate merchant-level metrics
-        total_customers = len(merchant_customers)
-        total_spend = sum(c['total_spend'] for c in merchant_customers.values())
-        avg_transaction_value = np.mean([c['avg_transaction_value'] for c in merchant_customers.values()])
-        avg_purchase_frequency = np.mean([c['purchase_frequency'] for c in merchant_customers.values()])
+        total_customers = summary['total_customers']
+        total_spend = summary['revenue_cents'] / 100.0
+        avg_transaction_value = summary['ticket_units_sum'] / total_customers / (100 * TICKET_SCALE)
+        avg_purchase_frequency = summary['avg_purchase_frequency']
         
         # Calculate retention metrics
-        repeat_customers = sum(1 for c in merchant_customers.values() if c['num_transactions'] > 1)
+        repeat_customers = summary['repeat_customers']
         retention_rate = (repeat_customers / total_customers) * 100 if total_customers > 0 else 0
         
         # Calculate average time between purchases
-        time_between_purchases = []
-        for customer in self.data:
-            merchant_transactions = [
-                t for t in customer['transactions'] 
-                if self.normalize_merchant_name(t['url']) == merchant_id.lower()
-            ]
-            if len(merchant_transactions) > 1:
-                dates = sorted([datetime.fromisoformat(t['datetime'].replace('Z', '+00:00')).replace(tzinfo=None) 
-                              for t in merchant_transactions])
-                for i in range(1, len(dates)):
-                    time_between_purchases.append((dates[i] - dates[i-1]).days)
-        
-        avg_time_between_purchases = np.mean(time_between_purchases) if time_between_purchases else 0
+        num_gaps = summary['num_gaps']
+        avg_time_between_purchases = summary['gap_days_sum'] / num_gaps if num_gaps else 0
         
         # Calculate churn rate (customers who haven't purchased in last 30 days)
-        current_date = datetime.now().replace(tzinfo=None)  # Make current date timezone-naive
-        churned_customers = sum(1 for c in merchant_customers.values() 
-                              if (current_date - datetime.fromisoformat(c['last_purchase'].replace('Z', '+00:00')).replace(tzinfo=None)).days > 30)
+        churned_customers = summary['churned_customers']
         churn_rate = (churned_customers / total_customers) * 100 if total_customers > 0 else 0
         
+        # Activity over the recent window, from the month partitions it overlaps
+        recent = self._window_activity(
+            merchant_code, since=current_time - self.RECENT_ACTIVITY_DAYS * SECONDS_PER_DAY, until=None
+        )
+        percentiles = self._percentiles(merchant_code)
+        
         # Get top customers
-        top_customers = self.get_merchant_customer_rankings(merchant_id)[:5]
+        top_customers = self.get_merchant_customer_rankings(self.store.merchants.decode(merchant_code), limit=5)
         
         return {
-            'merchant_id': merchant_id,
-            'total_customers': total_customers,
+            'merchant_id': self.store.merchants.decode(merchant_code),
+            # Averages below divide by the exact count the summary pass already has
+            'total_customers': len(self._merchant_sketches(merchant_code)['customers']) if self.approximate
+            else total_customers,
             'total_revenue': total_spend,
             'average_transaction_value': avg_transaction_value,
             'average_purchase_frequency': avg_purchase_frequency,
+            'spend_percentiles': percentiles['spend'],  # per transaction
+            'clv_percentiles': percentiles['clv'],  # per customer
+            'approximate': self.approximate,
             'retention_metrics': {
                 'retention_rate': round(retention_rate, 2),
                 'repeat_customers': repeat_customers,
@@ -165,59 +682,67 @@ class CLVAnalyzer:
                 'churn_rate': round(churn_rate, 2),
                 'churned_customers': churned_customers
             },
+            'recent_activity': {
+                'window_days': self.RECENT_ACTIVITY_DAYS,
+                'transactions': recent['transactions'],
+                'revenue': recent['revenue_cents'] / 100.0,
+                'active_customers': recent['active_customers']
+            },
             'top_customers': top_customers
         }
     
-    def get_similar_merchant_customers(self, merchant_id: str, top_n: int = 5) -> List[Dict]:
-        """Find customers who haven't purchased from this merchant but are similar to existing customers."""
-        if merchant_id not in self.merchant_metrics:
-            self.merchant_metrics[merchant_id] = self.calculate_merchant_specific_metrics(merchant_id)
-        
-        merchant_customers = self.merchant_metrics[merchant_id]
-        
-        if not merchant_customers:
+    def get_similar_merchant_customers(self, merchant_id: str, top_n: int = 5,
+                                       seeds: Optional[int] = None) -> List[Dict]:
+        """Customers who haven't purchased from this merchant, nearest to those who have.
+
+        Every customer is a standardized vector of LookalikeIndex.FEATURES.
+        By default the query is the centroid of the merchant's customers;
+        with seeds, it is each of the merchant's best `seeds` customers by
+        CLV, a candidate's distance is to the nearest of them, and
+        lookalike_of names that seed. similarity_score is
+        1 / (1 + distance), highest first.
+        """
+        merchant_code = self._merchant_code(merchant_id)
+        if merchant_code < 0 or top_n <= 0:
             return []
-        
-        # Calculate average metrics for merchant's current customers
-        avg_metrics = {
-            'total_spend': np.mean([c['total_spend'] for c in merchant_customers.values()]),
-            'monthly_frequency': np.mean([c['purchase_frequency'] for c in merchant_customers.values()]),
-            'avg_transaction': np.mean([c['avg_transaction_value'] for c in merchant_customers.values()])
-        }
-        
-        # Find similar customers who haven't purchased from this merchant
+        if self.lookalikes is None or self.lookalikes.num_rows != self.store.num_transactions:
+            self.lookalikes = LookalikeIndex(self.store, self.table)
+        index = self.lookalikes
+        own_rows = index.rows[self.table.customer[self.table.pairs_for_merchant(merchant_code)]]
+        if not len(own_rows):
+            return []
+        exclude = np.zeros(len(index), dtype=bool)
+        exclude[own_rows] = True
+
+        if seeds is None:
+            seed_rows = None
+            rows, distances = index.nearest(index.features[own_rows].mean(axis=0), top_n, exclude)
+            rows, distances = rows[0], distances[0]
+        else:
+            seed_rows = index.rows[self.table.customer[self.table.ranked_pairs(merchant_code)[:seeds]]]
+            rows, distances = index.nearest(index.features[seed_rows], top_n, exclude)
+            # A candidate near several seeds counts once, at its smallest distance
+            seed_of = np.repeat(np.arange(len(seed_rows)), top_n)
+            rows, distances = rows.ravel(), distances.ravel()
+            order = np.lexsort((distances, rows))
+            best = order[np.append(True, rows[order][1:] != rows[order][:-1])]
+            best = best[np.argsort(distances[best], kind='stable')][:top_n]
+            rows, distances, seed_of = rows[best], distances[best], seed_of[best]
+
         recommendations = []
-        for customer in self.data:
-            customer_id = customer['customer_type']
-            if customer_id not in merchant_customers:
-                # Calculate customer's overall metrics
-                transactions = customer['transactions']
-                if not transactions:
-                    continue
-                    
-                total_spend = sum(float(t['amount']) for t in transactions)
-                num_transactions = len(transactions)
-                dates = [datetime.fromisoformat(t['date'].replace('Z', '+00:00')) for t in transactions]
-                days_active = (max(dates) - min(dates)).days
-                months_active = max(1, days_active / 30)
-                monthly_frequency = num_transactions / months_active
-                avg_transaction = total_spend / num_transactions
-                
-                # Calculate similarity score
-                similarity_score = (
-                    0.4 * (total_spend / avg_metrics['total_spend']) +
-                    0.3 * (monthly_frequency / avg_metrics['monthly_frequency']) +
-                    0.3 * (avg_transaction / avg_metrics['avg_transaction'])
-                )
-                
-                recommendations.append({
-                    'customer_id': customer_id,
-                    'similarity_score': similarity_score,
-                    'total_spend': total_spend,
-                    'monthly_frequency': monthly_frequency,
-                    'avg_transaction': avg_transaction
-                })
-        
-        # Sort by similarity score and return top N
-        recommendations.sort(key=lambda x: x['similarity_score'], reverse=True)
-        return recommendations[:top_n] 
\ No newline at end of file
+        for i, (row, distance) in enumerate(zip(rows.tolist(), distances.tolist())):
+            if row < 0:
+                break  # fewer eligible customers than top_n
+            recommendation = {
+                'customer_id': self.store.customers.decode(int(index.customers[row])),
+                'similarity_score': 1 / (1 + distance),
+                'distance': distance,
+                'total_spend': float(index.total_spend[row]),
+                'monthly_frequency': float(index.monthly_frequency[row]),
+                'avg_transaction': float(index.avg_transaction[row])
+            }
+            if seed_rows is not None:
+                seed_customer = int(index.customers[seed_rows[seed_of[i]]])
+                recommendation['lookalike_of'] = self.store.customers.decode(seed_customer)
+            recommendations.append(recommendation)
+        return recommendations
@@ -0,0 +1,353 @@
+import math
+import numpy as np
+from typing import Callable, Dict, Optional, Tuple
+
+from merchant_table import MerchantCustomerTable
+from transaction_store import SECONDS_PER_DAY
+
+SECONDS_PER_WEEK = 7 * SECONDS_PER_DAY
+
+# Predicted value covers the next 12 months
+HORIZON_WEEKS = 365 / 7
+
+# L2 penalty on the log-parameters (fitted on per-merchant normalized data),
+# so merchants with a handful of customers still get finite parameters
+PENALIZER = 0.001
+
+# Lanczos approximation (g = 7, 9 terms), accurate to ~1e-15 for x >= 0.5
+LANCZOS_G = 7
+LANCZOS_COEFFICIENTS = np.array([
+    0.99999999999980993, 676.5203681218851, -1259.1392167224028, 771.32342877765313,
+    -176.61502916214059, 12.507343278686905, -0.13857109526572012,
+    9.9843695780195716e-6, 1.5056327351493116e-7,
+])
+
+
+def gammaln(x: np.ndarray) -> np.ndarray:
+    """log Gamma(x) for positive x, elementwise."""
+    x = np.asarray(x, dtype=np.float64)
+    small = x < 0.5
+    z = np.where(small, x + 1, x) - 1  # ln Gamma(x) = ln Gamma(x + 1) - ln x below 0.5
+    series = LANCZOS_COEFFICIENTS[0] + sum(
+        c / (z + i) for i, c in enumerate(LANCZOS_COEFFICIENTS[1:], start=1)
+    )
+    t = z + LANCZOS_G + 0.5
+    result = 0.5 * math.log(2 * math.pi) + (z + 0.5) * np.log(t) - t + np.log(series)
+    return np.where(small, result - np.log(x), result)
+
+
+def digamma(x: np.ndarray) -> np.ndarray:
+    """d/dx log Gamma(x) for positive x: shifted up to x >= 6, then the asymptotic series."""
+    x = np.array(x, dtype=np.float64)
+    result = np.zeros_like(x)
+    small = x < 6
+    while small.any():
+        result[small] -= 1 / x[small]
+        x[small] += 1
+        small = x < 6
+    inv2 = 1 / (x * x)
+    series = inv2 * (1 / 12 - inv2 * (1 / 120 - inv2 * (1 / 252 - inv2 * (1 / 240 - inv2 / 132))))
+    return result + np.log(x) - 0.5 / x - series
+
+
+def hyp2f1(a: np.ndarray, b: np.ndarray, c: np.ndarray, z: np.ndarray, max_terms: int = 10000) -> np.ndarray:
+    """Gauss hypergeometric 2F1(a, b; c; z) for 0 <= z < 1, by its power series.
+
+    Entries drop out of the loop as their series converges, so a few
+    slow ones (z close to 1) don't keep every entry iterating.
+    """
+    a, b, c, z = (np.array(v, dtype=np.float64) for v in np.broadcast_arrays(a, b, c, z))
+    total = np.ones_like(z)
+    term = np.ones_like(z)
+    active = np.arange(len(z))
+    for k in range(max_terms):
+        ratio = (a[active] + k) * (b[active] + k) / ((c[active] + k) * (k + 1)) * z[active]
+        term[active] *= ratio
+        total[active] += term[active]
+        # Stop once terms are negligible and shrinking (the ratio tends to z < 1)
+        done = (np.abs(term[active]) <= 1e-12 * np.abs(total[active])) & (np.abs(ratio) < 1)
+        active = active[~done]
+        if not len(active):
+            break
+    return total
+
+
+def minimize_batched(objective: Callable[[np.ndarray], Tuple[np.ndarray, np.ndarray]], theta: np.ndarray,
+                     max_iter: int = 200, tol: float = 1e-6) -> np.ndarray:
+    """Minimize many independent objectives at once with BFGS.
+
+    theta is (problems, parameters); objective(theta) returns each
+    problem's value (problems,) and gradient (problems, parameters).
+    Every problem keeps its own inverse-Hessian estimate and backtracking
+    step, but each evaluation covers all of them in one vectorized call,
+    so a fit over every merchant costs about as many passes over the data
+    as the slowest merchant's fit.
+    """
+    num_problems, num_params = theta.shape
+    inverse_hessian = np.tile(np.eye(num_params), (num_problems, 1, 1))
+    value, gradient = objective(theta)
+    active = np.ones(num_problems, dtype=bool)
+    for _ in range(max_iter):
+        direction = -np.einsum('pij,pj->pi', inverse_hessian, gradient)
+        slope = np.einsum('pi,pi->p', direction, gradient)
+        uphill = slope >= 0
+        if uphill.any():
+            # Lost curvature information: restart those problems from steepest descent
+            inverse_hessian[uphill] = np.eye(num_params)
+            direction[uphill] = -gradient[uphill]
+            slope[uphill] = -np.einsum('pi,pi->p', gradient[uphill], gradient[uphill])
+        direction[~active] = 0
+
+        step = np.ones(num_problems)
+        accepted = ~active
+        for _ in range(40):
+            candidate = theta + step[:, None] * direction
+            new_value, new_gradient = objective(candidate)
+            accepted = accepted | (np.isfinite(new_value) & (new_value <= value + 1e-4 * step * slope))
+            if accepted.all():
+                break
+            step = np.where(accepted, step, step / 2)
+        # Problems where no step helped have converged as far as they can
+        stalled = ~accepted
+        candidate[stalled] = theta[stalled]
+        new_value[stalled], new_gradient[stalled] = value[stalled], gradient[stalled]
+
+        s = candidate - theta
+        y = new_gradient - gradient
+        sy = np.einsum('pi,pi->p', s, y)
+        update = active & (sy > 1e-12)
+        if update.any():
+            rho = 1 / sy[update]
+            h = inverse_hessian[update]
+            left = np.eye(num_params) - rho[:, None, None] * s[update][:, :, None] * y[update][:, None, :]
+            inverse_hessian[update] = np.einsum('pij,pjk,plk->pil', left, h, left) + \
+                rho[:, None, None] * s[update][:, :, None] * s[update][:, None, :]
+
+        converged = stalled | (np.abs(new_gradient).max(axis=1) < tol) | (np.abs(value - new_value) < tol * 1e-3)
+        theta, value, gradient = candidate, new_value, new_gradient
+        active &= ~converged
+        if not active.any():
+            break
+    return theta
+
+
+# Each likelihood is split in two: a term that depends only on the
+# customer's merchant and transaction count, which is evaluated once per
+# distinct (merchant, count) and weighted by how many customers share it
+# (every gammaln/digamma call lives there), and a per-customer term.
+
+def bgnbd_count_term(params: np.ndarray, x: np.ndarray) -> Tuple[np.ndarray, Tuple[np.ndarray, ...]]:
+    """BG/NBD log-likelihood terms that depend on the repeat count x only, with their log-parameter gradient.
+
+    params is (rows, 4) holding r, alpha, a, b.
+    """
+    r, alpha, a, b = params.T
+    value = gammaln(r + x) - gammaln(r) + r * np.log(alpha) + \
+        gammaln(a + b) + gammaln(b + x) - gammaln(b) - gammaln(a + b + x)
+    digamma_ab = digamma(a + b) - digamma(a + b + x)
+    gradient = (
+        r * (digamma(r + x) - digamma(r) + np.log(alpha)),
+        r,
+        a * digamma_ab,
+        b * (digamma_ab + digamma(b + x) - digamma(b)),
+    )
+    return value, gradient
+
+
+def bgnbd_customer_term(params: np.ndarray, x: np.ndarray, recency: np.ndarray,
+                        age: np.ndarray) -> Tuple[np.ndarray, Tuple[np.ndarray, ...]]:
+    """The rest of each customer's BG/NBD log-likelihood: still alive at age, or
+    dropped out right after the last repeat purchase (at recency)."""
+    r, alpha, a, b = params.T
+    repeat = x > 0
+    b_x1 = np.where(repeat, b + x - 1, 1.0)
+    log_age, log_recency = np.log(alpha + age), np.log(alpha + recency)
+    alive = -(r + x) * log_age
+    dropped = np.where(repeat, np.log(a / b_x1) - (r + x) * log_recency, -np.inf)
+    value = np.logaddexp(alive, dropped)
+    w = np.exp(dropped - value)
+    gradient = (
+        -r * (log_age + w * (log_recency - log_age)),
+        -alpha * (r + x) * ((1 - w) / (alpha + age) + w / (alpha + recency)),
+        w,
+        -b * w / b_x1,
+    )
+    return value, gradient
+
+
+def gamma_gamma_count_term(params: np.ndarray, n: np.ndarray) -> Tuple[np.ndarray, Tuple[np.ndarray, ...]]:
+    """Gamma-Gamma log-likelihood terms that depend on the transaction count n only.
+
+    params is (rows, 3) holding p, q, v.
+    """
+    p, q, v = params.T
+    px = p * n
+    digamma_sum = digamma(px + q)
+    value = gammaln(px + q) - gammaln(px) - gammaln(q) + px * np.log(n)
+    gradient = (
+        px * (digamma_sum - digamma(px) + np.log(n)),
+        q * (digamma_sum - digamma(q)),
+        np.zeros_like(v),
+    )
+    return value, gradient
+
+
+def gamma_gamma_customer_term(params: np.ndarray, n: np.ndarray,
+                              mean_value: np.ndarray) -> Tuple[np.ndarray, Tuple[np.ndarray, ...]]:
+    """The rest of each customer's Gamma-Gamma log-likelihood, given the average of n transaction values."""
+    p, q, v = params.T
+    px = p * n
+    log_total = np.log(v + mean_value * n)
+    value = q * np.log(v) + (px - 1) * np.log(mean_value) - (px + q) * log_total
+    gradient = (
+        px * (np.log(mean_value) - log_total),
+        q * (np.log(v) - log_total),
+        q - v * (px + q) / (v + mean_value * n),
+    )
+    return value, gradient
+
+
+def _merchant_objective(count_term: Callable, customer_term: Callable, merchant: np.ndarray, num_merchants: int,
+                        count: np.ndarray, *data: np.ndarray) -> Callable[[np.ndarray], Tuple[np.ndarray, np.ndarray]]:
+    """Mean negative log-likelihood per merchant plus the penalty, over every merchant's customers at once."""
+    customers = np.maximum(np.bincount(merchant, minlength=num_merchants), 1)
+    stride = int(count.max()) + 1 if len(count) else 1
+    groups, weight = np.unique(merchant * stride + count.astype(np.int64), return_counts=True)
+    group_merchant, group_count = groups // stride, (groups % stride).astype(np.float64)
+
+    def merchant_sums(index: np.ndarray, value: np.ndarray, gradient: Tuple[np.ndarray, ...],
+                      weights: Optional[np.ndarray] = None) -> np.ndarray:
+        return np.stack([
+            np.bincount(index, weights=column if weights is None else column * weights, minlength=num_merchants)
+            for column in (value,) + gradient
+        ], axis=1)
+
+    def objective(theta: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        theta = np.clip(theta, -20, 20)
+        params = np.exp(theta)
+        sums = merchant_sums(group_merchant, *count_term(params[group_merchant], group_count), weight) + \
+            merchant_sums(merchant, *customer_term(params[merchant], count, *data))
+        sums = sums / -customers[:, None]  # bincount of no rows is int64
+        return sums[:, 0] + PENALIZER * (theta ** 2).sum(axis=1), sums[:, 1:] + 2 * PENALIZER * theta
+
+    return objective
+
+
+def customer_summary(table: MerchantCustomerTable, pairs: np.ndarray, now: int) -> Dict[str, np.ndarray]:
+    """Frequency / recency / age (weeks) / monetary arrays for table pairs."""
+    first = table.first_purchase[pairs]
+    num_transactions = table.num_transactions[pairs]
+    return {
+        'frequency': (num_transactions - 1).astype(np.float64),  # repeat purchases
+        'recency': (table.last_purchase[pairs] - first) / SECONDS_PER_WEEK,
+        'age': np.maximum(now - first, table.last_purchase[pairs] - first) / SECONDS_PER_WEEK,
+        'num_transactions': num_transactions.astype(np.float64),
+        'mean_value': table.total_cents[pairs] / num_transactions / 100.0,  # dollars
+    }
+
+
+class CLVModel:
+    """Probabilistic CLV per merchant: BG/NBD for purchase counts, Gamma-Gamma for spend.
+
+    BG/NBD models each customer's purchases as a Poisson process with a
+    gamma-distributed rate (r, alpha) and a beta-distributed (a, b)
+    chance of dropping out after every purchase; Gamma-Gamma models the
+    average transaction value (p, q, v). The per-pair aggregates only
+    keep a total, so Gamma-Gamma is fitted on every transaction's average
+    rather than repeat purchases alone, over customers with at least two.
+
+    Every merchant is fitted at once: times and values are normalized by
+    each merchant's mean so one penalty fits all scales, the likelihoods
+    are evaluated for all customers in one vectorized pass (their
+    special functions once per distinct merchant and transaction count),
+    and the per-merchant sums come from bincount (see minimize_batched).
+    """
+
+    BGNBD_PARAMS = ('r', 'alpha', 'a', 'b')
+    GAMMA_GAMMA_PARAMS = ('p', 'q', 'v')
+    PREDICTIONS = ('probability_alive', 'predicted_purchases', 'predicted_spend', 'predicted_value')
+    # Merchants without repeat customers have no spend to fit; q <= 1 predicts each customer's own average
+    DEFAULT_GAMMA_GAMMA = (1.0, 1.0, 1.0)
+
+    def __init__(self, bgnbd: np.ndarray, gamma_gamma: np.ndarray, fitted_at: int):
+        self.bgnbd = bgnbd  # (merchants, 4); alpha in weeks
+        self.gamma_gamma = gamma_gamma  # (merchants, 3); v in dollars
+        self.fitted_at = fitted_at
+        self.fallback = (np.median(bgnbd, axis=0), np.median(gamma_gamma, axis=0)) if len(bgnbd) else \
+            (np.ones(4), np.ones(3))
+
+    @classmethod
+    def fit(cls, table: MerchantCustomerTable, now: int) -> 'CLVModel':
+        pairs = np.arange(len(table.merchant))
+        merchant = table.merchant.astype(np.int64)
+        # Pairs appended after the table was built may belong to merchants past its offsets
+        num_merchants = max(len(table.offsets) - 1, int(merchant.max()) + 1 if len(merchant) else 0)
+        data = customer_summary(table, pairs, now)
+        counts = np.maximum(np.bincount(merchant, minlength=num_merchants), 1)
+
+        # BG/NBD on times in units of each merchant's mean customer age
+        time_scale = np.bincount(merchant, weights=data['age'], minlength=num_merchants) / counts
+        time_scale = np.where(time_scale > 0, time_scale, 1.0)
+        scale = time_scale[merchant]
+        objective = _merchant_objective(bgnbd_count_term, bgnbd_customer_term, merchant, num_merchants,
+                                        data['frequency'], data['recency'] / scale, data['age'] / scale)
+        bgnbd = np.exp(np.clip(minimize_batched(objective, np.zeros((num_merchants, 4))), -20, 20))
+        bgnbd[:, 1] *= time_scale
+
+        # Gamma-Gamma on repeat customers' average values, in units of each merchant's mean
+        repeat = (data['num_transactions'] > 1) & (data['mean_value'] > 0)
+        value_merchant = merchant[repeat]
+        value_counts = np.bincount(value_merchant, minlength=num_merchants)
+        gamma_gamma = np.tile(cls.DEFAULT_GAMMA_GAMMA, (num_merchants, 1))
+        if len(value_merchant):
+            value_scale = np.bincount(value_merchant, weights=data['mean_value'][repeat],
+                                      minlength=num_merchants) / np.maximum(value_counts, 1)
+            value_scale = np.where(value_scale > 0, value_scale, 1.0)
+            objective = _merchant_objective(gamma_gamma_count_term, gamma_gamma_customer_term, value_merchant,
+                                            num_merchants, data['num_transactions'][repeat],
+                                            data['mean_value'][repeat] / value_scale[value_merchant])
+            fitted = np.exp(np.clip(minimize_batched(objective, np.zeros((num_merchants, 3))), -20, 20))
+            fitted[:, 2] *= value_scale
+            gamma_gamma[value_counts > 0] = fitted[value_counts > 0]
+        return cls(bgnbd, gamma_gamma, now)
+
+    def merchant_params(self, merchant_code: int) -> Dict[str, float]:
+        bgnbd, gamma_gamma = self._params(merchant_code)
+        return {
+            **dict(zip(self.BGNBD_PARAMS, bgnbd.tolist())),
+            **dict(zip(self.GAMMA_GAMMA_PARAMS, gamma_gamma.tolist())),
+        }
+
+    def _params(self, merchant_code: int) -> Tuple[np.ndarray, np.ndarray]:
+        """A merchant's fitted parameters; merchants first seen after the fit get the median merchant's."""
+        if 0 <= merchant_code < len(self.bgnbd):
+            return self.bgnbd[merchant_code], self.gamma_gamma[merchant_code]
+        return self.fallback
+
+    def predict(self, table: MerchantCustomerTable, merchant_code: int, pairs: np.ndarray,
+                now: int, horizon_weeks: float = HORIZON_WEEKS) -> Dict[str, np.ndarray]:
+        """probability_alive, predicted_purchases, predicted_spend (per transaction) and
+        predicted_value over the next horizon_weeks for one merchant's pairs."""
+        (r, alpha, a, b), (p, q, v) = self._params(merchant_code)
+        data = customer_summary(table, pairs, now)
+        x, recency, age = data['frequency'], data['recency'], data['age']
+        repeat = x > 0
+
+        # Odds of having dropped out right after the last purchase versus still being alive
+        log_odds = np.where(repeat, np.log(a) - np.log(np.where(repeat, b + x - 1, 1.0)) +
+                            (r + x) * (np.log(alpha + age) - np.log(alpha + recency)), -np.inf)
+        probability_alive = np.exp(-np.logaddexp(0, log_odds))
+
+        a_shifted = a if abs(a - 1) > 1e-6 else 1 + 1e-6  # the expectation has a removable singularity at a = 1
+        z = horizon_weeks / (alpha + age + horizon_weeks)
+        decay = np.exp((r + x) * np.log1p(-z)) * hyp2f1(r + x, b + x, a_shifted + b + x - 1, z)
+        purchases = np.maximum((a_shifted + b + x - 1) / (a_shifted - 1) * (1 - decay), 0) * probability_alive
+
+        n, mean_value = data['num_transactions'], data['mean_value']
+        spend = p * (v + n * mean_value) / (p * n + q - 1) if q > 1 else mean_value
+        return {
+            'probability_alive': probability_alive,
+            'predicted_purchases': purchases,
+            'predicted_spend': spend,
+            'predicted_value': purchases * spend,
+        }
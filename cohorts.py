@@ -0,0 +1,75 @@
+import numpy as np
+from typing import Dict, List
+
+from transaction_store import TransactionStore
+
+
+class CohortMatrices:
+    """Acquisition-month cohort retention and revenue matrices for every merchant at once.
+
+    A customer joins a merchant's cohort for the calendar month of their
+    first purchase there, and a purchase's age is the number of calendar
+    months since that first month. customers[m, c, a] counts the distinct
+    customers of merchant m's cohort c who purchased at age a (age 0 is
+    the cohort's size), and revenue_cents[m, c, a] is what they spent
+    then. Cohorts count months from first_month, the store's earliest, so
+    every merchant shares one (cohort, age) grid.
+
+    The build is one pass over the store's merchant index, whose
+    (merchant, customer, time) order makes each pair's first purchase the
+    first row of its run and each (pair, age) a run of its own; the
+    matrices are then a bincount and an np.add.at over those runs.
+    """
+
+    def __init__(self, store: TransactionStore):
+        store.ensure_index()
+        rows = store.merchant_rows
+        merchants = store.merchant[rows].astype(np.int64)
+        customers = store.customer[rows]
+        months = store.datetimes[rows].astype('datetime64[M]').astype(np.int64)
+        self.num_rows = store.num_transactions
+        self.num_merchants = len(store.merchants)
+        self.first_month = int(months.min()) if len(rows) else 0
+        self.num_months = int(months.max()) - self.first_month + 1 if len(rows) else 0
+
+        new_pair = np.ones(len(rows), dtype=bool)
+        new_pair[1:] = (merchants[1:] != merchants[:-1]) | (customers[1:] != customers[:-1])
+        acquired = months[new_pair][np.cumsum(new_pair) - 1]
+        age = months - acquired
+        cell = (merchants * self.num_months + acquired - self.first_month) * self.num_months + age
+
+        # Ages never decrease within a pair, so a new (pair, age) run starts wherever either changes
+        new_run = new_pair.copy()
+        new_run[1:] |= age[1:] != age[:-1]
+        run_starts = np.flatnonzero(new_run)
+        shape = (self.num_merchants, self.num_months, self.num_months)
+        self.customers = np.bincount(cell[run_starts], minlength=int(np.prod(shape))).reshape(shape)
+        revenue_cents = np.zeros(int(np.prod(shape)), dtype=np.int64)
+        if len(run_starts):
+            np.add.at(revenue_cents, cell[run_starts], np.add.reduceat(store.total_cents[rows], run_starts))
+        self.revenue_cents = revenue_cents.reshape(shape)
+
+    def merchant(self, merchant_code: int) -> List[Dict]:
+        """One merchant's cohorts, oldest first.
+
+        Each has its month, size, and per-age lists (age 0 first, up to the
+        store's last month) of active customers, retention (percent of the
+        cohort size) and revenue.
+        """
+        if not 0 <= merchant_code < self.num_merchants:
+            return []
+        customers, revenue_cents = self.customers[merchant_code], self.revenue_cents[merchant_code]
+        cohorts = np.flatnonzero(customers[:, 0])
+        labels = np.datetime_as_string((self.first_month + cohorts).astype('datetime64[M]')).tolist()
+        result = []
+        for cohort, label in zip(cohorts.tolist(), labels):
+            observed = self.num_months - cohort
+            active = customers[cohort, :observed]
+            result.append({
+                'cohort': label,
+                'customers': int(active[0]),
+                'active_customers': active.tolist(),
+                'retention': np.round(active / active[0] * 100, 2).tolist(),
+                'revenue': (revenue_cents[cohort, :observed] / 100.0).tolist(),
+            })
+        return result
@@ -0,0 +1,146 @@
+import gzip
+import io
+import json
+import os
+from typing import Any, Dict, Iterable, Iterator, Optional, TextIO, Tuple
+
+try:
+    import zstandard
+except ImportError:  # only needed for .zst files
+    zstandard = None
+
+# Plain JSON documents (.txt is what the generator has always written)
+JSON_SUFFIXES = ('.txt', '.json')
+# One line of non-transaction fields, then one transaction per line
+NDJSON_SUFFIXES = ('.ndjson',)
+COMPRESSION_SUFFIXES = ('.gz', '.zst')
+
+# Every customer file name load_data picks up; bare .json is left out because
+# data directories also hold merchants.json
+CUSTOMER_FILE_SUFFIXES = tuple(
+    base + compression
+    for base in JSON_SUFFIXES + NDJSON_SUFFIXES
+    for compression in ('',) + COMPRESSION_SUFFIXES
+    if base + compression != '.json'
+)
+
+COMPACT_SEPARATORS = (',', ':')
+
+# What truncated, corrupt or non-UTF-8 files raise while being read
+DECOMPRESSION_ERRORS = (EOFError, gzip.BadGzipFile, UnicodeDecodeError) + \
+    ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def file_format(path: str) -> Tuple[str, Optional[str]]:
+    """(layout, compression) of a customer file from its extension.
+
+    layout is 'json' or 'ndjson'; compression is 'gz', 'zst' or None.
+    """
+    compression = None
+    for suffix in COMPRESSION_SUFFIXES:
+        if path.endswith(suffix):
+            compression = suffix[1:]
+            path = path[:-len(suffix)]
+    if path.endswith(NDJSON_SUFFIXES):
+        return 'ndjson', compression
+    if path.endswith(JSON_SUFFIXES):
+        return 'json', compression
+    raise ValueError(f"{path} is not a customer file")
+
+
+def is_customer_file(filename: str) -> bool:
+    return filename.endswith(CUSTOMER_FILE_SUFFIXES)
+
+
+def _zstandard():
+    if zstandard is None:
+        raise ImportError("reading or writing .zst customer files needs the zstandard package")
+    return zstandard
+
+
+def decompress(raw: bytes, compression: Optional[str]) -> bytes:
+    """Whole-file decompression, for files small enough to hold in memory."""
+    if compression == 'gz':
+        return gzip.decompress(raw)
+    if compression == 'zst':
+        return _zstandard().ZstdDecompressor().decompressobj().decompress(raw)
+    return raw
+
+
+def open_text(path: str) -> TextIO:
+    """Open a customer file for reading as text, decompressing as it is read."""
+    _, compression = file_format(path)
+    if compression == 'gz':
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if compression == 'zst':
+        raw = _zstandard().ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+        return io.TextIOWrapper(raw, encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+def _open_binary_writer(path: str, compression: Optional[str], level: Optional[int]):
+    if compression == 'gz':
+        return gzip.open(path, 'wb', compresslevel=6 if level is None else level)
+    if compression == 'zst':
+        compressor = _zstandard().ZstdCompressor(level=3 if level is None else level)
+        return compressor.stream_writer(open(path, 'wb'), closefd=True)
+    return open(path, 'wb')
+
+
+def read_ndjson(f: TextIO) -> Tuple[Dict[str, Any], Iterator[Dict]]:
+    """Header fields and a lazy iterator over the transactions of an NDJSON customer file."""
+    header = json.loads(f.readline() or '{}')
+    return header, (json.loads(line) for line in f if line.strip())
+
+
+def parse_document(data: bytes, layout: str) -> Dict[str, Any]:
+    """A whole customer document from its decompressed bytes."""
+    if layout == 'ndjson':
+        header, _, body = data.partition(b'\n')
+        # One json.loads over the lines joined into an array beats one call per line
+        transactions = json.loads(b'[' + b','.join(line for line in body.split(b'\n') if line.strip()) + b']')
+        return {**json.loads(header or b'{}'), 'transactions': transactions}
+    return json.loads(data)
+
+
+def write_customer_file(path: str, customer_data: Dict[str, Any], level: Optional[int] = None):
+    """Write a customer document in the layout and compression its extension names.
+
+    Plain .txt files keep the indent=4 layout the generator has always
+    used; every other format is written compact. NDJSON puts every field
+    except transactions on the first line and one transaction per line
+    after it, so readers never hold more than one transaction's text.
+    """
+    layout, compression = file_format(path)
+    with io.TextIOWrapper(_open_binary_writer(path, compression, level), encoding='utf-8') as f:
+        if layout == 'ndjson':
+            header = {key: value for key, value in customer_data.items() if key != 'transactions'}
+            f.write(json.dumps(header, separators=COMPACT_SEPARATORS) + '\n')
+            for transaction in customer_data.get('transactions', ()):
+                f.write(json.dumps(transaction, separators=COMPACT_SEPARATORS) + '\n')
+        elif path.endswith('.txt'):
+            json.dump(customer_data, f, indent=4)
+        else:
+            json.dump(customer_data, f, separators=COMPACT_SEPARATORS)
+
+
+def load_customer_document(path: str) -> Dict[str, Any]:
+    """A whole customer document as a dict, whatever its format."""
+    layout, compression = file_format(path)
+    with open(path, 'rb') as f:
+        return parse_document(decompress(f.read(), compression), layout)
+
+
+def convert_customer_files(paths: Iterable[str], output_dir: str, suffix: str,
+                           level: Optional[int] = None) -> int:
+    """Rewrite customer files into output_dir with another extension; returns the file count."""
+    count = 0
+    for path in paths:
+        name = os.path.basename(path)
+        for known in sorted(CUSTOMER_FILE_SUFFIXES, key=len, reverse=True):
+            if name.endswith(known):
+                name = name[:-len(known)]
+                break
+        write_customer_file(os.path.join(output_dir, name + suffix), load_customer_document(path), level)
+        count += 1
+    return count
@@ -1,7 +1,8 @@
 import openai
-from datetime import datetime
 from dotenv import load_dotenv
 import os
+import time
+from transaction_store import SECONDS_PER_DAY
 
 # Load environment variables
 load_dotenv()
@@ -36,7 +37,8 @@ class CustomerProfileGenerator:
     def analyze_purchase_behavior(self, customers):
         """Analyze purchase behavior patterns"""
         avg_frequency = sum(c['purchase_frequency'] for c in customers) / len(customers)
-        recent_shoppers = len([c for c in customers if (datetime.now() - datetime.fromisoformat(c['last_purchase'].replace('Z', '+00:00'))).days < 30])
+        current_time = int(time.time())
+        recent_shoppers = len([c for c in customers if (current_time - c['last_purchase_ts']) // SECONDS_PER_DAY < 30])
         
         return {
             'average_frequency': avg_frequency,
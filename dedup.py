@@ -0,0 +1,148 @@
+import math
+import numpy as np
+from typing import Dict, Set
+
+# Key value meaning "no transaction id"; such rows are never treated as duplicates
+NO_KEY = 0
+
+# Keys hashed per step, bounding the (keys, num_hashes) probe matrix
+BLOCK_KEYS = 1 << 16
+
+# Keys kept in Deduplicator's set before they are merged into its sorted array
+RECENT_KEYS = 1 << 14
+
+
+def first_occurrences(keys: np.ndarray) -> np.ndarray:
+    """Mask of each key's first position in keys; NO_KEY rows are always kept."""
+    ordered = np.sort(keys)
+    if (ordered[1:] != ordered[:-1]).all():
+        return np.ones(len(keys), dtype=bool)
+    first = np.zeros(len(keys), dtype=bool)
+    first[np.unique(keys, return_index=True)[1]] = True
+    return first | (keys == NO_KEY)
+
+
+class BloomFilter:
+    """Bit-array Bloom filter over 64-bit integer keys, checked a whole array at a time.
+
+    Keys are expected to be uniformly distributed already (they are
+    hashes), so the k probe positions come from double hashing the key's
+    two 32-bit halves instead of k separate hash functions.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(64, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = np.zeros((self.num_bits + 7) // 8, dtype=np.uint8)
+
+    def _positions(self, keys: np.ndarray) -> np.ndarray:
+        keys = keys.astype(np.uint64)
+        low = keys & np.uint64(0xFFFFFFFF)
+        high = (keys >> np.uint64(32)) | np.uint64(1)
+        probes = np.arange(self.num_hashes, dtype=np.uint64)
+        return (low[:, None] + probes * high[:, None]) % np.uint64(self.num_bits)
+
+    def add(self, keys: np.ndarray):
+        if len(keys) * self.num_hashes >= self.num_bits // 8:
+            # Bulk insert: mark a byte per bit, then pack them into the filter at once
+            marked = np.zeros(len(self.bits) * 8, dtype=bool)
+            for start in range(0, len(keys), BLOCK_KEYS):
+                marked[self._positions(keys[start:start + BLOCK_KEYS]).ravel()] = True
+            self.bits |= np.packbits(marked, bitorder='little')
+            return
+        positions = self._positions(keys).ravel()
+        byte, bit = positions >> np.uint64(3), positions & np.uint64(7)
+        # One pass per bit of the byte: repeated byte indices then all write the same value
+        for b in range(8):
+            self.bits[byte[bit == b]] |= np.uint8(1 << b)
+
+    def might_contain(self, keys: np.ndarray) -> np.ndarray:
+        """False means definitely never added; True means probably added."""
+        found = np.zeros(len(keys), dtype=bool)
+        for start in range(0, len(keys), BLOCK_KEYS):
+            positions = self._positions(keys[start:start + BLOCK_KEYS])
+            hits = (self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+            found[start:start + BLOCK_KEYS] = hits.all(axis=1)
+        return found
+
+
+class Deduplicator:
+    """Remembers transaction keys and flags repeats, with a Bloom filter in front of an exact set.
+
+    Almost every new key is rejected by the Bloom filter alone; only the
+    filter's possible hits (real repeats plus ~error_rate false
+    positives) are looked up in the exact set: a sorted int64 array for
+    bulk loads plus a Python set of recently added keys, merged into the
+    array once it grows. The filter is rebuilt twice as large whenever it
+    fills past capacity.
+    """
+
+    def __init__(self, capacity: int = 1 << 16, error_rate: float = 0.01):
+        self.error_rate = error_rate
+        self.bloom = BloomFilter(capacity, error_rate)
+        self._sorted = np.empty(0, dtype=np.int64)
+        self._recent: Set[int] = set()
+        self.num_keys = 0
+        self.duplicates = 0
+        self.exact_checks = 0
+        self.false_positives = 0
+
+    def _contains(self, keys: np.ndarray) -> np.ndarray:
+        found = np.zeros(len(keys), dtype=bool)
+        if len(self._sorted):
+            index = np.minimum(np.searchsorted(self._sorted, keys), len(self._sorted) - 1)
+            found = self._sorted[index] == keys
+        if self._recent:
+            found |= np.fromiter((key in self._recent for key in keys.tolist()), dtype=bool, count=len(keys))
+        return found
+
+    def add(self, keys: np.ndarray):
+        """Remember keys without checking them (they must not be repeats of each other or of known keys)."""
+        keys = keys[keys != NO_KEY]
+        if not len(keys):
+            return
+        self.num_keys += len(keys)
+        if self.num_keys > self.bloom.capacity:
+            self._merge_recent()
+            self.bloom = BloomFilter(2 * self.num_keys, self.error_rate)
+            self.bloom.add(self._sorted)
+        self.bloom.add(keys)
+        if len(keys) > RECENT_KEYS:
+            self._sorted = np.sort(np.concatenate((self._sorted, keys.astype(np.int64))))
+        else:
+            self._recent.update(keys.tolist())
+            if len(self._recent) > RECENT_KEYS:
+                self._merge_recent()
+
+    def _merge_recent(self):
+        if self._recent:
+            recent = np.fromiter(self._recent, dtype=np.int64, count=len(self._recent))
+            self._sorted = np.sort(np.concatenate((self._sorted, recent)))
+            self._recent = set()
+
+    def admit(self, keys: np.ndarray) -> np.ndarray:
+        """Mask of keys seen for the first time (the first of any repeats within keys); remembers them."""
+        keys = np.asarray(keys, dtype=np.int64)
+        first = first_occurrences(keys)
+        candidates = np.flatnonzero(first & (keys != NO_KEY) & self.bloom.might_contain(keys))
+        if len(candidates):
+            seen = self._contains(keys[candidates])
+            self.exact_checks += len(candidates)
+            self.false_positives += int(np.count_nonzero(~seen))
+            first[candidates[seen]] = False
+
+        self.add(keys[first])
+        self.duplicates += len(keys) - int(np.count_nonzero(first))
+        return first
+
+    def stats(self) -> Dict:
+        return {
+            'keys': self.num_keys,
+            'duplicates': self.duplicates,
+            'exact_checks': self.exact_checks,
+            'bloom_false_positives': self.false_positives,
+            'bloom_bytes': self.bloom.bits.nbytes,
+        }
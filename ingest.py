@@ -0,0 +1,332 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from decimal import ROUND_HALF_UP, Decimal
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+import customer_files
+from dedup import NO_KEY
+from json_stream import CustomerFileReader
+from transaction_store import StringTable, TransactionStore, TransactionStoreBuilder
+
+EPOCH = datetime(1970, 1, 1)
+
+# Customer files above this size are streamed instead of loaded whole
+STREAM_THRESHOLD_BYTES = 64 * 1024 * 1024
+# Compact customer JSON shrinks about this much compressed; scales the threshold for .gz/.zst files
+COMPRESSION_RATIO = 8
+
+# Distinct URL hosts remembered by merchant_for_url
+MERCHANT_MEMO_SIZE = 4096
+
+
+def parse_timestamp(value: str) -> int:
+    """Convert an ISO-8601 transaction datetime to epoch seconds (timezone-naive)."""
+    moment = datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+    return int((moment - EPOCH).total_seconds())
+
+
+def to_cents(value) -> int:
+    """Convert a price (number or numeric string) to integer cents, half cents rounded up.
+
+    Rounding follows the decimal value as written, so 1.005 is 101 cents
+    even though 1.005 * 100 is 100.49999... in binary floating point.
+    """
+    scaled = float(value) * 100
+    # Only values within float noise of a half cent need exact decimal rounding
+    if abs(abs(scaled - int(scaled)) - 0.5) < 1e-6:
+        return int(Decimal(str(value)).scaleb(2).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    return int(round(scaled))
+
+
+def normalize_merchant_name(url: str) -> str:
+    """Extract merchant name from URL."""
+    # Remove http(s):// and www.
+    url = url.lower().replace('https://', '').replace('http://', '').replace('www.', '')
+    # Get the domain part
+    domain = url.split('/')[0]
+    # Remove .com and similar endings
+    merchant = domain.split('.')[0]
+    return merchant
+
+
+def url_host(url: str) -> str:
+    """The scheme and host prefix of a URL, which alone determines its merchant name."""
+    scheme_end = url.find('://')
+    end = url.find('/', scheme_end + 3 if scheme_end >= 0 else 0)
+    return url if end < 0 else url[:end]
+
+
+@lru_cache(maxsize=MERCHANT_MEMO_SIZE)
+def _merchant_for_host(host: str) -> str:
+    return normalize_merchant_name(host)
+
+
+def merchant_for_url(url: str) -> str:
+    """normalize_merchant_name, memoized per URL host (order URLs themselves are all distinct)."""
+    return _merchant_for_host(url_host(url))
+
+
+def transaction_key(transaction: Dict) -> int:
+    """64-bit hash of a transaction's Knot id (or external_id), or dedup.NO_KEY if it has neither."""
+    source_id = transaction.get('id') or transaction.get('external_id')
+    if not source_id:
+        return NO_KEY
+    return int.from_bytes(hashlib.blake2b(str(source_id).encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+
+def is_rankable(transaction: Dict) -> bool:
+    """Whether a Knot transaction has the datetime, url and price total that ranking needs."""
+    return bool(transaction.get('datetime') and transaction.get('url')) and \
+        (transaction.get('price') or {}).get('total') is not None
+
+
+def parse_transactions(customer_id: Optional[str], transactions: Iterable[Dict]) -> Dict:
+    """Flatten a customer's transactions into a compact partial.
+
+    Transactions are consumed one at a time into typed arrays, so any
+    iterable works, including a stream that never holds the whole file.
+    The partial holds NumPy columns plus small per-file string tables, so
+    it is cheap to pickle back from a worker process and to merge.
+    Merchant names are normalized once per distinct URL host and interned
+    straight to the partial's merchant codes. Each row also carries its
+    transaction_key, so repeats of the same transaction can be dropped.
+    Transactions missing a url, datetime or price total, or whose values
+    don't parse, are skipped and counted in the partial's 'invalid'.
+    """
+    merchants, statuses, brands = StringTable(), StringTable(), StringTable()
+    host_codes: Dict[str, int] = {}
+    merchant, timestamp, total_cents = array('i'), array('q'), array('q')
+    status, brand, key = array('h'), array('h'), array('q')
+    invalid = 0
+    for t in transactions:
+        if not is_rankable(t):
+            invalid += 1
+            continue
+        try:
+            host = url_host(t['url'])
+            row_timestamp = parse_timestamp(t['datetime'])
+            row_cents = to_cents(t['price']['total'])
+        except (AttributeError, TypeError, ValueError, ArithmeticError):
+            invalid += 1
+            continue
+        payment_methods = t.get('payment_methods') or []
+        code = host_codes.get(host)
+        if code is None:
+            code = host_codes[host] = merchants.encode(_merchant_for_host(host))
+        merchant.append(code)
+        timestamp.append(row_timestamp)
+        total_cents.append(row_cents)
+        status.append(statuses.encode(t.get('order_status') or ''))
+        brand.append(brands.encode((payment_methods[0].get('brand') or '') if payment_methods else ''))
+        key.append(transaction_key(t))
+    return {
+        'customer_id': customer_id,
+        'merchants': merchants.values,
+        'statuses': statuses.values,
+        'brands': brands.values,
+        'merchant': np.frombuffer(merchant, dtype=np.int32) if merchant else np.empty(0, dtype=np.int32),
+        'timestamp': np.frombuffer(timestamp, dtype=np.int64) if timestamp else np.empty(0, dtype=np.int64),
+        'total_cents': np.frombuffer(total_cents, dtype=np.int64) if total_cents else np.empty(0, dtype=np.int64),
+        'status': np.frombuffer(status, dtype=np.int16) if status else np.empty(0, dtype=np.int16),
+        'brand': np.frombuffer(brand, dtype=np.int16) if brand else np.empty(0, dtype=np.int16),
+        'key': np.frombuffer(key, dtype=np.int64) if key else np.empty(0, dtype=np.int64),
+        'invalid': invalid,
+    }
+
+
+def parse_customer(customer_data: Dict) -> Dict:
+    """Flatten one parsed customer file into a compact partial."""
+    return parse_transactions(customer_data['customer_type'], customer_data['transactions'])
+
+
+def file_digest(path: str, block_size: int = 1 << 20) -> str:
+    """sha256 of a file's contents, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parse_customer_file(path: str) -> Dict:
+    """Parse one customer file into a partial; errors are reported in the result instead of raised.
+
+    The format comes from the extension (see customer_files): JSON or
+    NDJSON, optionally gzip or zstd compressed. Files larger than
+    STREAM_THRESHOLD_BYTES (of text, estimated for compressed files) are
+    streamed and decompressed as they are read: transactions are decoded
+    one by one, so peak memory is the partial's columns plus one read
+    chunk, however large the file is. Smaller files are read whole and
+    go through json.loads, which is faster. Timings are CPU seconds, so
+    they stay meaningful when workers share cores.
+
+    Every result also carries the file's size, mtime_ns and sha256 (of
+    the bytes on disk), which reloads use to tell changed files from
+    untouched ones.
+    """
+    start = time.process_time()
+    filename = os.path.basename(path)
+    stat = os.stat(path)
+    source = {'filename': filename, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    layout, compression = customer_files.file_format(path)
+    threshold = STREAM_THRESHOLD_BYTES if compression is None else STREAM_THRESHOLD_BYTES // COMPRESSION_RATIO
+    try:
+        if stat.st_size > threshold:
+            with customer_files.open_text(path) as f:
+                if layout == 'ndjson':
+                    header, transactions = customer_files.read_ndjson(f)
+                    partial = parse_transactions(header['customer_type'], transactions)
+                else:
+                    reader = CustomerFileReader(f)
+                    partial = parse_transactions(None, reader.transactions())
+                    partial['customer_id'] = reader.fields['customer_type']
+            source['sha256'] = file_digest(path)
+        else:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            source['sha256'] = hashlib.sha256(raw).hexdigest()
+            partial = parse_customer(customer_files.parse_document(customer_files.decompress(raw, compression), layout))
+    except json.JSONDecodeError:
+        source.setdefault('sha256', file_digest(path))
+        return {**source, 'error': 'invalid JSON', 'seconds': time.process_time() - start}
+    except customer_files.DECOMPRESSION_ERRORS as e:
+        source.setdefault('sha256', file_digest(path))
+        return {**source, 'error': f'unreadable ({type(e).__name__})', 'seconds': time.process_time() - start}
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        # Structurally wrong files (no transactions list, header fields missing) fail alone, not the whole pool
+        source.setdefault('sha256', file_digest(path))
+        return {**source, 'error': f'malformed ({type(e).__name__}: {e})', 'seconds': time.process_time() - start}
+    partial.update(source)
+    partial['seconds'] = time.process_time() - start
+    return partial
+
+
+def report_invalid(partial: Dict):
+    """Log a parsed file's skipped transactions, if it had any."""
+    if partial.get('invalid'):
+        print(f"Skipped {partial['invalid']} invalid transactions in {partial['filename']}")
+
+
+def manifest_entry(partial: Dict) -> Dict:
+    """What a reload needs to remember about one parsed file."""
+    return {
+        'size': partial['size'],
+        'mtime_ns': partial['mtime_ns'],
+        'sha256': partial['sha256'],
+        'customer_id': partial.get('customer_id'),  # None for files that failed to parse
+    }
+
+
+def list_customer_files(data_dir: str) -> List[str]:
+    """Customer files in data_dir, in any format customer_files can read."""
+    return [
+        os.path.join(data_dir, filename)
+        for filename in os.listdir(data_dir)
+        if customer_files.is_customer_file(filename)
+    ]
+
+
+def data_fingerprint(data_dir: str) -> str:
+    """Hash of the customer files' names, sizes and modification times."""
+    digest = hashlib.sha256()
+    for path in sorted(list_customer_files(data_dir)):
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def _pool_context():
+    # Forked workers inherit the parent's modules instead of re-importing
+    # __main__, which would re-run api.py's startup load in every worker.
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+
+def parse_customer_files(paths: List[str], workers: Optional[int] = None) -> Tuple[List[Dict], int]:
+    """Parse customer files, in a process pool when workers > 1; returns (partials, workers used)."""
+    if workers is None:
+        workers = min(os.cpu_count() or 1, len(paths))
+    context = _pool_context()
+    if workers > 1 and context is not None:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            partials = list(executor.map(parse_customer_file, paths, chunksize=max(1, len(paths) // (workers * 4))))
+        return partials, workers
+    return [parse_customer_file(path) for path in paths], 1
+
+
+def scan_changes(data_dir: str, manifest: Dict[str, Dict]) -> Tuple[List[str], List[str], Dict[str, Dict]]:
+    """Compare data_dir against a manifest of previously parsed files.
+
+    Files whose size and mtime match are trusted without reading them;
+    otherwise the content hash decides. Returns (paths of new or changed
+    files, filenames that were deleted, manifest entries of files that
+    were only touched, with their new size and mtime).
+    """
+    changed, touched = [], {}
+    present = set()
+    for path in list_customer_files(data_dir):
+        filename = os.path.basename(path)
+        present.add(filename)
+        entry = manifest.get(filename)
+        stat = os.stat(path)
+        if entry is not None and (entry['size'], entry['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+            continue
+        if entry is not None and entry['sha256'] == file_digest(path):
+            touched[filename] = {**entry, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            continue
+        changed.append(path)
+    deleted = [filename for filename in manifest if filename not in present]
+    return changed, deleted, touched
+
+
+def load_customer_files(data_dir: str, workers: Optional[int] = None) -> Tuple[TransactionStore, Dict]:
+    """Parse every customer file in data_dir into a TransactionStore.
+
+    With more than one worker the files are parsed in a process pool and
+    only the compact partials travel back to the parent. Returns the store
+    and ingestion stats (per-file parse seconds, wall time, speedup, the
+    manifest of parsed files, and how many repeated transactions were
+    dropped).
+    """
+    paths = list_customer_files(data_dir)
+    start = time.perf_counter()
+    partials, workers = parse_customer_files(paths, workers)
+
+    builder = TransactionStoreBuilder()
+    file_seconds, errors, manifest = {}, [], {}
+    for partial in partials:
+        file_seconds[partial['filename']] = partial['seconds']
+        manifest[partial['filename']] = manifest_entry(partial)
+        if 'error' in partial:
+            print(f"Error reading {partial['filename']}")
+            errors.append(partial['filename'])
+            continue
+        report_invalid(partial)
+        builder.add_partial(partial)
+    store = builder.build()
+    wall_seconds = time.perf_counter() - start
+
+    parse_seconds = sum(file_seconds.values())
+    stats = {
+        'workers': workers,
+        'files': len(paths),
+        'errors': errors,
+        'file_seconds': file_seconds,
+        'parse_seconds': parse_seconds,
+        'wall_seconds': wall_seconds,
+        'speedup': parse_seconds / wall_seconds if wall_seconds > 0 else 0.0,
+        'manifest': manifest,
+        'duplicates': store.deduplicator.duplicates,
+        'dedup': store.deduplicator.stats(),
+    }
+    return store, stats
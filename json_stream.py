@@ -0,0 +1,101 @@
+import json
+import re
+from typing import Any, Dict, Iterator, TextIO
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class CustomerFileReader:
+    """Incrementally read a {"customer_type": ..., "transactions": [...]} JSON document.
+
+    transactions() yields one transaction dict at a time while reading the
+    file in fixed-size chunks, so memory use is bounded by the chunk size
+    plus one transaction, not by the size of the file. Every other
+    top-level field is decoded whole into self.fields as it is passed;
+    fields that come after the transactions array are only available once
+    the iterator is exhausted.
+    """
+
+    def __init__(self, f: TextIO, chunk_size: int = 1 << 20):
+        self.fields: Dict[str, Any] = {}
+        self._f = f
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        """Drop the consumed prefix and read another chunk; False at end of file."""
+        if self._eof:
+            return False
+        chunk = self._f.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self) -> str:
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise json.JSONDecodeError('Unexpected end of data', self._buf, self._pos)
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self._buf, self._pos)
+        self._pos += 1
+
+    def _value(self) -> Any:
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # Most likely the value runs past the end of the buffer
+                if self._fill():
+                    continue
+                raise
+            # A number that ends exactly at the buffer edge may continue in the next chunk
+            if end == len(self._buf) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def _separator(self, closing: str) -> bool:
+        """Consume ',' (returns True) or the closing bracket (returns False)."""
+        char = self._peek()
+        self._pos += 1
+        if char == closing:
+            return False
+        if char != ',':
+            raise json.JSONDecodeError("Expecting ',' delimiter", self._buf, self._pos - 1)
+        return True
+
+    def transactions(self) -> Iterator[Dict]:
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            if not isinstance(key, str):
+                raise json.JSONDecodeError('Expecting property name', self._buf, self._pos)
+            self._expect(':')
+            if key == 'transactions':
+                self._expect('[')
+                if self._peek() == ']':
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if not self._separator(']'):
+                            break
+            else:
+                self.fields[key] = self._value()
+            if not self._separator('}'):
+                return
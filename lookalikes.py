@@ -0,0 +1,96 @@
+import numpy as np
+from typing import Tuple
+
+from merchant_table import MerchantCustomerTable
+from transaction_store import SECONDS_PER_DAY, TransactionStore
+
+
+class LookalikeIndex:
+    """Standardized per-customer feature vectors for nearest-neighbour lookalike search.
+
+    Each customer with at least one transaction gets a row of FEATURES
+    (on a signed log scale, so a few big spenders don't stretch the axes
+    and refunds that leave a net negative spend stay finite), each
+    column standardized to zero mean and unit variance over all
+    customers. Distances are Euclidean in that space.
+
+    nearest() scores customers block by block: the squared distances of
+    a block to every query are |x|^2 - 2 x.q + |q|^2, one matrix product,
+    and only each block's top candidates per query are kept, so memory
+    stays at (queries x BLOCK_ROWS) however many customers there are.
+    """
+
+    FEATURES = ('total_spend', 'monthly_frequency', 'avg_transaction', 'months_active',
+                'days_since_last_purchase', 'merchants')
+    BLOCK_ROWS = 65536
+
+    def __init__(self, store: TransactionStore, table: MerchantCustomerTable):
+        self.num_rows = store.num_transactions
+        num_customers = store.num_customers
+        # Aggregate the merchant/customer pairs rather than the rows: far fewer, and kept current on appends
+        customer = table.customer
+        spend_cents = np.bincount(customer, weights=table.total_cents, minlength=num_customers)
+        counts = np.bincount(customer, weights=table.num_transactions, minlength=num_customers)
+        merchants = np.bincount(customer, minlength=num_customers)
+        first = np.full(num_customers, np.iinfo(np.int64).max, dtype=np.int64)
+        last = np.full(num_customers, np.iinfo(np.int64).min, dtype=np.int64)
+        np.minimum.at(first, customer, table.first_purchase)
+        np.maximum.at(last, customer, table.last_purchase)
+
+        self.customers = np.flatnonzero(counts)  # customer code of each row
+        spend_cents, counts, merchants = spend_cents[self.customers], counts[self.customers], merchants[self.customers]
+        first, last = first[self.customers], last[self.customers]
+        self.total_spend = spend_cents / 100.0
+        self.months_active = np.maximum(1, (last - first) // SECONDS_PER_DAY / 30)
+        self.monthly_frequency = counts / self.months_active
+        self.avg_transaction = self.total_spend / counts
+        newest = int(last.max()) if len(last) else 0
+
+        features = np.column_stack((
+            self.total_spend, self.monthly_frequency, self.avg_transaction, self.months_active,
+            (newest - last) / SECONDS_PER_DAY, merchants
+        ))
+        features = np.sign(features) * np.log1p(np.abs(features))
+        self.mean = features.mean(axis=0) if len(features) else np.zeros(len(self.FEATURES))
+        std = features.std(axis=0) if len(features) else np.ones(len(self.FEATURES))
+        self.std = np.where(std > 0, std, 1.0)
+        self.features = ((features - self.mean) / self.std).astype(np.float32)
+        self.norms = np.einsum('ij,ij->i', self.features, self.features)
+        self.rows = np.full(num_customers, -1, dtype=np.int64)  # customer code -> row, -1 without transactions
+        self.rows[self.customers] = np.arange(len(self.customers))
+
+    def __len__(self) -> int:
+        return len(self.customers)
+
+    def nearest(self, queries: np.ndarray, top_n: int, exclude: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """The top_n rows nearest to each query, skipping rows where exclude (one flag per row) is True.
+
+        Returns (rows, distances), both (queries, top_n) and nearest
+        first; a query with fewer eligible rows is padded with row -1 at
+        distance inf.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        query_norms = np.einsum('ij,ij->i', queries, queries)[:, None]
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self), self.BLOCK_ROWS):
+            end = min(start + self.BLOCK_ROWS, len(self))
+            distances = self.norms[start:end] - 2 * queries @ self.features[start:end].T + query_norms
+            distances[:, exclude[start:end]] = np.inf
+            rows = np.broadcast_to(np.arange(start, end), distances.shape)
+            # Carry the best so far into this block's candidates and keep the top_n of both
+            distances, rows = np.hstack((best, distances)), np.hstack((best_rows, rows))
+            if distances.shape[1] > top_n:
+                keep = np.argpartition(distances, top_n - 1, axis=1)[:, :top_n]
+                distances, rows = np.take_along_axis(distances, keep, 1), np.take_along_axis(rows, keep, 1)
+            best, best_rows = distances, rows
+
+        missing = top_n - best.shape[1]
+        if missing > 0:
+            best = np.pad(best, ((0, 0), (0, missing)), constant_values=np.inf)
+            best_rows = np.pad(best_rows, ((0, 0), (0, missing)), constant_values=-1)
+        order = np.argsort(best, axis=1, kind='stable')
+        best, best_rows = np.take_along_axis(best, order, 1), np.take_along_axis(best_rows, order, 1)
+        best_rows = np.where(np.isinf(best), -1, best_rows)
+        # The expanded form can dip just below zero for near-identical vectors
+        return best_rows, np.sqrt(np.maximum(best, 0))
@@ -0,0 +1,294 @@
+import numpy as np
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from transaction_store import SECONDS_PER_DAY, TransactionStore, append_to_column
+
+
+# clv_score * CLV_SCALE is an integer, so rankings compare exact values
+CLV_SCALE = 250
+
+# Per-customer average tickets are summed in millionths of a cent
+TICKET_SCALE = 10 ** 6
+
+
+def clv_metrics(total_cents: np.ndarray, num_transactions: np.ndarray,
+                first_purchase: np.ndarray, last_purchase: np.ndarray) -> Tuple[np.ndarray, ...]:
+    """Derived CLV metrics for arrays of (merchant, customer) aggregates.
+
+    Returns (total_spend, months_active, purchase_frequency, clv_units,
+    clv_score), where clv_units = clv_score * CLV_SCALE in int64.
+    """
+    total_spend = total_cents / 100.0
+
+    # Calculate months between first and last purchase
+    days_active = (last_purchase - first_purchase) // SECONDS_PER_DAY
+    months_active = np.maximum(1, days_active / 30.0)
+
+    # Calculate monthly purchase frequency
+    purchase_frequency = num_transactions / months_active
+
+    # CLV score = 0.4 * total_spend        (40% weight on total spend)
+    #           + 0.3 * (transactions * 100) (30% weight on frequency)
+    #           + 0.3 * (months_active * 1000) (30% weight on longevity),
+    # scaled by 250 so that every term is a whole number
+    clv_units = (
+        total_cents +
+        7500 * num_transactions +
+        2500 * np.maximum(30, days_active)
+    ).astype(np.int64)
+    clv_score = clv_units / CLV_SCALE
+    return total_spend, months_active, purchase_frequency, clv_units, clv_score
+
+
+def ticket_units(total_cents: np.ndarray, num_transactions: np.ndarray) -> np.ndarray:
+    """Each pair's average ticket in TICKET_SCALE units of a cent, floored to an integer."""
+    return total_cents * TICKET_SCALE // num_transactions
+
+
+class MerchantCustomerTable:
+    """CLV metrics for every (merchant, customer) pair, materialized at once.
+
+    Pairs are stored grouped by merchant: offsets[m]:offsets[m + 1] is
+    merchant m's slice of every column. ranking holds pair ids in the same
+    slices, ordered by clv_score descending (compared exactly through
+    the integer clv_units).
+
+    Transactions appended later update their pair in place in O(1); pairs
+    first seen after materialization go to the end of the columns and are
+    listed per merchant in extra_pairs.
+
+    Each merchant also keeps its best top_k pair ids in top_pairs. When an
+    append raises a pair's clv_score, the new top-K is within the old
+    top-K plus the updated pair, so it is maintained in O(K). A refund
+    (negative total) can lower a score instead, and then a pair outside
+    a full top-K may belong in it, so the merchant's top-K is rebuilt
+    from its full ranking.
+    """
+
+    TOP_K = 100
+
+    BASE_AGGREGATES = ('merchant', 'customer', 'total_cents', 'num_transactions',
+                       'first_purchase', 'last_purchase', 'gap_days_sum')
+    DERIVED = ('total_spend', 'months_active', 'purchase_frequency', 'clv_units', 'clv_score')
+    AGGREGATES = BASE_AGGREGATES + DERIVED
+
+    def __init__(self, top_k: int = TOP_K):
+        self.top_k = top_k
+        self.merchant = np.empty(0, dtype=np.int32)
+        self.customer = np.empty(0, dtype=np.int32)
+        self.total_cents = np.empty(0, dtype=np.int64)
+        self.num_transactions = np.empty(0, dtype=np.int64)
+        self.first_purchase = np.empty(0, dtype=np.int64)
+        self.last_purchase = np.empty(0, dtype=np.int64)
+        self.gap_days_sum = np.empty(0, dtype=np.int64)  # sum of whole days between consecutive purchases
+        self.total_spend = np.empty(0, dtype=np.float64)
+        self.months_active = np.empty(0, dtype=np.float64)
+        self.purchase_frequency = np.empty(0, dtype=np.float64)
+        self.clv_units = np.empty(0, dtype=np.int64)  # clv_score * CLV_SCALE
+        self.clv_score = np.empty(0, dtype=np.float64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.ranking = np.empty(0, dtype=np.int64)
+        self.top_pairs: Dict[int, List[int]] = {}
+
+        self.extra_pairs: Dict[int, List[int]] = {}
+        self.merchant_versions: Dict[int, int] = {}  # bumped whenever a merchant's pairs change
+        self._pair_ids: Optional[Dict[int, int]] = None
+        self._dirty: Set[int] = set()  # merchants whose base ranking is stale
+        self._reranked: Dict[int, np.ndarray] = {}
+        self._buffers: Dict[str, np.ndarray] = {}
+
+    @classmethod
+    def from_store(cls, store: TransactionStore, top_k: int = TOP_K) -> 'MerchantCustomerTable':
+        """Aggregate every transaction in one sort-and-segment pass."""
+        store.ensure_index()
+        num_merchants = len(store.merchants)
+        rows = store.merchant_rows
+        if len(rows) == 0:
+            return cls.from_aggregates(num_merchants, {}, top_k)
+
+        # merchant_rows is ordered by (merchant, customer, time), so every pair is one segment
+        merchants = store.merchant[rows]
+        customers = store.customer[rows]
+        timestamps = store.timestamp[rows]
+        same_pair = (merchants[1:] == merchants[:-1]) & (customers[1:] == customers[:-1])
+        starts = np.flatnonzero(np.concatenate(([True], ~same_pair)))
+        ends = np.append(starts[1:], len(rows))
+
+        # Gap i sits on the later purchase; the first row of each pair contributes nothing
+        gap_days = np.where(same_pair, np.diff(timestamps) // SECONDS_PER_DAY, 0)
+        return cls.from_aggregates(num_merchants, {
+            'merchant': merchants[starts],
+            'customer': customers[starts],
+            'total_cents': np.add.reduceat(store.total_cents[rows], starts),
+            'num_transactions': ends - starts,
+            'first_purchase': timestamps[starts],
+            'last_purchase': timestamps[ends - 1],
+            'gap_days_sum': np.add.reduceat(np.concatenate(([0], gap_days)), starts),
+        }, top_k)
+
+    @classmethod
+    def from_aggregates(cls, num_merchants: int, aggregates: Dict[str, np.ndarray],
+                        top_k: int = TOP_K) -> 'MerchantCustomerTable':
+        """Build the table from per-pair aggregates computed elsewhere (e.g. pushed down to SQL).
+
+        aggregates holds the BASE_AGGREGATES columns, one entry per pair,
+        sorted by merchant then customer.
+        """
+        table = cls(top_k)
+        table.offsets = np.zeros(num_merchants + 1, dtype=np.int64)
+        if not aggregates or not len(aggregates['merchant']):
+            return table
+        for name in cls.BASE_AGGREGATES:
+            setattr(table, name, np.asarray(aggregates[name], dtype=getattr(table, name).dtype))
+        table._derive()
+        return table
+
+    def _derive(self):
+        """Recompute the derived metric columns, merchant offsets and rankings."""
+        self.total_spend, self.months_active, self.purchase_frequency, self.clv_units, self.clv_score = clv_metrics(
+            self.total_cents, self.num_transactions, self.first_purchase, self.last_purchase
+        )
+        counts = np.bincount(self.merchant, minlength=len(self.offsets) - 1)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.ranking = np.lexsort((-self.clv_units, self.merchant))
+        self.top_pairs = {
+            merchant_code: self.ranking[start:min(start + self.top_k, end)].tolist()
+            for merchant_code, (start, end) in enumerate(zip(self.offsets[:-1], self.offsets[1:]))
+            if end > start
+        }
+
+    @property
+    def num_pairs(self) -> int:
+        return len(self.merchant)
+
+    def _base_pairs(self, merchant_code: int) -> slice:
+        if merchant_code + 1 >= len(self.offsets):
+            return slice(0, 0)
+        return slice(self.offsets[merchant_code], self.offsets[merchant_code + 1])
+
+    def pairs_for_merchant(self, merchant_code: int) -> Union[slice, np.ndarray]:
+        """Pair ids of one merchant's customers, usable as an index into any column."""
+        base = self._base_pairs(merchant_code)
+        extra = self.extra_pairs.get(merchant_code)
+        if not extra:
+            return base
+        return np.concatenate((np.arange(base.start, base.stop), extra))
+
+    def summarize(self, merchant_code: int, now: int, churn_days: int = 30) -> Dict:
+        """Merchant-level insight aggregates, computed together from the merchant's pairs.
+
+        Covers revenue, averages, retention, inter-purchase gaps and churn
+        (no purchase within churn_days of `now`, in epoch seconds), without
+        touching individual transactions. Money is summed in integers
+        (revenue in cents, average tickets in ticket_units), so the totals
+        are exact whatever order pairs are added in.
+        """
+        pairs = self.pairs_for_merchant(merchant_code)
+        num_transactions = self.num_transactions[pairs]
+        total_customers = len(num_transactions)
+        if total_customers == 0:
+            return {'total_customers': 0}
+        days_since_purchase = (now - self.last_purchase[pairs]) // SECONDS_PER_DAY
+        return {
+            'total_customers': total_customers,
+            'revenue_cents': int(self.total_cents[pairs].sum()),
+            'ticket_units_sum': int(ticket_units(self.total_cents[pairs], num_transactions).sum()),
+            'avg_purchase_frequency': np.mean(self.purchase_frequency[pairs]),
+            'repeat_customers': int(np.count_nonzero(num_transactions > 1)),
+            'gap_days_sum': int(self.gap_days_sum[pairs].sum()),
+            'num_gaps': int(num_transactions.sum()) - total_customers,
+            'churned_customers': int(np.count_nonzero(days_since_purchase > churn_days)),
+        }
+
+    def top_ranked_pairs(self, merchant_code: int, limit: int) -> List[int]:
+        """The best `limit` (at most top_k) pair ids of one merchant, in O(limit)."""
+        return self.top_pairs.get(merchant_code, [])[:limit]
+
+    def _update_top(self, merchant_code: int, pair_id: int, previous_score: Optional[int] = None):
+        """Refresh a merchant's top-K after pair_id's score changed from previous_score (None if new)."""
+        top = self.top_pairs.setdefault(merchant_code, [])
+        score = self.clv_units[pair_id]
+        if previous_score is not None and score < previous_score and pair_id in top and len(top) >= self.top_k:
+            # The pair may fall below pairs the list no longer holds; rebuild it from the full ranking
+            self.top_pairs[merchant_code] = self.ranked_pairs(merchant_code)[:self.top_k].tolist()
+            return
+        if pair_id not in top and len(top) >= self.top_k and score < self.clv_units[top[-1]]:
+            return
+        candidates = top if pair_id in top else top + [pair_id]
+        # Ties keep pair order, matching the full ranking
+        candidates = sorted(candidates, key=lambda p: (-self.clv_units[p], p))
+        self.top_pairs[merchant_code] = candidates[:self.top_k]
+
+    def ranked_pairs(self, merchant_code: int) -> np.ndarray:
+        """Pair ids of all of one merchant's customers, best clv_score first."""
+        if merchant_code in self._dirty:
+            pairs = self.pairs_for_merchant(merchant_code)
+            if isinstance(pairs, slice):
+                pairs = np.arange(pairs.start, pairs.stop)
+            self._reranked[merchant_code] = pairs[np.argsort(-self.clv_units[pairs], kind='stable')]
+            self._dirty.discard(merchant_code)
+        if merchant_code in self._reranked:
+            return self._reranked[merchant_code]
+        return self.ranking[self._base_pairs(merchant_code)]
+
+    def _pair_id(self, merchant_code: int, customer_code: int) -> Optional[int]:
+        if self._pair_ids is None:
+            keys = (self.merchant.astype(np.int64) << 32) | self.customer
+            self._pair_ids = dict(zip(keys.tolist(), range(self.num_pairs)))
+        return self._pair_ids.get((merchant_code << 32) | customer_code)
+
+    def _new_pair(self, merchant_code: int, customer_code: int, timestamp: int, total_cents: int) -> int:
+        pair_id = self.num_pairs
+        values = {
+            'merchant': merchant_code, 'customer': customer_code, 'total_cents': total_cents,
+            'num_transactions': 1, 'first_purchase': timestamp, 'last_purchase': timestamp,
+            'gap_days_sum': 0, 'total_spend': 0.0, 'months_active': 0.0,
+            'purchase_frequency': 0.0, 'clv_units': 0, 'clv_score': 0.0,
+        }
+        for name in self.AGGREGATES:
+            setattr(self, name, append_to_column(self._buffers, name, getattr(self, name), [values[name]]))
+        self._pair_ids[(merchant_code << 32) | customer_code] = pair_id
+        self.extra_pairs.setdefault(merchant_code, []).append(pair_id)
+        return pair_id
+
+    def add_transaction(self, store: TransactionStore, row: int) -> int:
+        """Fold one stored transaction into its pair's aggregates; returns its merchant code."""
+        merchant_code = int(store.merchant[row])
+        customer_code = int(store.customer[row])
+        timestamp = int(store.timestamp[row])
+        total_cents = int(store.total_cents[row])
+
+        pair_id = self._pair_id(merchant_code, customer_code)
+        previous_score = None
+        if pair_id is None:
+            pair_id = self._new_pair(merchant_code, customer_code, timestamp, total_cents)
+        else:
+            previous_score = int(self.clv_units[pair_id])
+            self.total_cents[pair_id] += total_cents
+            self.num_transactions[pair_id] += 1
+            first, last = self.first_purchase[pair_id], self.last_purchase[pair_id]
+            if timestamp >= last:
+                self.gap_days_sum[pair_id] += (timestamp - last) // SECONDS_PER_DAY
+                self.last_purchase[pair_id] = timestamp
+            elif timestamp <= first:
+                self.gap_days_sum[pair_id] += (first - timestamp) // SECONDS_PER_DAY
+                self.first_purchase[pair_id] = timestamp
+            else:
+                # A purchase inside the known range splits one gap; rescan this pair only
+                timestamps = store.pair_timestamps(merchant_code, customer_code)
+                self.gap_days_sum[pair_id] = (np.diff(timestamps) // SECONDS_PER_DAY).sum()
+
+        derived = clv_metrics(
+            self.total_cents[pair_id:pair_id + 1], self.num_transactions[pair_id:pair_id + 1],
+            self.first_purchase[pair_id:pair_id + 1], self.last_purchase[pair_id:pair_id + 1]
+        )
+        for name, values in zip(self.DERIVED, derived):
+            getattr(self, name)[pair_id] = values[0]
+        self._dirty.add(merchant_code)
+        self._update_top(merchant_code, pair_id, previous_score)
+        self.merchant_versions[merchant_code] = self.merchant_versions.get(merchant_code, 0) + 1
+        return merchant_code
+
+    def add_rows(self, store: TransactionStore, start: int, end: int) -> Set[int]:
+        """Fold store rows [start, end) into the aggregates; returns the merchant codes touched."""
+        return {self.add_transaction(store, row) for row in range(start, end)}
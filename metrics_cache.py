@@ -0,0 +1,87 @@
+import sys
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+def estimate_size(obj: Any) -> int:
+    """Approximate bytes held by a JSON-like value (dicts, lists, scalars)."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(estimate_size(k) + estimate_size(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(estimate_size(v) for v in obj)
+    return size
+
+
+class MetricsCache:
+    """LRU cache bounded by estimated memory size, with versioned entries.
+
+    Every entry is stored with the version stamp it was computed at; a get
+    with a different stamp treats the entry as stale, drops it and counts
+    a miss. Least recently used entries are evicted once the total size
+    would exceed max_bytes.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries: 'OrderedDict[Hashable, Tuple[Hashable, Any, int]]' = OrderedDict()
+
+    def get(self, key: Hashable, version: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        entry_version, value, size = entry
+        if entry_version != version:
+            self._remove(key)
+            self.invalidations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, version: Hashable, value: Any):
+        size = estimate_size(value)
+        if key in self._entries:
+            self._remove(key)
+        if size > self.max_bytes:
+            return
+        while self.current_bytes + size > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+        self._entries[key] = (version, value, size)
+        self.current_bytes += size
+
+    def _remove(self, key: Hashable):
+        _, _, size = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def clear(self):
+        self._entries.clear()
+        self.current_bytes = 0
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
@@ -5,6 +5,7 @@ from datetime import datetime, timedelta
 import copy
 import os
 import argparse
+from customer_files import CUSTOMER_FILE_SUFFIXES, write_customer_file
 
 class MockTransactionGenerator:
     def __init__(self):
@@ -1195,8 +1196,8 @@ class MockTransactionGenerator:
         
         return customer_files
     
-    def save_customer_files(self, customer_files, output_dir):
-        """Save generated customer files to disk"""
+    def save_customer_files(self, customer_files, output_dir, suffix='.txt'):
+        """Save generated customer files to disk; the suffix picks the format (see customer_files.py)"""
         # Create output directory if it doesn't exist
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
@@ -1204,7 +1205,7 @@ class MockTransactionGenerator:
         # Save each customer's data
         for i, customer in enumerate(customer_files):
             # Use simple numbered filename
-            customer_filename = os.path.join(output_dir, f"{i+1}.txt")
+            customer_filename = os.path.join(output_dir, f"{i+1}{suffix}")
             
             # Combine all transactions from all merchants into one list
             all_transactions = []
@@ -1227,8 +1228,7 @@ class MockTransactionGenerator:
             }
             
             # Save the combined data to a single file
-            with open(customer_filename, 'w') as f:
-                json.dump(combined_data, f, indent=4)
+            write_customer_file(customer_filename, combined_data)
             
             print(f"Generated {len(all_transactions)} transactions for customer {i+1}")
         
@@ -1276,36 +1276,37 @@ class MockTransactionGenerator:
                 self.select_payment_methods_for_customer(persona)
             )
             
-            # Adjust the transaction amount
+            # Adjust the transaction amount, in whole cents
+            splurge_amount = round(splurge_amount, 2)
             splurge_transaction["price"]["total"] = splurge_amount
             splurge_transaction["price"]["sub_total"] = splurge_amount
             for product in splurge_transaction["products"]:
-                product["price"]["total"] = splurge_amount / len(splurge_transaction["products"])
+                product["price"]["total"] = round(splurge_amount / len(splurge_transaction["products"]), 2)
                 product["price"]["sub_total"] = product["price"]["total"]
                 product["price"]["unit_price"] = product["price"]["total"]
             
             transactions.append(splurge_transaction)
 
     def apply_seasonal_patterns(self, transactions):
-        """Add seasonal variations to spending patterns"""
+        """Add seasonal variations to spending patterns (amounts stay in whole cents)"""
         for transaction in transactions:
             month = datetime.strptime(transaction["datetime"], "%Y-%m-%dT%H:%M:%S+00:00").month
             
             # Holiday shopping spikes (Nov-Dec)
             if month in [11, 12]:
-                transaction["price"]["total"] *= random.uniform(1.2, 1.5)
+                transaction["price"]["total"] = round(transaction["price"]["total"] * random.uniform(1.2, 1.5), 2)
                 transaction["price"]["sub_total"] = transaction["price"]["total"]
                 for product in transaction["products"]:
-                    product["price"]["total"] *= random.uniform(1.2, 1.5)
+                    product["price"]["total"] = round(product["price"]["total"] * random.uniform(1.2, 1.5), 2)
                     product["price"]["sub_total"] = product["price"]["total"]
                     product["price"]["unit_price"] = product["price"]["total"]
             
             # Summer spending (Jun-Aug)
             elif month in [6, 7, 8]:
-                transaction["price"]["total"] *= random.uniform(1.1, 1.3)
+                transaction["price"]["total"] = round(transaction["price"]["total"] * random.uniform(1.1, 1.3), 2)
                 transaction["price"]["sub_total"] = transaction["price"]["total"]
                 for product in transaction["products"]:
-                    product["price"]["total"] *= random.uniform(1.1, 1.3)
+                    product["price"]["total"] = round(product["price"]["total"] * random.uniform(1.1, 1.3), 2)
                     product["price"]["sub_total"] = product["price"]["total"]
                     product["price"]["unit_price"] = product["price"]["total"]
 
@@ -1316,6 +1317,9 @@ def main():
     parser.add_argument('--customers', type=int, default=5, help='Number of customers to generate')
     parser.add_argument('--transactions', type=int, default=200, help='Approximate transactions per customer')
     parser.add_argument('--outdir', type=str, default='mock_data', help='Output directory')
+    parser.add_argument('--format', type=str, default='.txt', choices=CUSTOMER_FILE_SUFFIXES,
+                        help='File extension, which picks the format: .txt is indented JSON, '
+                             '.json.gz/.ndjson.zst etc. are compact and compressed')
     args = parser.parse_args()
     
     # Create the transaction generator
@@ -1325,7 +1329,7 @@ def main():
     customer_files = generator.generate_diverse_customers(args.customers, args.transactions)
     
     # Save the files
-    generator.save_customer_files(customer_files, args.outdir)
+    generator.save_customer_files(customer_files, args.outdir, args.format)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,267 @@
+import numpy as np
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sketches import HyperLogLog, TDigest
+from transaction_store import TransactionStore
+
+
+def month_starts(months: np.ndarray) -> np.ndarray:
+    """Epoch seconds at the start of each month, for months counted from 1970-01."""
+    return months.astype('datetime64[M]').astype('datetime64[s]').astype(np.int64)
+
+
+class MonthlyPartitions:
+    """The store's rows partitioned by calendar month, with per-merchant summaries.
+
+    rows holds every partitioned row id grouped by month, then merchant,
+    then customer; partition p is rows[offsets[p]:offsets[p + 1]], and
+    merchant m's slice of it starts at merchant_offsets[p, m]. For every
+    (partition, merchant) the transaction count, revenue and distinct
+    customer count are precomputed; a HyperLogLog of its customers and a
+    t-digest of its transaction values are built on first use by
+    window_sketches(), so distinct counts and percentiles over a window
+    merge across months instead of collecting the window's rows. Those
+    cell sketches are keyed by calendar month and updated by extend(), so
+    they are built from a cell's rows only once.
+
+    Queries over a time window skip partitions outside it entirely, use
+    the summaries of partitions fully inside it, and only look at rows of
+    the (at most two) partitions its edges cut through. Rows appended to
+    the store after the partitions were built are scanned as a tail until
+    extend() folds them in; extend() rebuilds only the months those rows
+    fall in, so older partitions and their summaries are never recomputed.
+    """
+
+    def __init__(self, store: TransactionStore, sketch_precision: int = 12):
+        self.store = store
+        self.sketch_precision = sketch_precision
+        # (month, merchant) -> {'customers': HyperLogLog, 'spend': TDigest of dollars}
+        self._cell_sketches: Dict[Tuple[int, int], Dict] = {}
+        self.num_merchants = len(store.merchants)
+        self.months = np.empty(0, dtype=np.int64)  # months since 1970-01, one per partition
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.rows = np.empty(0, dtype=np.int64)
+        self.merchant_offsets = np.zeros((0, self.num_merchants + 1), dtype=np.int64)
+        self.transactions = np.zeros((0, self.num_merchants), dtype=np.int64)
+        self.revenue_cents = np.zeros((0, self.num_merchants), dtype=np.int64)
+        self.customers = np.zeros((0, self.num_merchants), dtype=np.int64)
+        self.num_rows = 0
+        self.extend()
+
+    def _partition(self, rows: np.ndarray) -> Dict[str, np.ndarray]:
+        """Partition arrays for a set of row ids."""
+        store = self.store
+        row_months = store.datetimes[rows].astype('datetime64[M]').astype(np.int64)
+        order = np.lexsort((store.customer[rows], store.merchant[rows], row_months))
+        rows, row_months = rows[order], row_months[order]
+        merchants = store.merchant[rows]
+        customers = store.customer[rows]
+
+        months, starts = np.unique(row_months, return_index=True)
+        month_index = np.searchsorted(months, row_months)
+        cell = month_index * self.num_merchants + merchants
+        size = len(months) * self.num_merchants
+        transactions = np.bincount(cell, minlength=size)
+
+        # Rows are sorted by (month, merchant, customer): cells and customers come in runs
+        new_cell = np.ones(len(rows), dtype=bool)
+        new_cell[1:] = cell[1:] != cell[:-1]
+        cell_starts = np.flatnonzero(new_cell)
+        revenue_cents = np.zeros(size, dtype=np.int64)
+        revenue_cents[cell[cell_starts]] = np.add.reduceat(store.total_cents[rows], cell_starts) if len(rows) else 0
+        new_customer = new_cell.copy()
+        new_customer[1:] |= customers[1:] != customers[:-1]
+        customers_per_cell = np.bincount(cell[new_customer], minlength=size)
+
+        shape = (len(months), self.num_merchants)
+        within = np.cumsum(transactions.reshape(shape), axis=1)
+        merchant_offsets = np.hstack((np.zeros((len(months), 1), dtype=np.int64), within)) + starts[:, None]
+        return {
+            'months': months,
+            'offsets': np.append(starts, len(rows)),
+            'rows': rows,
+            'merchant_offsets': merchant_offsets,
+            'transactions': transactions.reshape(shape),
+            'revenue_cents': revenue_cents.reshape(shape),
+            'customers': customers_per_cell.reshape(shape),
+        }
+
+    def extend(self):
+        """Fold rows appended to the store since the last call into their partitions."""
+        store = self.store
+        if len(store.merchants) != self.num_merchants:
+            pad = len(store.merchants) - self.num_merchants
+            self.num_merchants = len(store.merchants)
+            for name in ('transactions', 'revenue_cents', 'customers'):
+                setattr(self, name, np.pad(getattr(self, name), ((0, 0), (0, pad))))
+            self.merchant_offsets = np.pad(self.merchant_offsets, ((0, 0), (0, pad)), mode='edge')
+        if store.num_transactions == self.num_rows:
+            return
+
+        # Partitions before the earliest new month are untouched; later ones are rebuilt with the new rows
+        tail = np.arange(self.num_rows, store.num_transactions)
+        first_month = store.datetimes[tail].astype('datetime64[M]').astype(np.int64).min()
+        keep = int(np.searchsorted(self.months, first_month))
+        rebuilt = self._partition(np.concatenate((self.rows[self.offsets[keep]:], tail)))
+
+        kept_rows = self.offsets[keep]
+        self.months = np.concatenate((self.months[:keep], rebuilt['months']))
+        self.offsets = np.concatenate((self.offsets[:keep], rebuilt['offsets'] + kept_rows))
+        self.rows = np.concatenate((self.rows[:kept_rows], rebuilt['rows']))
+        self.merchant_offsets = np.vstack((self.merchant_offsets[:keep], rebuilt['merchant_offsets'] + kept_rows))
+        for name in ('transactions', 'revenue_cents', 'customers'):
+            setattr(self, name, np.vstack((getattr(self, name)[:keep], rebuilt[name])))
+        self.num_rows = store.num_transactions
+
+        # Fold the new rows into the cell sketches built so far; cells of months not yet sketched wait for first use
+        if self._cell_sketches:
+            tail_cells = store.datetimes[tail].astype('datetime64[M]').astype(np.int64) * self.num_merchants + \
+                store.merchant[tail]
+            order = np.argsort(tail_cells, kind='stable')
+            cells, starts = np.unique(tail_cells[order], return_index=True)
+            for cell, rows in zip(cells.tolist(), np.split(tail[order], starts[1:])):
+                sketches = self._cell_sketches.get(divmod(cell, self.num_merchants))
+                if sketches is not None:
+                    self._add_rows(sketches, rows)
+
+    @property
+    def num_partitions(self) -> int:
+        return len(self.months)
+
+    def partition_bounds(self, partition: int) -> Tuple[int, int]:
+        """[start, end) of a partition in epoch seconds."""
+        start, end = month_starts(self.months[partition] + np.array([0, 1]))
+        return int(start), int(end)
+
+    def _merchant_rows(self, partition: int, merchant_code: int) -> np.ndarray:
+        return self.rows[self.merchant_offsets[partition, merchant_code]:self.merchant_offsets[partition, merchant_code + 1]]
+
+    def _tail_rows(self, merchant_code: int, since: Optional[int], until: Optional[int]) -> np.ndarray:
+        """Rows appended since the last extend() that match a merchant and window."""
+        store = self.store
+        tail = np.arange(self.num_rows, store.num_transactions)
+        mask = store.merchant[tail] == merchant_code
+        if since is not None:
+            mask &= store.timestamp[tail] >= since
+        if until is not None:
+            mask &= store.timestamp[tail] < until
+        return tail[mask]
+
+    def _window_cells(self, merchant_code: int, since: Optional[int],
+                      until: Optional[int]) -> Iterator[Tuple[int, bool, np.ndarray]]:
+        """(partition, inside, rows) for every partition holding a merchant's rows in a window.
+
+        inside is True when the whole partition lies in the window (its
+        summaries apply as they are); otherwise rows are already filtered
+        to the window.
+        """
+        starts, ends = month_starts(self.months), month_starts(self.months + 1)
+        lo = 0 if since is None else int(np.searchsorted(ends, since, side='right'))
+        hi = self.num_partitions if until is None else int(np.searchsorted(starts, until, side='left'))
+        if not 0 <= merchant_code < self.num_merchants:
+            return  # only the tail can hold a merchant first seen after the last extend()
+        for partition in range(lo, hi):
+            rows = self._merchant_rows(partition, merchant_code)
+            if not len(rows):
+                continue
+            if (since is None or starts[partition] >= since) and (until is None or ends[partition] <= until):
+                yield partition, True, rows
+                continue
+            timestamps = self.store.timestamp[rows]
+            mask = np.ones(len(rows), dtype=bool)
+            if since is not None:
+                mask &= timestamps >= since
+            if until is not None:
+                mask &= timestamps < until
+            yield partition, False, rows[mask]
+
+    def window(self, merchant_code: int, since: Optional[int] = None, until: Optional[int] = None,
+               distinct: bool = True) -> Dict:
+        """One merchant's activity with since <= timestamp < until (epoch seconds, either open).
+
+        Returns transactions, revenue_cents, active_customers (distinct;
+        None when distinct is False, which skips gathering the window's
+        customers) and partitions_scanned (partitions whose rows had to be
+        filtered).
+        """
+        store = self.store
+        transactions, revenue_cents, scanned = 0, 0, 0
+        customers: List[np.ndarray] = []
+        for partition, inside, rows in self._window_cells(merchant_code, since, until):
+            if inside:
+                # Entirely inside the window: the summaries already have the answer
+                transactions += int(self.transactions[partition, merchant_code])
+                revenue_cents += int(self.revenue_cents[partition, merchant_code])
+            else:
+                transactions += len(rows)
+                revenue_cents += int(store.total_cents[rows].sum())
+                scanned += 1
+            if distinct:
+                customers.append(store.customer[rows])
+
+        tail = self._tail_rows(merchant_code, since, until)
+        transactions += len(tail)
+        revenue_cents += int(store.total_cents[tail].sum())
+        customers.append(store.customer[tail])
+
+        return {
+            'transactions': transactions,
+            'revenue_cents': revenue_cents,
+            'active_customers': len(np.unique(np.concatenate(customers))) if distinct else None,
+            'partitions_scanned': scanned,
+        }
+
+    def _new_sketches(self) -> Dict:
+        return {'customers': HyperLogLog(self.sketch_precision), 'spend': TDigest()}
+
+    def _add_rows(self, sketches: Dict, rows: np.ndarray):
+        sketches['customers'].add(self.store.customer_hashes()[self.store.customer[rows]])
+        sketches['spend'].add(self.store.total_cents[rows] / 100.0)
+
+    def _cell_sketch(self, partition: int, merchant_code: int) -> Dict:
+        """Customer HyperLogLog and spend t-digest of one (partition, merchant), built on first use."""
+        cell = (int(self.months[partition]), merchant_code)
+        sketches = self._cell_sketches.get(cell)
+        if sketches is None:
+            sketches = self._cell_sketches[cell] = self._new_sketches()
+            self._add_rows(sketches, self._merchant_rows(partition, merchant_code))
+        return sketches
+
+    def window_sketches(self, merchant_code: int, since: Optional[int] = None,
+                        until: Optional[int] = None) -> Dict:
+        """Sketches of a merchant's rows with since <= timestamp < until.
+
+        customers is a HyperLogLog of its distinct customers and spend a
+        t-digest of its transaction values in dollars. Partitions fully
+        inside the window contribute their cached cell sketches, so a long
+        window costs one merge per month instead of a pass over its rows.
+        """
+        result = self._new_sketches()
+        for partition, inside, rows in self._window_cells(merchant_code, since, until):
+            if inside:
+                cell = self._cell_sketch(partition, merchant_code)
+                result['customers'].merge(cell['customers'])
+                result['spend'].merge(cell['spend'])
+            else:
+                self._add_rows(result, rows)
+        self._add_rows(result, self._tail_rows(merchant_code, since, until))
+        return result
+
+    def monthly_summary(self, merchant_code: int) -> List[Dict]:
+        """Per-month transactions, revenue and distinct customers for one merchant, from the summaries alone.
+
+        Call extend() first if rows were appended since the partitions were built.
+        """
+        if merchant_code < 0 or merchant_code >= self.num_merchants:
+            return []
+        labels = np.datetime_as_string(self.months.astype('datetime64[M]')).tolist()
+        return [
+            {
+                'month': label,
+                'transactions': int(self.transactions[p, merchant_code]),
+                'revenue_cents': int(self.revenue_cents[p, merchant_code]),
+                'customers': int(self.customers[p, merchant_code]),
+            }
+            for p, label in enumerate(labels)
+            if self.transactions[p, merchant_code]
+        ]
@@ -10,6 +10,9 @@ const cors = require('cors');
 
 const app = express();
 const PORT = process.env.PORT || 3000;
+const ANALYTICS_API_URL = process.env.ANALYTICS_API_URL || 'http://localhost:5001';
+// Shared secret the analytics API requires on forwarded transactions (its CLV_INGEST_TOKEN)
+const CLV_INGEST_TOKEN = process.env.CLV_INGEST_TOKEN || '';
 
 // Set your Knot credentials via environment variables or replace the placeholders.
 const KNOT_CLIENT_ID = process.env.KNOT_CLIENT_ID;
@@ -36,6 +39,8 @@ const db = new sqlite3.Database('./transactions.db', (err) => {
   if (err) {
     console.error("Error opening database:", err.message);
   } else {
+    // WAL lets the Python analytics backend read this file while we keep writing
+    db.run(`PRAGMA journal_mode=WAL`);
     db.run(`CREATE TABLE IF NOT EXISTS transactions (
       id INTEGER PRIMARY KEY AUTOINCREMENT,
       transactionId TEXT,
@@ -48,9 +53,12 @@ const db = new sqlite3.Database('./transactions.db', (err) => {
       products TEXT,
       merchantId TEXT,
       merchantName TEXT,
-      rawData TEXT
+      rawData TEXT,
+      externalUserId TEXT
       )`, (err) => {
         if (err) console.error("Error creating transactions table:", err.message);
+        // Databases created before externalUserId existed get the column added
+        db.run(`ALTER TABLE transactions ADD COLUMN externalUserId TEXT`, () => {});
       });
     }
 });
@@ -178,8 +186,8 @@ app.post('/webhook', async (req, res) => {
         for (const txn of allTransactions) {
           db.run(
             `INSERT INTO transactions (
-              transactionId, externalId, datetime, url, orderStatus, paymentMethods, price, products, merchantId, merchantName, rawData
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)`,
+              transactionId, externalId, datetime, url, orderStatus, paymentMethods, price, products, merchantId, merchantName, rawData, externalUserId
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)`,
             [
               txn.id,
               txn.external_id || null,
@@ -191,7 +199,8 @@ app.post('/webhook', async (req, res) => {
               JSON.stringify(txn.products || []),
               merchantAccountId,
               merchant.name || null,
-              JSON.stringify(txn)
+              JSON.stringify(txn),
+              external_user_id || null
             ],
             (err) => {
               if (err) console.error("Error inserting transaction:", err);
@@ -199,6 +208,20 @@ app.post('/webhook', async (req, res) => {
           );
         }  
   
+        // Forward the batch to the Python analytics API so rankings update without a reload.
+        try {
+          const analyticsResponse = await fetch(`${ANALYTICS_API_URL}/api/transactions`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json', 'X-Ingest-Token': CLV_INGEST_TOKEN },
+            body: JSON.stringify({ external_user_id, transactions: allTransactions })
+          });
+          if (!analyticsResponse.ok) {
+            console.error("Error from analytics API:", await analyticsResponse.text());
+          }
+        } catch (err) {
+          console.error("Error forwarding transactions to analytics API:", err);
+        }
+  
         console.log(`Synced ${allTransactions.length} transactions for merchant ${merchantAccountId}`);
         return res.json({ message: "Transactions synced", count: allTransactions.length });
       } else {
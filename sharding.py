@@ -0,0 +1,269 @@
+import argparse
+import heapq
+import json
+import multiprocessing
+import time
+import zlib
+from functools import reduce
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import ingest
+from clv_analyzer import CLVAnalyzer
+from merchant_table import TICKET_SCALE, ticket_units
+from sketches import TDigest
+from transaction_store import SECONDS_PER_DAY
+
+CHURN_DAYS = 30
+TOP_CUSTOMERS = 5
+
+# Fields of a merchant partial that merge by plain addition
+SUMMED_FIELDS = ('customers', 'transactions', 'revenue_cents', 'ticket_units_sum', 'frequency_sum',
+                 'repeat_customers', 'gap_days_sum', 'churned_customers',
+                 'recent_transactions', 'recent_revenue_cents', 'recent_customers')
+# Fields holding t-digests, merged with TDigest.merge
+DIGEST_FIELDS = ('spend', 'clv')
+
+
+def shard_of(customer_id: str, num_shards: int) -> int:
+    """Stable shard for a customer id, the same in every process and on every run."""
+    return zlib.crc32(customer_id.encode('utf-8')) % num_shards
+
+
+def merchant_partial(analyzer: CLVAnalyzer, merchant_id: str, now: int, top_k: int) -> Dict:
+    """One shard's mergeable aggregates for a merchant.
+
+    Shards own disjoint customers, so every field merges across shards by
+    addition, min/max or a top-K merge (see merge_partials); percentiles
+    can't be added up, so they travel as t-digests and are read off the
+    merged digest.
+    """
+    merchant_code = analyzer.store.merchants.lookup(merchant_id.lower())
+    empty = {name: 0 for name in SUMMED_FIELDS}
+    empty.update({name: TDigest() for name in DIGEST_FIELDS})
+    empty.update({'first_purchase': None, 'last_purchase': None, 'top_k': top_k, 'top': []})
+    if merchant_code < 0:
+        return empty
+
+    table = analyzer.table
+    pairs = table.pairs_for_merchant(merchant_code)
+    num_transactions = table.num_transactions[pairs]
+    if not len(num_transactions):
+        return empty
+    last_purchase = table.last_purchase[pairs]
+    # Exact cents from the window path, so shard merges stay integer additions
+    recent = analyzer._window_activity(merchant_code, now - analyzer.RECENT_ACTIVITY_DAYS * SECONDS_PER_DAY, None)
+    sketches = analyzer.merchant_sketches(merchant_id)
+    return {
+        'customers': len(num_transactions),
+        'transactions': int(num_transactions.sum()),
+        'revenue_cents': int(table.total_cents[pairs].sum()),
+        'ticket_units_sum': int(ticket_units(table.total_cents[pairs], num_transactions).sum()),
+        'frequency_sum': float(table.purchase_frequency[pairs].sum()),
+        'repeat_customers': int(np.count_nonzero(num_transactions > 1)),
+        'gap_days_sum': int(table.gap_days_sum[pairs].sum()),
+        'churned_customers': int(np.count_nonzero((now - last_purchase) // SECONDS_PER_DAY > CHURN_DAYS)),
+        'recent_transactions': recent['transactions'],
+        'recent_revenue_cents': recent['revenue_cents'],
+        'recent_customers': recent['active_customers'],
+        'spend': sketches['spend'],
+        'clv': sketches['clv'],
+        'first_purchase': int(table.first_purchase[pairs].min()),
+        'last_purchase': int(last_purchase.max()),
+        'top_k': top_k,
+        'top': analyzer.get_merchant_customer_rankings(merchant_id, limit=top_k),
+    }
+
+
+def merge_partials(a: Dict, b: Dict) -> Dict:
+    """Combine two merchant partials; associative and commutative up to ties in the top-K."""
+    merged = {name: a[name] + b[name] for name in SUMMED_FIELDS}
+    for name in DIGEST_FIELDS:
+        merged[name] = TDigest(a[name].compression).merge(a[name]).merge(b[name])
+    firsts = [p['first_purchase'] for p in (a, b) if p['first_purchase'] is not None]
+    lasts = [p['last_purchase'] for p in (a, b) if p['last_purchase'] is not None]
+    merged['first_purchase'] = min(firsts) if firsts else None
+    merged['last_purchase'] = max(lasts) if lasts else None
+    merged['top_k'] = min(a['top_k'], b['top_k'])
+    merged['top'] = heapq.nlargest(merged['top_k'], a['top'] + b['top'], key=lambda c: c['clv_score'])
+    return merged
+
+
+def finalize_insights(partial: Dict, merchant_id: str, recent_days: int) -> Dict:
+    """Turn a fully merged partial into the get_merchant_insights response."""
+    total_customers = partial['customers']
+    if not total_customers:
+        return {}
+    num_gaps = partial['transactions'] - total_customers
+    quantiles = [p / 100 for p in CLVAnalyzer.PERCENTILES]
+    percentiles = {
+        name: dict(zip([f'p{p}' for p in CLVAnalyzer.PERCENTILES],
+                       np.round(partial[name].quantiles(quantiles), 2).tolist()))
+        for name in DIGEST_FIELDS
+    }
+    return {
+        'merchant_id': merchant_id,
+        'total_customers': total_customers,
+        'total_revenue': partial['revenue_cents'] / 100.0,
+        'average_transaction_value': partial['ticket_units_sum'] / total_customers / (100 * TICKET_SCALE),
+        'average_purchase_frequency': partial['frequency_sum'] / total_customers,
+        'spend_percentiles': percentiles['spend'],
+        'clv_percentiles': percentiles['clv'],
+        'approximate': True,
+        'retention_metrics': {
+            'retention_rate': round(partial['repeat_customers'] / total_customers * 100, 2),
+            'repeat_customers': partial['repeat_customers'],
+            'avg_time_between_purchases': round(partial['gap_days_sum'] / num_gaps, 1) if num_gaps else 0,
+            'churn_rate': round(partial['churned_customers'] / total_customers * 100, 2),
+            'churned_customers': partial['churned_customers']
+        },
+        'recent_activity': {
+            'window_days': recent_days,
+            'transactions': partial['recent_transactions'],
+            'revenue': partial['recent_revenue_cents'] / 100.0,
+            'active_customers': partial['recent_customers']
+        },
+        'top_customers': partial['top']
+    }
+
+
+def _serve_shard(conn):
+    """Shard process main loop: one CLVAnalyzer over this shard's customers, driven by commands."""
+    analyzer = CLVAnalyzer()
+
+    def load(partials: List[Dict]) -> int:
+        analyzer.load_partials(partials)
+        return analyzer.store.num_transactions
+
+    handlers = {
+        'load': load,
+        'append': analyzer.append_transactions,
+        'partial': lambda merchant_id, now, top_k: merchant_partial(analyzer, merchant_id, now, top_k),
+        'rankings': analyzer.get_merchant_customer_rankings,
+        'merchants': lambda: list(analyzer.store.merchants.values),
+        'stats': lambda: {'transactions': analyzer.store.num_transactions,
+                          'customers': analyzer.store.num_loaded_customers,
+                          'nbytes': analyzer.store.nbytes},
+    }
+    while True:
+        command, args = conn.recv()
+        if command == 'close':
+            conn.close()
+            return
+        try:
+            conn.send(('ok', handlers[command](*args)))
+        except Exception as e:
+            conn.send(('error', f"{type(e).__name__}: {e}"))
+
+
+class ShardedAnalyzer:
+    """CLVAnalyzer's query API over customers hash-partitioned across shard processes.
+
+    Each shard is a long-lived process holding a CLVAnalyzer for the
+    customers that shard_of() maps to it, so memory and CPU scale with
+    the number of shards. Queries are broadcast to every shard at once;
+    each answers with a small partial (sums, counts, min/max dates, gap
+    sums, its own top-K) and the partials are merged here. Shards only
+    exchange picklable commands over a connection, so local processes
+    stand in for separate nodes.
+    """
+
+    def __init__(self, num_shards: int = 4):
+        self.num_shards = num_shards
+        context = ingest._pool_context() or multiprocessing.get_context()
+        self._connections = []
+        self._processes = []
+        for _ in range(num_shards):
+            parent, child = context.Pipe()
+            process = context.Process(target=_serve_shard, args=(child,), daemon=True)
+            process.start()
+            child.close()
+            self._connections.append(parent)
+            self._processes.append(process)
+
+    def _call(self, command: str, shard_args: Dict[int, tuple]) -> List:
+        """Send a command to several shards at once, then collect their replies in shard order."""
+        for shard, args in shard_args.items():
+            self._connections[shard].send((command, args))
+        results = []
+        for shard in shard_args:
+            status, result = self._connections[shard].recv()
+            if status == 'error':
+                raise RuntimeError(f"shard {shard}: {result}")
+            results.append(result)
+        return results
+
+    def _broadcast(self, command: str, *args) -> List:
+        return self._call(command, {shard: args for shard in range(self.num_shards)})
+
+    def load_data(self, data_dir: str = 'data', workers: Optional[int] = None) -> Dict:
+        """Parse data_dir (in a process pool) and hand each shard its customers' partials."""
+        start = time.perf_counter()
+        partials, _ = ingest.parse_customer_files(ingest.list_customer_files(data_dir), workers)
+        by_shard = [[] for _ in range(self.num_shards)]
+        for partial in partials:
+            if 'error' in partial:
+                print(f"Error reading {partial['filename']}")
+                continue
+            ingest.report_invalid(partial)
+            by_shard[shard_of(partial['customer_id'], self.num_shards)].append(partial)
+        rows = self._call('load', {shard: (shard_partials,) for shard, shard_partials in enumerate(by_shard)})
+        return {'shards': self.num_shards, 'rows_per_shard': rows, 'wall_seconds': time.perf_counter() - start}
+
+    def append_transactions(self, customer_id: str, transactions: List[Dict]) -> int:
+        return self._call('append', {shard_of(customer_id, self.num_shards): (customer_id, transactions)})[0]
+
+    def merchants(self) -> List[str]:
+        return sorted(set().union(*self._broadcast('merchants')))
+
+    def get_merchant_insights(self, merchant_id: str, now: Optional[int] = None) -> Dict:
+        now = int(time.time()) if now is None else now
+        partials = self._broadcast('partial', merchant_id, now, TOP_CUSTOMERS)
+        return finalize_insights(reduce(merge_partials, partials), merchant_id, CLVAnalyzer.RECENT_ACTIVITY_DAYS)
+
+    def get_merchant_customer_rankings(self, merchant_id: str, limit: Optional[int] = None) -> List[Dict]:
+        """Global ranking: every shard's own top `limit`, merged."""
+        rankings = [r for shard_rankings in self._broadcast('rankings', merchant_id, limit) for r in shard_rankings]
+        rankings.sort(key=lambda c: c['clv_score'], reverse=True)
+        return rankings if limit is None else rankings[:limit]
+
+    def stats(self) -> List[Dict]:
+        return self._broadcast('stats')
+
+    def close(self):
+        for connection in self._connections:
+            connection.send(('close', ()))
+            connection.close()
+        for process in self._processes:
+            process.join()
+
+    def __enter__(self) -> 'ShardedAnalyzer':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the CLV analyzer as local hash-sharded processes')
+    parser.add_argument('--data-dir', type=str, default='data', help='Customer data directory')
+    parser.add_argument('--shards', type=int, default=4, help='Number of shard processes')
+    parser.add_argument('--merchant', type=str, help='Print insights for one merchant')
+    args = parser.parse_args()
+
+    with ShardedAnalyzer(args.shards) as sharded:
+        load = sharded.load_data(args.data_dir)
+        print(f"Loaded {sum(load['rows_per_shard'])} transactions into {args.shards} shards "
+              f"{load['rows_per_shard']} in {load['wall_seconds']:.2f}s")
+        merchants = [args.merchant] if args.merchant else sharded.merchants()
+        start = time.perf_counter()
+        insights = {merchant: sharded.get_merchant_insights(merchant) for merchant in merchants}
+        elapsed = time.perf_counter() - start
+        if args.merchant:
+            print(json.dumps(insights[args.merchant], indent=2))
+        print(f"{len(merchants)} merchant insights in {elapsed * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
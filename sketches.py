@@ -0,0 +1,152 @@
+import hashlib
+import math
+import numpy as np
+from typing import Iterable, Optional, Sequence
+
+
+def hash64(values: Iterable[str]) -> np.ndarray:
+    """Stable 64-bit hashes of strings (the same in every process), as uint64."""
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little') for value in values),
+        dtype=np.uint64
+    )
+
+
+def bit_length(values: np.ndarray) -> np.ndarray:
+    """int.bit_length() of every element of a uint64 array, exactly (no float rounding)."""
+    values = values.astype(np.uint64)
+    lengths = np.zeros(len(values), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = values >= np.uint64(1 << shift)
+        lengths[high] += shift
+        values[high] >>= np.uint64(shift)
+    return lengths + (values > 0)
+
+
+class HyperLogLog:
+    """Distinct-count estimate over 64-bit hashes in 2**precision one-byte registers.
+
+    The top `precision` bits of a hash pick a register, which keeps the
+    longest run of leading zeros (plus one) seen in the remaining bits.
+    The relative error is about 1.04 / sqrt(2**precision), 1.6% at the
+    default precision, whatever the number of distinct values. Two
+    sketches of the same precision merge by taking register-wise maxima,
+    so counts over disjoint shards or months combine without double
+    counting values they share.
+    """
+
+    def __init__(self, precision: int = 12):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add(self, hashes: np.ndarray):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if not len(hashes):
+            return
+        suffix_bits = 64 - self.precision
+        index = (hashes >> np.uint64(suffix_bits)).astype(np.int64)
+        rank = suffix_bits - bit_length(hashes & np.uint64((1 << suffix_bits) - 1)) + 1
+        # Highest rank per register: sort by (register, rank) and keep each register's last entry
+        packed = np.sort((index << 8) | rank)
+        last = np.append(packed[1:] >> 8 != packed[:-1] >> 8, True)
+        index, rank = packed[last] >> 8, (packed[last] & 0xFF).astype(np.uint8)
+        self.registers[index] = np.maximum(self.registers[index], rank)
+
+    def merge(self, other: 'HyperLogLog') -> 'HyperLogLog':
+        """Fold another sketch into this one; returns self."""
+        if other.precision != self.precision:
+            raise ValueError(f"cannot merge HyperLogLog precisions {self.precision} and {other.precision}")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self) -> float:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / float(np.sum(np.ldexp(1.0, -self.registers.astype(np.int64))))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # Small cardinalities: linear counting over the empty registers is more accurate
+            return m * math.log(m / zeros)
+        return estimate
+
+    def __len__(self) -> int:
+        return int(round(self.count()))
+
+    def __sizeof__(self) -> int:
+        return object.__sizeof__(self) + self.registers.nbytes
+
+
+class TDigest:
+    """Mergeable quantile sketch: weighted centroids, fine near the tails and coarse in the middle.
+
+    Values are kept as (mean, weight) centroids. Up to `compression`
+    centroids are kept as they are, so small inputs stay exact; past
+    that, the sorted centroids are grouped by which unit of the k1 scale
+    function, compression / (2 pi) * asin(2q - 1), their quantile falls
+    in. That leaves about compression / 2 centroids, and the ones near
+    q = 0 and q = 1 hold very few values each. Merging two digests is
+    compressing their centroids together, so digests built over shards or
+    time ranges combine into the digest of their union.
+    """
+
+    def __init__(self, compression: int = 200):
+        self.compression = compression
+        self.means = np.empty(0, dtype=np.float64)
+        self.weights = np.empty(0, dtype=np.float64)
+        self.min = math.inf
+        self.max = -math.inf
+
+    @property
+    def count(self) -> float:
+        return float(self.weights.sum())
+
+    def add(self, values: np.ndarray, weights: Optional[np.ndarray] = None):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if not len(values):
+            return
+        weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=np.float64)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self._compress(np.concatenate((self.means, values)), np.concatenate((self.weights, weights)))
+
+    def merge(self, other: 'TDigest') -> 'TDigest':
+        """Fold another digest into this one; returns self."""
+        if len(other.means):
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self._compress(np.concatenate((self.means, other.means)), np.concatenate((self.weights, other.weights)))
+        return self
+
+    def _compress(self, means: np.ndarray, weights: np.ndarray):
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        if len(means) <= self.compression:
+            self.means, self.weights = means, weights
+            return
+        cumulative = np.cumsum(weights)
+        q = (cumulative - weights / 2) / cumulative[-1]
+        # q is non-decreasing, so equal k buckets are contiguous runs
+        k = np.floor(self.compression / (2 * math.pi) * np.arcsin(2 * q - 1))
+        starts = np.flatnonzero(np.concatenate(([True], k[1:] != k[:-1])))
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def quantiles(self, qs: Sequence[float]) -> np.ndarray:
+        """Estimated values at quantiles qs (0..1), interpolated between centroid centres."""
+        if not len(self.means):
+            return np.full(len(qs), np.nan)
+        cumulative = np.cumsum(self.weights)
+        total = cumulative[-1]
+        centres = cumulative - self.weights / 2
+        # Pin the ends to the exact min and max, matching np.percentile at q = 0 and q = 1
+        return np.interp(
+            np.asarray(qs, dtype=np.float64) * (total - 1) + 0.5,
+            np.concatenate(([0.5], centres, [total - 0.5])),
+            np.concatenate(([self.min], self.means, [self.max]))
+        )
+
+    def quantile(self, q: float) -> float:
+        return float(self.quantiles([q])[0])
+
+    def __sizeof__(self) -> int:
+        return object.__sizeof__(self) + self.means.nbytes + self.weights.nbytes
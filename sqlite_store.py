@@ -0,0 +1,337 @@
+import itertools
+import json
+import os
+import sqlite3
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import ingest
+from dedup import NO_KEY, BloomFilter, first_occurrences
+from merchant_table import MerchantCustomerTable
+from transaction_store import SECONDS_PER_DAY, StringTable, TransactionStore
+
+# Table server.js writes synced Knot transactions to, in the same database file
+KNOT_TABLE = 'transactions'
+KNOT_SOURCE = 'knot'
+
+# Lookup tables behind the store's string tables; ids are the store's codes
+LOOKUP_TABLES = {
+    'customers': 'clv_customers',
+    'merchants': 'clv_merchants',
+    'statuses': 'clv_statuses',
+    'brands': 'clv_brands',
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clv_customers (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS clv_merchants (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS clv_statuses (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS clv_brands (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS clv_sources (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,  -- data file name, or 'knot' for the sync server's table
+    sha256 TEXT,                -- content hash of an ingested data file
+    last_row INTEGER,           -- highest Knot row id ingested
+    size INTEGER,               -- data file size and mtime when last hashed; a match skips hashing
+    mtime_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS clv_transactions (
+    customer_id INTEGER NOT NULL REFERENCES clv_customers (id),
+    merchant_id INTEGER NOT NULL REFERENCES clv_merchants (id),
+    timestamp INTEGER NOT NULL,  -- epoch seconds
+    total_cents INTEGER NOT NULL,
+    status_id INTEGER NOT NULL REFERENCES clv_statuses (id),
+    brand_id INTEGER NOT NULL REFERENCES clv_brands (id),
+    source_id INTEGER NOT NULL REFERENCES clv_sources (id),
+    txn_key INTEGER NOT NULL DEFAULT 0  -- ingest.transaction_key
+);
+-- Covers per-merchant aggregation without touching the table itself
+CREATE INDEX IF NOT EXISTS clv_transactions_merchant_customer_time
+    ON clv_transactions (merchant_id, customer_id, timestamp, total_cents);
+CREATE INDEX IF NOT EXISTS clv_transactions_source ON clv_transactions (source_id);
+"""
+
+# Created after _migrate(), which adds txn_key to databases from before it existed
+KEY_INDEX = f"""
+CREATE INDEX IF NOT EXISTS clv_transactions_key ON clv_transactions (txn_key) WHERE txn_key != {NO_KEY};
+"""
+
+# Host parameters per `txn_key IN (...)` lookup, under SQLite's default limit
+KEY_LOOKUP_BATCH = 500
+
+# Per-(merchant, customer) aggregates, in MerchantCustomerTable.BASE_AGGREGATES order;
+# integer division truncates, which floors here because gaps are never negative
+PAIR_AGGREGATES_SQL = f"""
+SELECT merchant_id, customer_id, SUM(total_cents), COUNT(*), MIN(timestamp), MAX(timestamp), SUM(gap_days)
+FROM (
+    SELECT merchant_id, customer_id, total_cents, timestamp,
+           COALESCE((timestamp - LAG(timestamp) OVER (
+               PARTITION BY merchant_id, customer_id ORDER BY timestamp
+           )) / {SECONDS_PER_DAY}, 0) AS gap_days
+    FROM clv_transactions
+    {{where}}
+)
+GROUP BY merchant_id, customer_id
+ORDER BY merchant_id, customer_id
+"""
+
+
+def _fetch_int_columns(cursor: sqlite3.Cursor, width: int) -> np.ndarray:
+    """Read an all-integer result set straight into an (rows, width) int64 array."""
+    flat = np.fromiter(itertools.chain.from_iterable(cursor), dtype=np.int64)
+    return flat.reshape(-1, width)
+
+
+class SQLiteStore:
+    """Normalized, indexed SQLite storage for transactions from every source.
+
+    Customer data files and the Knot sync server's `transactions` table are
+    both ingested into clv_* tables in one database file (server.js's
+    transactions.db by default), so the demo files and the production feed
+    share one path into CLVAnalyzer. The database runs in WAL mode, so the
+    sync server keeps writing while the analyzer reads.
+
+    Ingestion is incremental: data files are skipped while their size and
+    mtime, or failing that their content hash, are unchanged (changed
+    files replace their rows, deleted files drop them), and Knot rows are
+    read from the last ingested row id on.
+    A transaction already stored under the same id (Knot pagination can
+    redeliver them) is not inserted again: a Bloom filter over the stored
+    keys clears most rows in memory, and only its possible hits are
+    looked up in the key index.
+    """
+
+    def __init__(self, path: str = 'transactions.db'):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self._migrate()
+        self.conn.executescript(KEY_INDEX)
+        self._load_tables()
+        self._bloom: Optional[BloomFilter] = None
+        self._bloom_keys = 0
+
+    def _migrate(self):
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(clv_transactions)')}
+        if 'txn_key' not in columns:
+            self.conn.execute(f'ALTER TABLE clv_transactions ADD COLUMN txn_key INTEGER NOT NULL DEFAULT {NO_KEY}')
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(clv_sources)')}
+        for column in ('size', 'mtime_ns'):
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE clv_sources ADD COLUMN {column} INTEGER')
+
+    def _load_tables(self):
+        self.tables: Dict[str, StringTable] = {
+            name: StringTable(row[0] for row in self.conn.execute(f'SELECT name FROM {table} ORDER BY id'))
+            for name, table in LOOKUP_TABLES.items()
+        }
+
+    def _intern(self, name: str, values: List[str]) -> np.ndarray:
+        """Codes of values in a lookup table, inserting the ones not seen before."""
+        table = self.tables[name]
+        start = len(table)
+        codes = np.array([table.encode(value) for value in values], dtype=np.int64)
+        if len(table) > start:
+            self.conn.executemany(
+                f'INSERT INTO {LOOKUP_TABLES[name]} (id, name) VALUES (?, ?)',
+                zip(range(start, len(table)), table.values[start:])
+            )
+        return codes
+
+    def _source(self, name: str) -> int:
+        self.conn.execute('INSERT OR IGNORE INTO clv_sources (name) VALUES (?)', (name,))
+        return self.conn.execute('SELECT id FROM clv_sources WHERE name = ?', (name,)).fetchone()[0]
+
+    def _new_keys(self, keys: np.ndarray) -> np.ndarray:
+        """Mask of rows whose transaction key is not stored yet (nor repeated earlier in keys)."""
+        if self._bloom is None:
+            stored = np.fromiter((row[0] for row in self.conn.execute(
+                f'SELECT txn_key FROM clv_transactions WHERE txn_key != {NO_KEY}'
+            )), dtype=np.int64)
+            self._bloom = BloomFilter(max(2 * len(stored), 1 << 16))
+            self._bloom.add(stored)
+            self._bloom_keys = len(stored)
+
+        new = first_occurrences(keys)
+        # Bits of deleted rows stay set; that only costs a lookup, the index has the final say
+        candidates = np.flatnonzero(new & (keys != NO_KEY) & self._bloom.might_contain(keys))
+        for start in range(0, len(candidates), KEY_LOOKUP_BATCH):
+            batch = candidates[start:start + KEY_LOOKUP_BATCH]
+            found = {row[0] for row in self.conn.execute(
+                f'SELECT txn_key FROM clv_transactions WHERE txn_key != {NO_KEY} '
+                f'AND txn_key IN ({",".join("?" * len(batch))})', keys[batch].tolist()
+            )}
+            new[batch[np.isin(keys[batch], np.fromiter(found, dtype=np.int64, count=len(found)))]] = False
+
+        added = keys[new & (keys != NO_KEY)]
+        self._bloom_keys += len(added)
+        if self._bloom_keys > self._bloom.capacity:
+            self._bloom = None  # rebuilt, larger, from the table on next use
+        else:
+            self._bloom.add(added)
+        return new
+
+    def _insert_partial(self, partial: Dict, source_id: int) -> int:
+        """Bulk-insert one customer partial (see ingest.parse_transactions), minus stored transactions.
+
+        Returns the number of rows inserted.
+        """
+        keep = self._new_keys(partial['key'])
+        num_rows = int(np.count_nonzero(keep))
+        if not num_rows:
+            return 0
+        customer = int(self._intern('customers', [partial['customer_id']])[0])
+        merchant = self._intern('merchants', partial['merchants'])[partial['merchant'][keep]]
+        status = self._intern('statuses', partial['statuses'])[partial['status'][keep]]
+        brand = self._intern('brands', partial['brands'])[partial['brand'][keep]]
+        self.conn.executemany(
+            'INSERT INTO clv_transactions '
+            '(customer_id, merchant_id, timestamp, total_cents, status_id, brand_id, source_id, txn_key) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            zip(itertools.repeat(customer), merchant.tolist(), partial['timestamp'][keep].tolist(),
+                partial['total_cents'][keep].tolist(), status.tolist(), brand.tolist(), itertools.repeat(source_id),
+                partial['key'][keep].tolist())
+        )
+        return num_rows
+
+    def _transaction(self, ingest_fn):
+        """Run ingest_fn in one database transaction; the lookup tables are re-read if it fails."""
+        try:
+            with self.conn:
+                return ingest_fn()
+        except Exception:
+            self._load_tables()
+            self._bloom = None
+            raise
+
+    def ingest_directory(self, data_dir: str, workers: Optional[int] = None) -> Dict:
+        """Ingest new and changed customer files from data_dir and forget deleted ones.
+
+        Only files whose size or mtime changed are hashed (see
+        ingest.scan_changes), so a reload with nothing new reads no data.
+        """
+        manifest = {
+            name: {'sha256': sha256, 'size': size, 'mtime_ns': mtime_ns}
+            for name, sha256, size, mtime_ns in self.conn.execute(
+                'SELECT name, sha256, size, mtime_ns FROM clv_sources WHERE name != ?', (KNOT_SOURCE,)
+            )
+        }
+        changed, deleted, touched = ingest.scan_changes(data_dir, manifest)
+        num_files = len(manifest) - len(deleted) + sum(os.path.basename(path) not in manifest for path in changed)
+        partials, _ = ingest.parse_customer_files(changed, workers) if changed else ([], 1)
+
+        def apply():
+            rows, parsed_rows, errors = 0, 0, []
+            self.conn.executemany(
+                'UPDATE clv_sources SET size = ?, mtime_ns = ? WHERE name = ?',
+                [(entry['size'], entry['mtime_ns'], name) for name, entry in touched.items()]
+            )
+            for name in deleted:
+                source_id = self._source(name)
+                self.conn.execute('DELETE FROM clv_transactions WHERE source_id = ?', (source_id,))
+                self.conn.execute('DELETE FROM clv_sources WHERE id = ?', (source_id,))
+            for partial in partials:
+                # A changed file's old rows go even if the new version fails to parse
+                source_id = self._source(partial['filename'])
+                self.conn.execute('DELETE FROM clv_transactions WHERE source_id = ?', (source_id,))
+                if 'error' in partial:
+                    print(f"Error reading {partial['filename']}")
+                    errors.append(partial['filename'])
+                    continue
+                ingest.report_invalid(partial)
+                parsed_rows += len(partial['timestamp'])
+                rows += self._insert_partial(partial, source_id)
+                self.conn.execute('UPDATE clv_sources SET sha256 = ?, size = ?, mtime_ns = ? WHERE id = ?',
+                                  (partial['sha256'], partial['size'], partial['mtime_ns'], source_id))
+            return {'files': num_files, 'parsed': len(partials), 'deleted': len(deleted),
+                    'rows': rows, 'duplicates': parsed_rows - rows, 'errors': errors}
+
+        return self._transaction(apply)
+
+    def ingest_knot(self) -> Dict:
+        """Ingest Knot transactions synced by server.js since the last call.
+
+        Rows are attributed to their externalUserId; rows without one (or
+        without a datetime, url or price total) cannot be ranked and are
+        only counted as skipped. Redelivered transactions (same Knot id)
+        are counted as duplicates.
+        """
+        columns = {row[1] for row in self.conn.execute(f'PRAGMA table_info({KNOT_TABLE})')}
+        if 'externalUserId' not in columns:
+            return {'rows': 0, 'skipped': 0, 'duplicates': 0}
+        source_id = self._source(KNOT_SOURCE)
+        last_row = self.conn.execute('SELECT last_row FROM clv_sources WHERE id = ?', (source_id,)).fetchone()[0] or 0
+        max_row = self.conn.execute(f'SELECT MAX(id) FROM {KNOT_TABLE}').fetchone()[0] or 0
+
+        by_customer = defaultdict(list)
+        skipped = 0
+        cursor = self.conn.execute(
+            f'SELECT externalUserId, transactionId, externalId, datetime, url, orderStatus, paymentMethods, price '
+            f'FROM {KNOT_TABLE} WHERE id > ? AND id <= ? ORDER BY id', (last_row, max_row)
+        )
+        for customer_id, transaction_id, external_id, datetime, url, order_status, payment_methods, price in cursor:
+            price = json.loads(price or '{}')
+            if not (customer_id and datetime and url and price.get('total') is not None):
+                skipped += 1
+                continue
+            by_customer[customer_id].append({
+                'id': transaction_id,
+                'external_id': external_id,
+                'datetime': datetime,
+                'url': url,
+                'order_status': order_status,
+                'payment_methods': json.loads(payment_methods or '[]'),
+                'price': price,
+            })
+
+        def apply():
+            rows = sum(
+                self._insert_partial(ingest.parse_transactions(customer_id, transactions), source_id)
+                for customer_id, transactions in by_customer.items()
+            )
+            self.conn.execute('UPDATE clv_sources SET last_row = ? WHERE id = ?', (max_row, source_id))
+            parsed_rows = sum(len(transactions) for transactions in by_customer.values())
+            return {'rows': rows, 'skipped': skipped, 'duplicates': parsed_rows - rows}
+
+        return self._transaction(apply)
+
+    def ingest(self, data_dir: Optional[str] = None, workers: Optional[int] = None) -> Dict:
+        """Ingest both sources; returns stats per source."""
+        stats = {'knot': self.ingest_knot()}
+        if data_dir is not None:
+            stats['files'] = self.ingest_directory(data_dir, workers)
+        return stats
+
+    def pair_aggregates(self, merchant_code: Optional[int] = None) -> Dict[str, np.ndarray]:
+        """Per-(merchant, customer) aggregates computed inside SQLite.
+
+        Sums, counts, first/last purchase and inter-purchase gap days are
+        grouped over the (merchant, customer, time) index, for every
+        merchant or just one; the result feeds
+        MerchantCustomerTable.from_aggregates.
+        """
+        where, params = ('WHERE merchant_id = ?', (merchant_code,)) if merchant_code is not None else ('', ())
+        names = MerchantCustomerTable.BASE_AGGREGATES
+        values = _fetch_int_columns(self.conn.execute(PAIR_AGGREGATES_SQL.format(where=where), params), len(names))
+        return {name: values[:, i] for i, name in enumerate(names)}
+
+    def to_store(self) -> TransactionStore:
+        """Read every transaction into a TransactionStore, in index order."""
+        store = TransactionStore()
+        for name in TransactionStore.STRING_TABLES:
+            setattr(store, name, StringTable(self.tables[name].values))
+        values = _fetch_int_columns(self.conn.execute(
+            'SELECT customer_id, merchant_id, timestamp, total_cents, status_id, brand_id, txn_key FROM clv_transactions '
+            'ORDER BY merchant_id, customer_id, timestamp'
+        ), len(TransactionStore.COLUMNS))
+        for i, name in enumerate(TransactionStore.COLUMNS):
+            setattr(store, name, values[:, i].astype(getattr(store, name).dtype))
+        store.build_index()
+        return store
+
+    def close(self):
+        self.conn.close()
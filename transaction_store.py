@@ -0,0 +1,323 @@
+import json
+import os
+import numpy as np
+from typing import Dict, List, Iterable, Optional, Tuple
+
+from dedup import Deduplicator
+from sketches import hash64
+
+SECONDS_PER_DAY = 86400
+
+
+class StringTable:
+    """Dictionary-encode strings into dense integer codes."""
+
+    def __init__(self, values: Iterable[str] = ()):
+        self.values: List[str] = []
+        self.codes: Dict[str, int] = {}
+        for value in values:
+            self.encode(value)
+
+    def encode(self, value: str) -> int:
+        """Return the code for a value, adding it to the table if needed."""
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+    def lookup(self, value: str) -> int:
+        """Return the code for a value, or -1 if it has never been seen."""
+        return self.codes.get(value, -1)
+
+    def decode(self, code: int) -> str:
+        return self.values[code]
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __contains__(self, value: str) -> bool:
+        return value in self.codes
+
+
+def _remap(table: StringTable, local_values: List[str], local_codes: np.ndarray, dtype) -> np.ndarray:
+    """Translate codes from a partial's own string table into a shared table."""
+    mapping = np.array([table.encode(value) for value in local_values], dtype=dtype)
+    return mapping[local_codes] if len(mapping) else local_codes.astype(dtype)
+
+
+def append_to_column(buffers: Dict[str, np.ndarray], name: str, column: np.ndarray, values) -> np.ndarray:
+    """Append values to a column kept as a view of an over-allocated buffer.
+
+    Returns the new column view. Growth doubles the buffer, so repeated
+    appends cost amortized O(1) per value.
+    """
+    start = len(column)
+    end = start + len(values)
+    buffer = buffers.get(name)
+    if buffer is None or column.base is not buffer or len(buffer) < end:
+        buffer = np.empty(max(2 * end, 1024), dtype=column.dtype)
+        buffer[:start] = column
+        buffers[name] = buffer
+    buffer[start:end] = values
+    return buffer[:end]
+
+
+class TransactionStore:
+    """Columnar storage for every transaction of every loaded customer.
+
+    Each transaction is one row across parallel NumPy arrays. String
+    attributes (customer ids, merchants, order statuses, payment brands)
+    are dictionary-encoded through a StringTable, so a row is a handful of
+    fixed-width integers instead of a nested dict.
+
+    Rows are also indexed by merchant: merchant_rows holds every row id
+    grouped by merchant, then by customer, then by time, and
+    merchant_offsets[m]:merchant_offsets[m + 1] is merchant m's slice of it.
+    Rows appended after the index was built (row id >= indexed_rows) are
+    not in it until ensure_index() is called.
+
+    Every row keeps the hash of its transaction id (key), so the same Knot
+    transaction delivered twice is stored once: dedupe() drops repeats
+    from a freshly built store and append_partial() skips rows whose key
+    is already present.
+    """
+
+    COLUMNS = ('customer', 'merchant', 'timestamp', 'total_cents', 'status', 'brand', 'key')
+    INDEX_COLUMNS = ('merchant_rows', 'merchant_offsets')
+    STRING_TABLES = ('customers', 'merchants', 'statuses', 'brands')
+    SNAPSHOT_FORMAT = 2
+
+    def __init__(self):
+        self.customers = StringTable()
+        self.merchants = StringTable()
+        self.statuses = StringTable()
+        self.brands = StringTable()
+
+        self.customer = np.empty(0, dtype=np.int32)
+        self.merchant = np.empty(0, dtype=np.int32)
+        self.timestamp = np.empty(0, dtype=np.int64)  # epoch seconds
+        self.total_cents = np.empty(0, dtype=np.int64)
+        self.status = np.empty(0, dtype=np.int16)
+        self.brand = np.empty(0, dtype=np.int16)
+        self.key = np.empty(0, dtype=np.int64)  # ingest.transaction_key, dedup.NO_KEY if the row has no id
+
+        self.merchant_rows = np.empty(0, dtype=np.int64)
+        self.merchant_offsets = np.zeros(1, dtype=np.int64)
+        self.indexed_rows = 0
+
+        # Over-allocated backing arrays for appended rows; the columns above are views into them
+        self._buffers: Dict[str, np.ndarray] = {}
+        self._deduplicator: Optional[Deduplicator] = None
+        self._customer_hashes = np.empty(0, dtype=np.uint64)
+
+    def build_index(self):
+        """Build the merchant -> (customer, time) ordered posting lists."""
+        self.merchant_rows = np.lexsort((self.timestamp, self.customer, self.merchant))
+        counts = np.bincount(self.merchant, minlength=len(self.merchants))
+        self.merchant_offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.indexed_rows = self.num_transactions
+
+    def ensure_index(self):
+        if self.indexed_rows != self.num_transactions:
+            self.build_index()
+
+    def rows_for_merchant(self, merchant_code: int) -> np.ndarray:
+        """Indexed row ids of one merchant's transactions, ordered by customer then time."""
+        if merchant_code + 1 >= len(self.merchant_offsets):
+            return np.empty(0, dtype=np.int64)
+        return self.merchant_rows[self.merchant_offsets[merchant_code]:self.merchant_offsets[merchant_code + 1]]
+
+    def pair_timestamps(self, merchant_code: int, customer_code: int) -> np.ndarray:
+        """Sorted timestamps of one customer's transactions with one merchant."""
+        rows = self.rows_for_merchant(merchant_code)
+        customers = self.customer[rows]
+        lo, hi = np.searchsorted(customers, [customer_code, customer_code + 1])
+        indexed = self.timestamp[rows[lo:hi]]
+        tail = slice(self.indexed_rows, self.num_transactions)
+        appended = self.timestamp[tail][
+            (self.merchant[tail] == merchant_code) & (self.customer[tail] == customer_code)
+        ]
+        return np.sort(np.concatenate((indexed, appended)))
+
+    def encode_partial(self, partial: Dict) -> Dict[str, np.ndarray]:
+        """Translate a customer partial (see ingest.parse_customer) into store-coded columns."""
+        customer_code = self.customers.encode(partial['customer_id'])
+        return {
+            'customer': np.full(len(partial['timestamp']), customer_code, dtype=np.int32),
+            'merchant': _remap(self.merchants, partial['merchants'], partial['merchant'], np.int32),
+            'timestamp': partial['timestamp'],
+            'total_cents': partial['total_cents'],
+            'status': _remap(self.statuses, partial['statuses'], partial['status'], np.int16),
+            'brand': _remap(self.brands, partial['brands'], partial['brand'], np.int16),
+            'key': partial['key'],
+        }
+
+    @property
+    def deduplicator(self) -> Deduplicator:
+        """Keys of every stored row; built from the key column on first use."""
+        if self._deduplicator is None:
+            self._deduplicator = Deduplicator(capacity=max(2 * self.num_transactions, 1 << 16))
+            self._deduplicator.add(np.asarray(self.key))
+        return self._deduplicator
+
+    def dedupe(self) -> int:
+        """Drop rows repeating an earlier row's transaction key; returns how many were dropped."""
+        self._deduplicator = Deduplicator(capacity=max(2 * self.num_transactions, 1 << 16))
+        keep = self._deduplicator.admit(np.asarray(self.key))
+        if keep.all():
+            return 0
+        for name in self.COLUMNS:
+            setattr(self, name, np.asarray(getattr(self, name))[keep])
+        self._buffers = {}
+        return self._deduplicator.duplicates
+
+    def append_partial(self, partial: Dict) -> Tuple[int, int]:
+        """Append one customer partial in amortized O(rows), skipping transactions already stored.
+
+        Returns the new row range, which is shorter than the partial when
+        some of its rows were repeats.
+        """
+        columns = self.encode_partial(partial)
+        keep = self.deduplicator.admit(columns['key'])
+        if not keep.all():
+            columns = {name: values[keep] for name, values in columns.items()}
+        start = self.num_transactions
+        for name in self.COLUMNS:
+            setattr(self, name, append_to_column(self._buffers, name, getattr(self, name), columns[name]))
+        return start, self.num_transactions
+
+    def drop_customers(self, customer_codes: Iterable[int]) -> np.ndarray:
+        """Remove every row of the given customers and rebuild the index.
+
+        Codes stay in the string tables, so every other code is unchanged
+        and a customer can be re-added under the same code. Returns the
+        distinct merchant codes the removed rows belonged to.
+        """
+        removed = np.isin(self.customer, np.fromiter(customer_codes, dtype=np.int64))
+        merchants = np.unique(self.merchant[removed])
+        keep = ~removed
+        for name in self.COLUMNS:
+            setattr(self, name, np.asarray(getattr(self, name))[keep])
+        self._buffers = {}
+        self._deduplicator = None
+        self.build_index()
+        return merchants
+
+    def save_snapshot(self, directory: str, key: str):
+        """Write the columns, index and string tables to a snapshot directory.
+
+        Arrays are stored as .npy files so they can be memory-mapped back;
+        the manifest is written last, so a partial write is never loaded.
+        Every file is written under a temporary name and renamed over the
+        old one, so processes (this one included) that still map the
+        previous snapshot keep reading its unchanged files.
+        """
+        self.ensure_index()
+        os.makedirs(directory, exist_ok=True)
+        manifest_path = os.path.join(directory, 'manifest.json')
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        for name in self.COLUMNS + self.INDEX_COLUMNS:
+            path = os.path.join(directory, f'{name}.npy')
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, getattr(self, name))
+            os.replace(path + '.tmp', path)
+        strings_path = os.path.join(directory, 'strings.json')
+        with open(strings_path + '.tmp', 'w') as f:
+            json.dump({name: getattr(self, name).values for name in self.STRING_TABLES}, f)
+        os.replace(strings_path + '.tmp', strings_path)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump({'format': self.SNAPSHOT_FORMAT, 'key': key, 'rows': self.num_transactions}, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    @classmethod
+    def load_snapshot(cls, directory: str, key: str, mmap: bool = True) -> Optional['TransactionStore']:
+        """Load a snapshot saved under the same key, or None if there is no match.
+
+        With mmap the arrays are read-only memory maps, paged in on first
+        use; appending copies a column into memory before growing it.
+        """
+        try:
+            with open(os.path.join(directory, 'manifest.json'), 'r') as f:
+                manifest = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if manifest.get('format') != cls.SNAPSHOT_FORMAT or manifest.get('key') != key:
+            return None
+
+        store = cls()
+        mmap_mode = 'r' if mmap else None
+        for name in cls.COLUMNS + cls.INDEX_COLUMNS:
+            setattr(store, name, np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode))
+        with open(os.path.join(directory, 'strings.json'), 'r') as f:
+            strings = json.load(f)
+        for name in cls.STRING_TABLES:
+            setattr(store, name, StringTable(strings[name]))
+        store.indexed_rows = manifest['rows']
+        return store
+
+    @property
+    def datetimes(self) -> np.ndarray:
+        """Zero-copy datetime64[s] view of the timestamp column."""
+        return self.timestamp.view('datetime64[s]')
+
+    def customer_hashes(self) -> np.ndarray:
+        """sketches.hash64 of every customer id, indexed by customer code.
+
+        Codes are only ever appended, so hashes of new customers are added
+        to the cached array as they appear.
+        """
+        if len(self._customer_hashes) < self.num_customers:
+            new = hash64(self.customers.values[len(self._customer_hashes):])
+            self._customer_hashes = np.concatenate((self._customer_hashes, new))
+        return self._customer_hashes
+
+    @property
+    def num_customers(self) -> int:
+        """Size of the customer code space, including customers whose rows were all dropped."""
+        return len(self.customers)
+
+    @property
+    def num_loaded_customers(self) -> int:
+        """Customers with at least one row; drop_customers() keeps the codes of the ones it removes."""
+        return int(np.count_nonzero(np.bincount(self.customer, minlength=self.num_customers)))
+
+    @property
+    def num_transactions(self) -> int:
+        return len(self.customer)
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the column arrays (string tables excluded)."""
+        return sum(column.nbytes for column in (
+            self.customer, self.merchant, self.timestamp,
+            self.total_cents, self.status, self.brand, self.key,
+            self.merchant_rows, self.merchant_offsets
+        ))
+
+    def __len__(self) -> int:
+        return self.num_transactions
+
+
+class TransactionStoreBuilder:
+    """Merge per-customer partials, then freeze them into a TransactionStore."""
+
+    def __init__(self):
+        self.store = TransactionStore()
+        self._chunks: Dict[str, List[np.ndarray]] = {name: [] for name in TransactionStore.COLUMNS}
+
+    def add_partial(self, partial: Dict):
+        """Queue the rows of one customer partial (see ingest.parse_customer)."""
+        for name, values in self.store.encode_partial(partial).items():
+            self._chunks[name].append(values)
+
+    def build(self) -> TransactionStore:
+        store = self.store
+        for name, chunks in self._chunks.items():
+            if chunks:
+                setattr(store, name, np.concatenate(chunks).astype(getattr(store, name).dtype, copy=False))
+        store.dedupe()
+        store.build_index()
+        return store
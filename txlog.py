@@ -0,0 +1,178 @@
+import argparse
+import json
+import os
+from typing import Dict
+
+import numpy as np
+
+import customer_files
+import ingest
+from dedup import Deduplicator
+from transaction_store import StringTable, TransactionStore
+
+MAGIC = b'KNOTTXL2'
+HEADER_BYTES = 64
+
+# One fixed-width, little-endian record per transaction (40 bytes)
+RECORD_DTYPE = np.dtype([
+    ('customer', '<i4'),
+    ('merchant', '<i4'),
+    ('timestamp', '<i8'),  # epoch seconds
+    ('total_cents', '<i8'),
+    ('status', '<i2'),
+    ('brand', '<i2'),
+    ('product', '<i4'),  # first product name, coded in the products table
+    ('key', '<i8'),  # ingest.transaction_key
+])
+
+
+class TransactionLogWriter:
+    """Write customer files into a memory-mappable transaction log directory.
+
+    Layout:
+        records.bin       64-byte header, then RECORD_DTYPE records
+        strings.json      small string tables (customers, merchants, ...)
+        urls.blob         UTF-8 order URLs back to back, one per record
+        url_offsets.npy   int64 offsets into urls.blob (records + 1 entries)
+        merchant_rows.npy / merchant_offsets.npy   the store's merchant index
+
+    Transactions whose id was already written are skipped.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.tables: Dict[str, StringTable] = {
+            name: StringTable() for name in TransactionStore.STRING_TABLES + ('products',)
+        }
+        self.num_records = 0
+        self.deduplicator = Deduplicator()
+        self.url_offsets = [0]
+        self._records = open(os.path.join(directory, 'records.bin'), 'wb')
+        self._records.write(b'\0' * HEADER_BYTES)
+        self._urls = open(os.path.join(directory, 'urls.blob'), 'wb')
+
+    def append_customer(self, customer_data: Dict):
+        partial = ingest.parse_customer(customer_data)
+        keep = self.deduplicator.admit(partial['key'])
+        transactions = [t for t, kept in zip(customer_data['transactions'], keep) if kept]
+        records = np.zeros(len(transactions), dtype=RECORD_DTYPE)
+        records['customer'] = self.tables['customers'].encode(partial['customer_id'])
+        for column, table in (('merchant', 'merchants'), ('status', 'statuses'), ('brand', 'brands')):
+            mapping = np.array([self.tables[table].encode(v) for v in partial[table]], dtype=np.int64)
+            records[column] = mapping[partial[column][keep]] if len(mapping) else 0
+        for column in ('timestamp', 'total_cents', 'key'):
+            records[column] = partial[column][keep]
+        records['product'] = [
+            self.tables['products'].encode(t['products'][0].get('name') or '') if t.get('products') else -1
+            for t in transactions
+        ]
+        self._records.write(records.tobytes())
+
+        for t in transactions:
+            url = (t.get('url') or '').encode('utf-8')
+            self._urls.write(url)
+            self.url_offsets.append(self.url_offsets[-1] + len(url))
+        self.num_records += len(transactions)
+
+    def close(self):
+        self._urls.close()
+        header = MAGIC + np.array([self.num_records, RECORD_DTYPE.itemsize], dtype='<i8').tobytes()
+        self._records.seek(0)
+        self._records.write(header.ljust(HEADER_BYTES, b'\0'))
+        self._records.close()
+        np.save(os.path.join(self.directory, 'url_offsets.npy'), np.array(self.url_offsets, dtype=np.int64))
+        with open(os.path.join(self.directory, 'strings.json'), 'w') as f:
+            json.dump({name: table.values for name, table in self.tables.items()}, f)
+
+        # Persist the merchant index so readers never have to sort
+        log = TransactionLog(self.directory, indexed=False)
+        store = log.to_store()
+        store.build_index()
+        for name in TransactionStore.INDEX_COLUMNS:
+            np.save(os.path.join(self.directory, f'{name}.npy'), getattr(store, name))
+
+
+class TransactionLog:
+    """Read-only, memory-mapped view of a transaction log directory.
+
+    Nothing is deserialized on open: records is a NumPy memmap, and each
+    column is a strided view into it, so processes that open the same log
+    share its pages through the OS page cache.
+    """
+
+    def __init__(self, directory: str, indexed: bool = True):
+        self.directory = directory
+        path = os.path.join(directory, 'records.bin')
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_BYTES)
+        if header[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a transaction log")
+        num_records, record_size = np.frombuffer(header[len(MAGIC):len(MAGIC) + 16], dtype='<i8')
+        if record_size != RECORD_DTYPE.itemsize:
+            raise ValueError(f"{path} has {record_size}-byte records, expected {RECORD_DTYPE.itemsize}")
+        self.records = np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER_BYTES, shape=(int(num_records),)) \
+            if num_records else np.empty(0, dtype=RECORD_DTYPE)
+
+        with open(os.path.join(directory, 'strings.json'), 'r') as f:
+            self.tables = {name: StringTable(values) for name, values in json.load(f).items()}
+        self.url_offsets = np.load(os.path.join(directory, 'url_offsets.npy'), mmap_mode='r')
+        self.urls = np.memmap(os.path.join(directory, 'urls.blob'), dtype=np.uint8, mode='r') \
+            if self.url_offsets[-1] else np.empty(0, dtype=np.uint8)
+        self.index = {
+            name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+            for name in TransactionStore.INDEX_COLUMNS
+        } if indexed else None
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def url(self, record: int) -> str:
+        return self.urls[self.url_offsets[record]:self.url_offsets[record + 1]].tobytes().decode('utf-8')
+
+    def product_name(self, record: int) -> str:
+        code = int(self.records['product'][record])
+        return self.tables['products'].decode(code) if code >= 0 else ''
+
+    def to_store(self) -> TransactionStore:
+        """A TransactionStore whose columns are zero-copy views of the log."""
+        store = TransactionStore()
+        for name in TransactionStore.COLUMNS:
+            setattr(store, name, self.records[name])
+        for name in TransactionStore.STRING_TABLES:
+            setattr(store, name, self.tables[name])
+        if self.index is not None:
+            store.merchant_rows = self.index['merchant_rows']
+            store.merchant_offsets = self.index['merchant_offsets']
+            store.indexed_rows = len(self.records)
+        return store
+
+
+def write_log(data_dir: str, directory: str) -> int:
+    """Convert every customer file in data_dir into a transaction log; returns the record count.
+
+    Repeated transactions are written once.
+    """
+    writer = TransactionLogWriter(directory)
+    for path in ingest.list_customer_files(data_dir):
+        try:
+            customer_data = customer_files.load_customer_document(path)
+        except (json.JSONDecodeError,) + customer_files.DECOMPRESSION_ERRORS:
+            print(f"Error reading {os.path.basename(path)}")
+            continue
+        writer.append_customer(customer_data)
+    writer.close()
+    return writer.num_records
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert customer data files into a memory-mapped transaction log')
+    parser.add_argument('--data-dir', type=str, default='data', help='Customer data directory')
+    parser.add_argument('--outdir', type=str, default='transaction_log', help='Output log directory')
+    args = parser.parse_args()
+    num_records = write_log(args.data_dir, args.outdir)
+    print(f"Wrote {num_records} transactions to '{args.outdir}'")
+
+
+if __name__ == "__main__":
+    main()
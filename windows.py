@@ -0,0 +1,129 @@
+import numpy as np
+from typing import Dict, Optional, Tuple
+
+from transaction_store import TransactionStore
+
+# Bits of a pair search key given to the timestamp; the pair id takes the rest
+TIME_BITS = 34
+
+
+class WindowIndex:
+    """Running sums over every merchant's transactions, for [since, until) window queries.
+
+    The indexed rows are kept in two orders. By time: each merchant's rows
+    sorted by timestamp, with a running sum of cents, so a merchant's
+    transaction count and revenue in any window come from two binary
+    searches and a subtraction. By pair: the store's merchant index
+    (merchant, customer, time) with its own running sum; each row also
+    gets a search key of (pair id << TIME_BITS | time), so every
+    customer's first and last row inside a window is one vectorized
+    binary search per customer, however many rows the window holds.
+
+    Rows appended to the store after the build are scanned as a tail;
+    rebuild the index once the tail grows too long.
+    """
+
+    def __init__(self, store: TransactionStore):
+        store.ensure_index()
+        self.store = store
+        self.num_rows = store.num_transactions
+        self.num_merchants = len(store.merchants)
+        rows = store.merchant_rows
+        merchants = store.merchant[rows]
+        customers = store.customer[rows]
+        timestamps = store.timestamp[rows]
+        cents = store.total_cents[rows]
+        self.merchant_offsets = np.asarray(store.merchant_offsets[:self.num_merchants + 1])
+
+        # Time order within each merchant
+        by_time = np.lexsort((timestamps, merchants))
+        self.times = timestamps[by_time]
+        self.cum_cents = np.concatenate(([0], np.cumsum(cents[by_time])))
+
+        # Pair order: the index's own (merchant, customer, time) order
+        new_pair = np.ones(len(rows), dtype=bool)
+        new_pair[1:] = (merchants[1:] != merchants[:-1]) | (customers[1:] != customers[:-1])
+        pair_starts = np.flatnonzero(new_pair)
+        self.pair_customer = customers[pair_starts]
+        self.pair_offsets = np.searchsorted(merchants[pair_starts], np.arange(self.num_merchants + 1))
+        self.t0 = int(timestamps.min()) if len(rows) else 0
+        pair_ids = np.cumsum(new_pair) - 1
+        self.pair_keys = (pair_ids.astype(np.int64) << TIME_BITS) | (timestamps - self.t0)
+        self.pair_times = timestamps
+        self.pair_cum_cents = np.concatenate(([0], np.cumsum(cents)))
+
+    def _time_offset(self, moment: int) -> int:
+        return min(max(moment - self.t0, 0), (1 << TIME_BITS) - 1)
+
+    def _tail_rows(self, merchant_code: int, since: Optional[int], until: Optional[int]) -> np.ndarray:
+        """Rows appended since the build that match a merchant and window."""
+        store = self.store
+        tail = np.arange(self.num_rows, store.num_transactions)
+        mask = store.merchant[tail] == merchant_code
+        if since is not None:
+            mask &= store.timestamp[tail] >= since
+        if until is not None:
+            mask &= store.timestamp[tail] < until
+        return tail[mask]
+
+    def totals(self, merchant_code: int, since: Optional[int] = None, until: Optional[int] = None) -> Tuple[int, int]:
+        """(transactions, revenue_cents) of one merchant with since <= timestamp < until."""
+        transactions, revenue_cents = 0, 0
+        if 0 <= merchant_code < self.num_merchants:
+            lo, hi = self.merchant_offsets[merchant_code], self.merchant_offsets[merchant_code + 1]
+            times = self.times[lo:hi]
+            start = lo + (np.searchsorted(times, since) if since is not None else 0)
+            end = lo + (np.searchsorted(times, until) if until is not None else len(times))
+            transactions = int(end - start)
+            revenue_cents = int(self.cum_cents[end] - self.cum_cents[start])
+        tail = self._tail_rows(merchant_code, since, until)
+        return transactions + len(tail), revenue_cents + int(self.store.total_cents[tail].sum())
+
+    def customer_aggregates(self, merchant_code: int, since: Optional[int] = None,
+                            until: Optional[int] = None) -> Dict[str, np.ndarray]:
+        """Per-customer aggregates of one merchant's transactions inside a window.
+
+        Returns customer, total_cents, num_transactions, first_purchase
+        and last_purchase columns, one entry per customer with at least
+        one transaction in the window, sorted by customer code.
+        """
+        parts = []
+        if 0 <= merchant_code < self.num_merchants:
+            pairs = np.arange(self.pair_offsets[merchant_code], self.pair_offsets[merchant_code + 1], dtype=np.int64)
+            base = pairs << TIME_BITS
+            start = np.searchsorted(self.pair_keys, base + (self._time_offset(since) if since is not None else 0))
+            end = np.searchsorted(self.pair_keys, base + (self._time_offset(until) if until is not None else 1 << TIME_BITS))
+            active = end > start
+            start, end = start[active], end[active]
+            parts.append((self.pair_customer[pairs[active]], self.pair_cum_cents[end] - self.pair_cum_cents[start],
+                          end - start, self.pair_times[start], self.pair_times[end - 1]))
+
+        tail = self._tail_rows(merchant_code, since, until)
+        if len(tail):
+            store = self.store
+            timestamps = store.timestamp[tail]
+            parts.append((store.customer[tail], store.total_cents[tail], np.ones(len(tail), dtype=np.int64),
+                          timestamps, timestamps))
+        if not parts:
+            parts.append((np.empty(0, dtype=np.int32),) + tuple(np.empty(0, dtype=np.int64) for _ in range(4)))
+
+        customer, total_cents, num_transactions, first, last = (np.concatenate(column) for column in zip(*parts))
+        if len(tail):
+            # Tail rows may repeat a customer, or belong to one the index already has: merge by customer
+            order = np.argsort(customer, kind='stable')
+            customer, total_cents, num_transactions, first, last = (
+                column[order] for column in (customer, total_cents, num_transactions, first, last)
+            )
+            starts = np.flatnonzero(np.concatenate(([True], customer[1:] != customer[:-1])))
+            customer = customer[starts]
+            total_cents = np.add.reduceat(total_cents, starts)
+            num_transactions = np.add.reduceat(num_transactions, starts)
+            first = np.minimum.reduceat(first, starts)
+            last = np.maximum.reduceat(last, starts)
+        return {
+            'customer': customer,
+            'total_cents': total_cents.astype(np.int64),
+            'num_transactions': num_transactions.astype(np.int64),
+            'first_purchase': first.astype(np.int64),
+            'last_purchase': last.astype(np.int64),
+        }